@@ -9,6 +9,73 @@ Contributors: Dr. Anton Vrieling
 '''
 Major updates
 ===============================================================
+19/10/2026
+- new class -> Manifest, records the inputs and settings of each output, replaces the remove_latest heuristics in
+udm2_setnull(), merge(), clip() and band_algebra(), which now only rebuild outdated outputs
+- all outputs are written under a temporary name in the output folder and renamed when complete, see atomic_output()
+- new function -> validate_outputs(), fast integrity check of existing GeoTIFFs, broken ones are queued for rebuild
+- new decorator -> track_stage(), the public stages append wall/CPU time, I/O, task counts, peak RSS and GDAL cache
+usage to [work_dir]/run_log.jsonl, see summarize_run_log() and run_log_summary.py
+- prep_pipline() -> intermediate folders in the work directory or temp_dir instead of hard-coded paths
+- batch_run.py -> runs the stages of the jobs (AOIs x date ranges) listed in a YAML/TOML file in parallel within a
+worker budget, resuming from the manifest of each job, replaces editing main.py for every run; run_tasks() spreads
+the outdated tasks of a stage over the n_workers processes of the job
+- new variable -> shared_dir, downloaded and merged images can be shared by several AOIs, see stage_dir()
+- new function -> run_multi_aoi(), searches the union of the AOIs (aoi_shp can be a list) and downloads/merges once in
+shared_dir, clip onward runs per AOI in its own work directory on the merged images intersecting the AOI, see
+for_aoi() and aoi_file_list()
+- new variable -> gdal_config, GDAL cache, threads, VSI cache and gdal.Warp memory/threading per stage, divided
+between pool workers, applied by track_stage() and recorded in the run log, see gdal_settings()
+- new variable -> queue_dir, the tasks of setnull, merge, clip and band algebra are run by workers on several hosts
+sharing a filesystem through a file based work queue with leases and retries, see work_queue.py; queue_lease_s and
+queue_max_attempts set the lease duration and the number of attempts
+- new variable -> compression_profiles, codec, level, predictor and tiling per asset type (ZSTD level 1 + PREDICTOR=2
+by default instead of LZW) honoured by every GeoTIFF and netCDF write path, see creation_options(); gdal_merge()
+compresses in one gdal.Translate() pass, which fixes the LZW read errors; benchmarks/bench_compression.py compares the
+codecs, higher ZSTD levels mostly cost write time
+- prep_pipline(crs, target_grid) -> the images of each day are reprojected and aligned to a target grid on the fly
+through warped VRTs while stacking, no reprojected copy of the stacks is written, see warp_options(); with crs only,
+every day is warped to one grid covering all days, see common_grid()
+- new variables -> min_aoi_coverage, min_usable_area, download_assets() drops the search results covering too little
+of the AOI, or too little of it without clouds, before downloading, see coverage_filter()
+- new function -> run_streaming(), each day/satellite group is set to null, merged, clipped and turned into clear
+prob/NDVI as soon as its images are downloaded, bounded download queue and groups in flight, see stream_pipeline.py;
+the tasks of the stages are built by setnull_tasks(), merge_tasks(), clip_tasks() and band_algebra_tasks()
+- new variable -> tile_min_pixels, larger images are set to null and turned into NDVI/clear prob tile by tile in a
+process pool with the expressions and no data of gdal_calc.py, see gdal_calc_tiled(); the blocks of composite() and
+gap_fill() are aligned to the tiles of the output and split so that a single image keeps every worker busy
+- new variable -> virtual_intermediates, the setnull and merge outputs are VRTs (a Python pixel function and a mosaic)
+read by clip, which writes the only GeoTIFFs; prep_pipline() chains its intermediates as VRTs and writes each stack
+in one pass from a stack VRT instead of rewriting it for every date, see stack_vrt() and pixel_functions.py
+- new stage -> quality_catalog(), fractions of clear, snow, shadow, haze and cloud pixels and mean confidence of
+every clipped udm2 image per scene and per AOI, computed once in parallel and saved as parquet (csv without a parquet
+engine), used by clip_clear_perc() and select_scenes() instead of reopening the images
+- new stage -> gap_fill(), daily NDVI series gap filled by linear interpolation or smoothed with a Savitzky-Golay
+filter, from the clipped images or the prep_pipline() stacks, vectorized per block in a process pool
+- new stage -> composite(), monthly/seasonal median, max-NDVI or clearest-observation composites of the clipped sr
+masked with udm2 clear and confidence, with a source date band, vectorized per block in a process pool within a
+memory budget, see composite_block()
+- new function -> export_patch_store(), prep_pipline(patch_size) also exports the stacks to memory-mapped .npy
+arrays of patches with an index of dates and clear fraction per patch, read with patch_store.PatchStore
+- new function -> export_jp2(), the JPEG2000 export of prep_pipline() encodes sr and udm2 at the same time with
+tiles and code blocks, lossless udm2 by default, and reports the encode time of each output, see jp2_profiles; the
+encoder is multithreaded only where the JP2OpenJPEG driver has the NUM_THREADS creation option (not GDAL 3.0.4)
+- benchmarks/ -> synthetic PlanetScope data generator and benchmark runner of all processing stages
+- planet, geopandas, requests and netCDF4 are imported by the functions that use them, api_key.txt is read and the
+Planet client created on first use, so offline processing neither needs an API key nor pays their import time
+- new function -> run_pipeline(), runs download -> setnull -> merge -> clip -> clear prob/NDVI/stack incrementally
+- clip_clear_perc() -> rasterize the AOI polygons once per scene grid and compute the clear fraction from a windowed
+read of udm2 band 1 in a process pool, SR clip and thumbnail only for scenes passing the threshold
+- new variable -> n_workers
+- normalize() -> per band stretch with exact histogram percentiles for uint8/uint16, no data and cached statistics
+- new function -> band_percentiles()
+- clip_clear_perc() -> thumbnails rendered by render_thumbnail() in a process pool, decimated reads, no matplotlib
+- clip(discard_empty_scene=True) -> scenes selected with a cached STRtree over the footprints of all_scenes, which
+is persisted alongside the GeoPackage, see load_footprint_index()
+- new function -> clip_multi_tasks(), gdal_clip_feature() and clip(multi_feature=True) for clipping one raster to
+many polygons, one task per polygon reading only its window and recorded in the manifest; clip(spatial_index=True) also
+writes a spatial index (.qix) next to the AOI shapefile, which is left untouched otherwise
+
 10/01/2022
 - fix bugs
 - udm2_setnull() -> a_nodata 
@@ -72,30 +139,301 @@ To do list
 - gdal warp
 '''
 
-from planet import api
-from planet.api import filters
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
-import geopandas as gpd
 import json
 from tqdm import tqdm
 from glob import glob
 import os
-from osgeo import ogr, gdal
-import rasterio
-import matplotlib.pyplot as plt
+from osgeo import ogr, gdal, osr
 import numpy as np
-import requests
-from requests.auth import HTTPBasicAuth
 import sys
 import warnings
-import netCDF4
 import shutil
+import socket
+from contextlib import contextmanager, nullcontext
+import pickle
+import hashlib
+from multiprocessing import Pool, current_process
+import functools
+import copy
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 warnings.simplefilter('ignore')
 
+# Footprint indexes of scene catalogs, cached per process and keyed by the file path of the GeoPackage
+_footprint_index_cache = {}
+# Polygon masks rasterized to a scene grid, cached per worker process and keyed by geometry and grid
+_mask_cache = {}
+
 from pathlib import Path
 import string
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+# A unit of work of a processing stage: the output, the inputs and settings it is built from, and the name of the
+# Utilities method and its keyword arguments that build it
+Task = namedtuple('Task', ['stage', 'output_path', 'input_paths', 'params', 'func', 'kwargs'])
+
+
+def io_counters():
+    '''
+    Bytes read and written by the current process (Linux only)
+    :return: tuple, (read bytes, written bytes), (None, None) if not available
+    '''
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def usage_counters():
+    '''
+    Resource usage of the current process and its terminated child processes
+    :return: dictionary
+    '''
+    counters = {'cpu': time.process_time(), 'cpu_children': None, 'maxrss_mb': None, 'maxrss_children_mb': None,
+                'inblock_children': None, 'oublock_children': None}
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        counters.update({'cpu_children': usage_children.ru_utime + usage_children.ru_stime,
+                         'maxrss_mb': usage_self.ru_maxrss / rss_scale,
+                         'maxrss_children_mb': usage_children.ru_maxrss / rss_scale,
+                         'inblock_children': usage_children.ru_inblock,
+                         'oublock_children': usage_children.ru_oublock})
+    return counters
+
+
+def physical_memory_mb():
+    '''
+    Physical memory of the machine
+    :return: int, MB, 8192 if not available
+    '''
+    try:
+        return int(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2)
+    except (AttributeError, ValueError, OSError):
+        return 8192
+
+
+def apply_gdal_config(settings):
+    '''
+    Set GDAL configuration options (the upper case keys of settings) in the current process and in the environment of
+    its subprocesses, e.g., gdal_calc.py and gdal_merge.py. Also used as the initializer of pool workers.
+    :param settings: dictionary, {option: value}, None unsets an option, see Utilities.gdal_settings()
+    :return: dictionary, the previous values of the options
+    '''
+    previous = {}
+    for key, value in settings.items():
+        if not key.isupper():
+            continue
+        if key == 'GDAL_CACHEMAX':
+            # the block cache size is read once by GDAL, later changes need SetCacheMax()
+            previous[key] = gdal.GetCacheMax() // 1024 ** 2
+            if value is not None:
+                gdal.SetCacheMax(int(value) * 1024 ** 2)
+        else:
+            previous[key] = gdal.GetConfigOption(key)
+            gdal.SetConfigOption(key, None if value is None else str(value))
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = str(value)
+    return previous
+
+
+def tiff_codec_available(codec):
+    '''
+    Whether the GTiff driver of this GDAL build supports a compression codec, e.g., ZSTD needs GDAL >= 2.3 built with
+    libzstd
+    :param codec: string, e.g., 'ZSTD'
+    :return: boolean
+    '''
+    if codec == 'NONE':
+        return True
+    option_list = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return '<Value>{}</Value>'.format(codec) in option_list
+
+
+def vrt_python_settings(module='pixel_functions'):
+    '''
+    GDAL configuration options letting GDAL run the Python pixel functions of a trusted module when VRTs are read, see
+    pixel_functions.py. The module is appended to the trusted modules already set and GDAL_VRT_ENABLE_PYTHON is only
+    set if it is not set yet.
+    :param module: string, name of the module
+    :return: dictionary, {option: value}, see apply_gdal_config()
+    '''
+    trusted = gdal.GetConfigOption('GDAL_VRT_PYTHON_TRUSTED_MODULES')
+    module_list = [name for name in (trusted or '').split(',') if name]
+    return {'GDAL_VRT_ENABLE_PYTHON': gdal.GetConfigOption('GDAL_VRT_ENABLE_PYTHON') or 'TRUSTED_MODULES',
+            'GDAL_VRT_PYTHON_TRUSTED_MODULES': ','.join(module_list + ([] if module in module_list else [module]))}
+
+
+def jp2_creation_option_available(option):
+    '''
+    Whether the JP2OpenJPEG driver of this GDAL build lists a creation option, e.g., NUM_THREADS, which older builds
+    (e.g., GDAL 3.0.4) do not have and would ignore with a warning
+    :param option: string, e.g., 'NUM_THREADS'
+    :return: boolean
+    '''
+    driver = gdal.GetDriverByName('JP2OpenJPEG')
+    option_list = (driver.GetMetadataItem('DMD_CREATIONOPTIONLIST') if driver is not None else None) or ''
+    return 'name="{}"'.format(option) in option_list
+
+
+def track_stage(func):
+    '''
+    Decorator of the public processing stages, appends a structured record (json line) of each call to the run log:
+    wall and CPU time, bytes read and written, number of tasks, peak RSS and GDAL cache usage. The GDAL settings of
+    the stage (see Utilities.gdal_settings()) are applied while it runs and recorded as well.
+    '''
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        parent = self._stage_stack[-1] if self._stage_stack else None
+        self._stage_stack.append(func.__name__)
+        self._stage_tasks[func.__name__] = {'tasks_total': 0, 'tasks_run': 0, 'tasks_failed': 0}
+        settings = self.gdal_settings(func.__name__)
+        previous_settings = apply_gdal_config(settings)
+        start_time = datetime.now()
+        start_wall = time.perf_counter()
+        start_usage = usage_counters()
+        start_read, start_write = io_counters()
+        error = None
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            end_usage = usage_counters()
+            end_read, end_write = io_counters()
+            self._stage_stack.pop()
+            apply_gdal_config(previous_settings)
+
+            def delta(key):
+                if start_usage[key] is None or end_usage[key] is None:
+                    return None
+                return end_usage[key] - start_usage[key]
+
+            record = {
+                'run_id': self.run_id, 'stage': func.__name__, 'parent': parent, 'host': socket.gethostname(),
+                'pid': os.getpid(), 'start': start_time.isoformat(), 'end': datetime.now().isoformat(),
+                'wall_s': time.perf_counter() - start_wall, 'cpu_s': delta('cpu'),
+                'cpu_children_s': delta('cpu_children'),
+                'read_bytes': None if start_read is None else end_read - start_read,
+                'write_bytes': None if start_write is None else end_write - start_write,
+                'read_bytes_children': None if delta('inblock_children') is None else delta('inblock_children') * 512,
+                'write_bytes_children': None if delta('oublock_children') is None else delta('oublock_children') * 512,
+                'peak_rss_mb': end_usage['maxrss_mb'], 'peak_rss_children_mb': end_usage['maxrss_children_mb'],
+                'gdal_cache_used_mb': gdal.GetCacheUsed() / 1024 ** 2,
+                'gdal_cache_max_mb': settings['GDAL_CACHEMAX'], 'gdal_settings': settings,
+                'error': error}
+            record.update(self._stage_tasks.pop(func.__name__))
+            self.write_run_log(record)
+
+    return wrapper
+
+
+class Manifest:
+    '''
+    Record of the inputs (size and modification time) and settings each output was built from, so that only outputs
+    whose inputs or settings changed are rebuilt
+    :param path: string, file path of the manifest (json)
+    '''
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.records = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.records = json.load(f)
+        self.n_unsaved = 0
+
+    @staticmethod
+    def file_signature(path):
+        '''
+        :param path: string, file path
+        :return: list, [size, modification time]
+        '''
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    @staticmethod
+    def as_json(params):
+        '''
+        Settings in the form they are stored, e.g., tuples become lists
+        '''
+        return json.loads(json.dumps(params, default=str))
+
+    def is_up_to_date(self, output_path, input_paths, params, adopt=False, validate=None):
+        '''
+        Check whether an output was built from the current inputs with the same settings
+        :param output_path: string, file path of the output
+        :param input_paths: list, file path of the inputs
+        :param params: dictionary, settings used to build the output
+        :param adopt: boolean, True means an existing output without record is accepted and recorded if it is newer
+                    than all its inputs, e.g., outputs created before the manifest was introduced
+        :param validate: function, integrity check of an output before it is adopted, e.g., Utilities.validate_geotiff
+        :return: boolean
+        '''
+
+        output_path = str(output_path)
+        if not os.path.exists(output_path):
+            return False
+        if not all(os.path.exists(input_path) for input_path in input_paths):
+            return False
+        record = self.records.get(output_path)
+        if record is None:
+            if adopt and all(os.path.getmtime(input_path) <= os.path.getmtime(output_path)
+                             for input_path in input_paths) and (validate is None or validate(output_path)):
+                self.record(output_path, input_paths, params)
+                return True
+            return False
+        if record['params'] != self.as_json(params):
+            return False
+        return record['inputs'] == {str(input_path): self.file_signature(input_path) for input_path in input_paths}
+
+    def record(self, output_path, input_paths, params, stage=None):
+        '''
+        Record the inputs and settings of an output, the manifest is saved every 100 records and by save()
+        :param output_path: string, file path of the output
+        :param input_paths: list, file path of the inputs
+        :param params: dictionary, settings used to build the output
+        :param stage: string, name of the processing stage
+        :return:
+        '''
+
+        self.records[str(output_path)] = {
+            'stage': stage,
+            'inputs': {str(input_path): self.file_signature(input_path) for input_path in input_paths},
+            'params': self.as_json(params),
+            'time': datetime.now().strftime("%Y%m%d-%H%M%S")}
+        self.n_unsaved += 1
+        if self.n_unsaved >= 100:
+            self.save()
+
+    def save(self):
+        '''
+        Write the manifest to a temporary file and replace the previous one
+        :return:
+        '''
+
+        if not os.path.exists(str(Path(self.path).parent)):
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.records, f)
+        os.replace(temp_path, self.path)
+        self.n_unsaved = 0
+
 
 class Utilities:
     '''
@@ -109,10 +447,11 @@ class Utilities:
     # Set directories
     default_work_dir = '/mnt/raid5/Planet/pre_processed/Sierra_Nevada_AOI1'
     default_output_dirs = {'raw': 'raw', 'clipped raw': 'clipped_raw', 'merge': 'merge', 'clip': 'clip',
-                           'clear prob': 'clear_prob', 'NDVI': 'NDVI', 'clip clear perc': 'bomas'}
-    # API Key
+                           'clear prob': 'clear_prob', 'NDVI': 'NDVI', 'clip clear perc': 'bomas',
+                           'composite': 'composite'}
+    # API Key, read from default_api_file on first use if None
     default_api_file = str(Path(os.getcwd()) / 'api_key.txt')
-    default_api_key = open(default_api_file, 'r').readlines()[0]
+    default_api_key = None
 
     # Specs
     default_satellite = 'PS'
@@ -125,6 +464,11 @@ class Utilities:
     default_start_date = '2019-01-01'
     default_end_date = '2020-01-01'
     default_cloud_cover = 1
+    # Coverage filter of the search results, see coverage_filter(), None disables a criterion
+    default_min_aoi_coverage = None  # fraction of the AOI covered by the footprint
+    default_min_usable_area = None  # km2 of the AOI covered by the footprint and not cloudy
+    default_tile_min_pixels = None  # e.g., 10000 * 10000, None means every image is processed as a whole
+    default_virtual_intermediates = False  # True means setnull and merge outputs are VRTs, see setnull_path()
     default_aoi_shp = '/mnt/raid5/California_timeseries/aois/sn_aoi1.shp'
     default_all_scenes = '/mnt/raid5/California_timeseries/Sierra_Nevada/aoi1/sn_aoi1_20190101_20200101_1000_0000.gpkg'
     # Color composition for visualization
@@ -132,6 +476,40 @@ class Utilities:
     default_dpi = 90
     default_percentile = [2, 98]
     default_remove_latest = True
+    default_rebuild_unrecorded = False
+    # Parallel processing
+    default_n_workers = os.cpu_count()
+    # Task functions with their own process pool, run_tasks() runs them one after the other
+    pool_funcs = ['gdal_composite', 'gdal_gap_fill']
+    # Age of the leftover temporary files removed by validate_outputs() where processes cannot be checked (Windows)
+    temp_max_age_s = 24 * 3600
+    # GDAL performance settings, see gdal_settings()
+    default_gdal_config = {'cache_mb': None, 'n_threads': None, 'vsi_cache_mb': 256, 'warp_memory_mb': 1024,
+                           'warp_multithread': True, 'share': 1., 'stages': {}}
+    # Compression of the outputs per asset type (codec, level, predictor, tiling), see creation_options(), and of the
+    # netCDF stacks (codec 'zlib', or e.g. 'zstd' with netCDF4 >= 1.6), see netcdf_compression()
+    default_compression_profiles = {
+        'analytic_sr': {'codec': 'ZSTD', 'level': 1, 'predictor': 2, 'tiled': True, 'block_size': 512},
+        'udm2': {'codec': 'ZSTD', 'level': 1, 'predictor': 2, 'tiled': True, 'block_size': 512},
+        'NDVI': {'codec': 'ZSTD', 'level': 1, 'predictor': 2, 'tiled': True, 'block_size': 512},
+        'clear prob': {'codec': 'ZSTD', 'level': 1, 'predictor': 2, 'tiled': True, 'block_size': 512},
+        'default': {'codec': 'ZSTD', 'level': 1, 'predictor': 2, 'tiled': True, 'block_size': 512},
+        'netcdf': {'codec': 'zlib', 'level': 4, 'shuffle': True}}
+    # udm2 bands 1 - 6, see udm2_statistics()
+    udm2_classes = ['clear', 'snow', 'shadow', 'light_haze', 'heavy_haze', 'cloud']
+    # JPEG2000 export of the stacks (JP2OpenJPEG), lossy at the given quality or reversible (lossless), tiles of
+    # block_size and code blocks of codeblock pixels, see jp2_creation_options()
+    default_jp2_profiles = {
+        'analytic_sr': {'quality': 80, 'reversible': False, 'block_size': 1024, 'codeblock': 64, 'resolutions': None},
+        'udm2': {'quality': 100, 'reversible': True, 'block_size': 1024, 'codeblock': 64, 'resolutions': None},
+        'default': {'quality': 80, 'reversible': False, 'block_size': 1024, 'codeblock': 64, 'resolutions': None}}
+    # Outputs kept in shared_dir, i.e., independent of the AOI, and the stages producing them
+    shared_outputs = ['raw', 'clipped raw', 'clipped_raw', 'merge']
+    shared_stages = ['download', 'setnull', 'merge']
+    # Processing stages and the stages they depend on, in order of execution
+    default_stage_dependencies = {'download': [], 'setnull': ['download'], 'merge': ['setnull'], 'clip': ['merge'],
+                                  'clear prob': ['clip'], 'NDVI': ['clip'], 'stack': ['clip'], 'composite': ['clip'],
+                                  'gap fill': ['clip']}
 
     def __init__(self, gdal_osgeo_dir=default_gdal_osgeo_dir, work_dir=default_work_dir,
                  output_dirs=default_output_dirs, satellite=default_satellite, proj_code=default_proj_code,
@@ -139,7 +517,12 @@ class Utilities:
                  process_level=default_process_level, asset_types=default_asset_types, start_date=default_start_date,
                  end_date=default_end_date, cloud_cover=default_cloud_cover, aoi_shp=default_aoi_shp,
                  rgb_composition=default_rgb_composition, dpi=default_dpi, percentile=default_percentile,
-                 remove_latest=default_remove_latest, all_scenes=default_all_scenes):
+                 remove_latest=default_remove_latest, all_scenes=default_all_scenes, n_workers=default_n_workers,
+                 manifest_path=None, run_log_path=None, shared_dir=None, gdal_config=None, queue_dir=None,
+                 queue_workers=None, queue_lease_s=300, queue_max_attempts=3, compression_profiles=None,
+                 jp2_profiles=None, min_aoi_coverage=default_min_aoi_coverage, min_usable_area=default_min_usable_area,
+                 tile_min_pixels=default_tile_min_pixels, virtual_intermediates=default_virtual_intermediates,
+                 rebuild_unrecorded=default_rebuild_unrecorded):
         '''
 
         :param gdal_osgeo_dir: string
@@ -147,7 +530,7 @@ class Utilities:
         :param output_dirs: dictionary, the name of folder for storing different outputs
         :param satellite: string, abbreviation of satellite name, PS - PLanetScope, S2 - Sentinel-2
         :param proj_code: int, the EPSG code of projection systtem
-        :param api_key: string
+        :param api_key: string, read from default_api_file when first needed if None
         :param filter_items: list, a list of filter item names
         :param item_types: list, a list of item type, more info: https://developers.planet.com/docs/data/items-assets/
         :param process_level: string, processing level
@@ -160,8 +543,51 @@ class Utilities:
                                 PlanetScope images
         :param dpi: int, dpi of saved plot
         :param percentile: list, minimum and maximum percentile
-        :param remove_latest: boolean, true means remove the latest file in the folder because the process was killed
-                            manually and the latest file is not complete. If false, the latest file will not be removed.
+        :param remove_latest: boolean, true means existing outputs without a record in the manifest (e.g., of runs
+                            before the manifest) are checked with validate_output() before they are accepted, so that
+                            the file being written when a previous run was killed is rebuilt. If false, they are
+                            accepted unchecked. Either way they must be newer than their inputs, see adopt_settings().
+        :param n_workers: int, the number of worker processes used by the parallel stages
+        :param manifest_path: string, file path of the manifest recording the inputs and settings of each output,
+                            [work_dir]/manifest.json if None
+        :param run_log_path: string, file path of the run log (json lines) with the performance record of each stage,
+                            [work_dir]/run_log.jsonl if None
+        :param shared_dir: string, the directory of downloaded and merged images (see shared_outputs), which can be
+                        shared by the work directories of several AOIs, work_dir if None
+        :param gdal_config: dictionary, GDAL performance settings updating default_gdal_config:
+                            'cache_mb' - block cache (GDAL_CACHEMAX) of the whole stage, 25% of the memory if None,
+                            'n_threads' - threads (GDAL_NUM_THREADS) of the whole stage, all CPUs if None,
+                            'vsi_cache_mb' - read cache per file (VSI_CACHE_SIZE), 0 disables it,
+                            'warp_memory_mb' and 'warp_multithread' - working buffer and threading of gdal.Warp,
+                            'share' - fraction of the memory and CPUs of the machine used by this instance,
+                            'stages' - settings of individual stages, e.g., {'clip': {'warp_memory_mb': 4096}}
+                            The cache and threads are divided between the workers of the parallel stages.
+        :param queue_dir: string, folder of a work queue on a filesystem shared with other hosts. If given, the tasks of
+                        the per scene/date stages (setnull, merge, clip, band algebra) are run by the workers of the
+                        queue, see work_queue.py
+        :param queue_workers: int, the number of queue workers started on this host, n_workers if None
+        :param queue_lease_s: float, seconds after which the lease of a queued task that was not renewed expires (e.g.,
+                              its worker host died) and the task is retried, workers on other hosts take it from
+                              python work_queue.py worker QUEUE_DIR --lease
+        :param queue_max_attempts: int, the number of times a queued task is tried before it is given up, see --attempts
+        :param compression_profiles: dictionary, compression profiles updating default_compression_profiles, e.g.,
+                                    {'udm2': {'codec': 'DEFLATE', 'level': 6}}. Codecs: 'ZSTD', 'DEFLATE', 'LZW',
+                                    'NONE', unsupported codecs fall back to DEFLATE
+        :param jp2_profiles: dictionary, JPEG2000 profiles updating default_jp2_profiles, e.g.,
+                             {'analytic_sr': {'reversible': True}}
+        :param min_aoi_coverage: float, minimum fraction (0 - 1) of the AOI covered by the footprint of a scene, scenes
+                                 below are dropped from the search results before downloading
+        :param min_usable_area: float, minimum area (km2) of the AOI covered by the footprint of a scene and not cloudy
+                                according to its clear_percent or cloud_cover, scenes below are dropped
+        :param tile_min_pixels: int, images with at least that many pixels are set to null and turned into NDVI/clear
+                                prob tile by tile in a process pool instead of by one gdal_calc.py, see
+                                gdal_calc_tiled()
+        :param virtual_intermediates: boolean, True means the setnull and merge outputs are VRTs computed when they are
+                                      read (by clip), and prep_pipline() only writes the final stacks, see
+                                      gdal_udm2_setnull_vrt(), gdal_mosaic_vrt() and stack_vrt(). GDAL is allowed to
+                                      run pixel_functions.py while the stages run, see vrt_python_settings()
+        :param rebuild_unrecorded: boolean, True means existing outputs without a record in the manifest are never
+                                   accepted, they are downloaded or rebuilt
         '''
 
         # self.gdal_osgeo_dir = gdal_osgeo_dir
@@ -178,11 +604,12 @@ class Utilities:
         self.gdal_vrtmerge_path = str(Path(
             '/home/yan/anaconda3/envs/PlanetScopePy_gdal333/lib/python3.7/site-packages/osgeo_utils/samples/gdal_vrtmerge.py'))
         self.work_dir = work_dir
+        self.shared_dir = work_dir if shared_dir is None else shared_dir
         self.output_dirs = output_dirs
         self.satellite = satellite
         self.proj_code = proj_code
-        self.api_key = api_key
-        self.client = api.ClientV1(api_key=api_key)
+        self._api_key = api_key
+        self._client = None  # Planet API client, created on first use, see client
         self.filter_items = filter_items
         self.item_types = item_types
         self.process_level = process_level
@@ -192,31 +619,66 @@ class Utilities:
         self.end_date = datetime(year=int(end_date.split('-')[0]), month=int(end_date.split('-')[1]),
                                  day=int(end_date.split('-')[2]))
         self.cloud_cover = cloud_cover
+        self.min_aoi_coverage = min_aoi_coverage
+        self.min_usable_area = min_usable_area
+        self.tile_min_pixels = tile_min_pixels
+        self.virtual_intermediates = virtual_intermediates
         self.aoi_shp = aoi_shp
         self.rgb_composition = rgb_composition
         self.dpi = dpi
         self.percentile = percentile
         self.remove_latest = remove_latest
+        self.rebuild_unrecorded = rebuild_unrecorded
         self.records_path = None  # File path of execution track document
         self.id_list_download = None  # a list of item id which will be downloaded
 
         self.all_scenes = all_scenes
+        self.n_workers = n_workers
+        self.gdal_config = {} if gdal_config is None else gdal_config
+        self.queue_dir = queue_dir
+        self.compression_profiles = dict([(key, dict(value)) for key, value in
+                                          self.default_compression_profiles.items()])
+        for key, value in (compression_profiles or {}).items():
+            self.compression_profiles.setdefault(key, {}).update(value)
+        self.jp2_profiles = dict([(key, dict(value)) for key, value in self.default_jp2_profiles.items()])
+        for key, value in (jp2_profiles or {}).items():
+            self.jp2_profiles.setdefault(key, {}).update(value)
+        self.queue_workers = n_workers if queue_workers is None else queue_workers
+        self.queue_lease_s = queue_lease_s
+        self.queue_max_attempts = queue_max_attempts
+        self.manifest_path = str(Path(work_dir) / 'manifest.json') if manifest_path is None else manifest_path
+        self._manifest = None
+        self.run_log_path = str(Path(work_dir) / 'run_log.jsonl') if run_log_path is None else run_log_path
+        self.run_id = '{}-{}-{}'.format(datetime.now().strftime("%Y%m%d-%H%M%S"), socket.gethostname(), os.getpid())
+        self._stage_stack = []  # names of the running stages, see track_stage()
+        self._stage_tasks = {}  # task counts of the running stages
 
     def shp_to_json(self):
         '''
         Convert AOI shapefile to json format that is required for retrieve imagery for specific location
-        using Planet API
+        using Planet API. If aoi_shp is a list of shapefiles, the union of the AOIs is used, so that scenes covering
+        several AOIs are searched once.
         :return: aoi_geom, dictionary
         '''
 
-        shp = gpd.read_file(self.aoi_shp)
-        if shp.crs != {'init': 'epsg:{}'.format(str(self.proj_code))}:
-            shp = shp.to_crs({'init': 'epsg:{}'.format(str(self.proj_code))})
+        import geopandas as gpd
+        from shapely.ops import unary_union
+
+        shp_list = []
+        for aoi_shp in (self.aoi_shp if isinstance(self.aoi_shp, (list, tuple)) else [self.aoi_shp]):
+            shp = gpd.read_file(aoi_shp)
+            if shp.crs != {'init': 'epsg:{}'.format(str(self.proj_code))}:
+                shp = shp.to_crs({'init': 'epsg:{}'.format(str(self.proj_code))})
+            else:
+                shp = shp.to_crs({'init': 'epsg:4326'})
+            shp_list.append(shp)
+        if len(shp_list) == 1:
+            coors = np.array(dict(json.loads(shp_list[0]['geometry'].to_json()))
+                             ['features'][0]['geometry']['coordinates'])[:, :, 0:2].tolist()
+            aoi_geom = {"type": "Polygon", "coordinates": coors}
         else:
-            shp = shp.to_crs({'init': 'epsg:4326'})
-        coors = np.array(dict(json.loads(shp['geometry'].to_json()))
-                         ['features'][0]['geometry']['coordinates'])[:, :, 0:2].tolist()
-        aoi_geom = {"type": "Polygon", "coordinates": coors}
+            union = unary_union([geom for shp in shp_list for geom in shp['geometry']])
+            aoi_geom = json.loads(gpd.GeoSeries([union]).to_json())['features'][0]['geometry']
         # print(self.aoi_geom)
         return aoi_geom
 
@@ -263,6 +725,159 @@ class Utilities:
         if not os.path.exists(f):
             os.mkdir(f)
 
+    @staticmethod
+    def temp_path(output_path, tag='tmp'):
+        '''
+        Temporary file path in the same directory as the output, hidden from the glob patterns of the stages
+        :param output_path: string, file path of the output
+        :param tag: string, distinguishes several temporary files of the same output
+        :return: string
+        '''
+        output_path = Path(output_path)
+        return str(output_path.parent / '.{}.{}-{}-{}{}'.format(output_path.stem, tag, socket.gethostname(),
+                                                               os.getpid(), output_path.suffix))
+
+    @staticmethod
+    def output_signature(output_path):
+        '''
+        Size and modification time of an output, compared before and after a task to tell whether it was (re)built
+        :param output_path: string, file path
+        :return: list, see Manifest.file_signature(), None if the output does not exist
+        '''
+        if output_path is None or not os.path.exists(str(output_path)):
+            return None
+        return Manifest.file_signature(str(output_path))
+
+    @staticmethod
+    @contextmanager
+    def atomic_output(output_path):
+        '''
+        Write an output under a temporary name in the same directory and rename it when it is complete, so that a killed
+        run never leaves a truncated output behind. In-memory (/vsimem) outputs are written directly.
+        :param output_path: string, file path of the output
+        :return: string, the temporary file path to write to
+        '''
+
+        if str(output_path).startswith('/vsi'):
+            yield str(output_path)
+            return
+        temp_path = Utilities.temp_path(output_path)
+        try:
+            yield temp_path
+            if os.path.exists(temp_path):
+                os.replace(temp_path, str(output_path))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def run_command(command):
+        '''
+        Run a command line, e.g., gdal_calc.py or gdal_merge.py
+        :param command: string
+        :return:
+        '''
+        return_code = os.system(command)
+        if return_code != 0:
+            raise RuntimeError('Command failed with exit code {}: {}'.format(return_code, command))
+
+    @staticmethod
+    def validate_geotiff(path):
+        '''
+        Fast integrity check of a GeoTIFF without decoding it: the TIFF header, the offsets and sizes of all blocks of
+        the first and last band against the file size, and a read of the last block
+        :param path: string, file path
+        :return: boolean, True if the file looks complete
+        '''
+
+        gdal.PushErrorHandler('CPLQuietErrorHandler')
+        try:
+            file_size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                header = f.read(4)
+            if header not in [b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+']:
+                return False
+            raster = gdal.Open(path, gdal.GA_ReadOnly)
+            if raster is None or raster.RasterCount == 0:
+                return False
+            for band_idx in sorted(set([1, raster.RasterCount])):
+                band = raster.GetRasterBand(band_idx)
+                block_x, block_y = band.GetBlockSize()
+                n_block_x = (raster.RasterXSize + block_x - 1) // block_x
+                n_block_y = (raster.RasterYSize + block_y - 1) // block_y
+                for block_idx in range(n_block_x * n_block_y):
+                    block_row, block_col = divmod(block_idx, n_block_x)
+                    offset = band.GetMetadataItem('BLOCK_OFFSET_{}_{}'.format(block_col, block_row), 'TIFF')
+                    byte_count = band.GetMetadataItem('BLOCK_SIZE_{}_{}'.format(block_col, block_row), 'TIFF')
+                    if offset is None or byte_count is None:
+                        # Block layout not exposed, e.g., not a GeoTIFF, none of the other blocks is checked
+                        break
+                    if int(offset) == 0 or int(offset) + int(byte_count) > file_size:
+                        return False
+                # Decode the last block only
+                x0, y0 = (n_block_x - 1) * block_x, (n_block_y - 1) * block_y
+                if band.ReadRaster(x0, y0, raster.RasterXSize - x0, raster.RasterYSize - y0) is None:
+                    return False
+            raster = None
+            return True
+        except Exception:
+            return False
+        finally:
+            gdal.PopErrorHandler()
+
+    @staticmethod
+    def validate_output(path):
+        '''
+        validate_geotiff() of an output, the VRTs of virtual_intermediates are not GeoTIFFs and are not checked
+        :param path: string, file path
+        :return: boolean
+        '''
+        return str(path).lower().endswith('.vrt') or Utilities.validate_geotiff(path)
+
+    def validate_outputs(self, file_list, remove=True):
+        '''
+        Check existing outputs with validate_output() in parallel and queue the broken ones for rebuild, i.e., remove
+        them and their records in the manifest. Leftover temporary files of killed runs on this host are removed too,
+        on Windows only those older than temp_max_age_s.
+        :param file_list: list, file path of the outputs
+        :param remove: boolean, True means the broken outputs are removed
+        :return: list, file path of the broken outputs
+        '''
+
+        file_list = [file for file in file_list if os.path.exists(file)]
+        with self.worker_pool() as pool:
+            valid_list = list(tqdm(pool.imap(self.validate_output, file_list, chunksize=16), total=len(file_list),
+                                   unit="item", desc='Validating outputs'))
+        broken_list = [file for file, valid in zip(file_list, valid_list) if not valid]
+        if remove is True:
+            for file in broken_list:
+                os.remove(file)
+                self.manifest.records.pop(str(file), None)
+            self.manifest.save()
+
+            # Temporary files of processes on this host that no longer exist
+            host = socket.gethostname()
+            for directory in set([str(Path(file).parent) for file in file_list]):
+                for temp_file in glob(os.path.join(directory, '.*-{}-*'.format(host))):
+                    pid = Path(temp_file).stem.split('-')[-1]
+                    if not pid.isdigit():
+                        continue
+                    if os.name == 'nt':
+                        # os.kill(pid, 0) sends CTRL_C_EVENT on Windows instead of checking the process
+                        try:
+                            if time.time() - os.path.getmtime(temp_file) > self.temp_max_age_s:
+                                os.remove(temp_file)
+                        except OSError:
+                            pass
+                        continue
+                    try:
+                        os.kill(int(pid), 0)
+                    except ProcessLookupError:
+                        os.remove(temp_file)
+                    except OSError:
+                        pass
+        return broken_list
+
     def setup_dirs(self):
         '''
         Create all required folders for saving different outputs
@@ -272,7 +887,160 @@ class Utilities:
         print('The outputs will be saved in this directory: ' + self.work_dir)
 
         for i in self.output_dirs.keys():
-            self.create_dir(Path(self.work_dir) / '{}'.format(self.output_dirs[i]))
+            self.create_dir(self.stage_dir(i))
+
+    def gdal_settings(self, stage=None, n_workers=1):
+        '''
+        Effective GDAL settings of a stage, the cache and threads are divided between n_workers processes
+        :param stage: string, name of the stage (method), e.g., 'clip', see gdal_config
+        :param n_workers: int, the number of processes running GDAL at the same time
+        :return: dictionary, GDAL configuration options (upper case) and gdal.Warp settings (lower case)
+        '''
+        config = dict(self.default_gdal_config)
+        config.update(self.gdal_config)
+        config.update(config['stages'].get(stage, {}))
+        n_workers = max(1, int(n_workers))
+        cache_mb = config['cache_mb'] if config['cache_mb'] is not None \
+            else physical_memory_mb() * config['share'] / 4
+        n_threads = config['n_threads'] if config['n_threads'] is not None \
+            else (os.cpu_count() or 1) * config['share']
+        settings = {'GDAL_CACHEMAX': max(16, int(cache_mb / n_workers)),
+                    'GDAL_NUM_THREADS': max(1, int(n_threads / n_workers)),
+                    'VSI_CACHE': 'TRUE' if config['vsi_cache_mb'] else 'FALSE',
+                    'VSI_CACHE_SIZE': int(config['vsi_cache_mb'] * 1024 ** 2) if config['vsi_cache_mb'] else None,
+                    'warp_memory_mb': max(16, int(config['warp_memory_mb'] / n_workers)),
+                    'warp_multithread': config['warp_multithread'] is True and n_threads / n_workers >= 2}
+        if self.virtual_intermediates is True:
+            # the pixel functions of the setnull VRTs, in this process, the workers and gdal_calc.py/gdal_merge.py
+            settings.update(vrt_python_settings())
+        return settings
+
+    def worker_copy(self):
+        '''
+        Copy of the settings sent to the worker processes of run_tasks() and of the streaming mode, without the
+        manifest and the Planet client, which only the coordinator uses
+        :return: Utilities
+        '''
+        worker_ut = copy.copy(self)
+        worker_ut._client = None
+        worker_ut._manifest = None
+        worker_ut._stage_stack = []
+        worker_ut._stage_tasks = {}
+        return worker_ut
+
+    def worker_pool(self):
+        '''
+        Process pool of n_workers, each worker gets its share of the GDAL settings of the running stage
+        :return: multiprocessing.Pool
+        '''
+        stage = self._stage_stack[-1] if self._stage_stack else None
+        return Pool(self.n_workers, initializer=apply_gdal_config,
+                    initargs=(self.gdal_settings(stage, self.n_workers),))
+
+    def warp_kwargs(self):
+        '''
+        Keyword arguments of gdal.Warp() from the GDAL settings of the running stage
+        :return: dictionary
+        '''
+        settings = self.gdal_settings(self._stage_stack[-1] if self._stage_stack else None)
+        return {'multithread': settings['warp_multithread'], 'warpMemoryLimit': settings['warp_memory_mb']}
+
+    def compression_profile(self, output_path=None, profile=None):
+        '''
+        Compression profile of an output, found from its file name if profile is None
+        :param output_path: string, file path of the output
+        :param profile: string, key of compression_profiles, e.g., 'udm2'
+        :return: dictionary
+        '''
+        if profile is None:
+            name = Path(str(output_path)).name
+            if name.endswith('_ndvi.tif'):
+                profile = 'NDVI'
+            elif name.endswith('_clearprob.tif'):
+                profile = 'clear prob'
+            elif self.asset_attrs('udm2')['suffix'] in name:
+                profile = 'udm2'
+            elif self.asset_attrs('analytic_sr')['suffix'] in name:
+                profile = 'analytic_sr'
+            else:
+                profile = 'default'
+        return dict(self.compression_profiles['default'], **self.compression_profiles.get(profile, {}))
+
+    def creation_options(self, output_path=None, compression=None, profile=None):
+        '''
+        GeoTIFF creation options of an output from its compression profile
+        :param output_path: string, file path of the output
+        :param compression: string, codec overriding the profile, e.g., 'LZW' or 'NONE'
+        :param profile: string, key of compression_profiles, found from the file name if None
+        :return: list, e.g., ['COMPRESS=ZSTD', 'ZSTD_LEVEL=1', 'PREDICTOR=2', 'TILED=YES', ...]
+        '''
+        config = self.compression_profile(output_path, profile)
+        codec = str(compression or config['codec']).upper()
+        if not tiff_codec_available(codec):
+            codec = 'DEFLATE'
+        option_list = ['COMPRESS={}'.format(codec)]
+        level_option = {'ZSTD': 'ZSTD_LEVEL', 'DEFLATE': 'ZLEVEL', 'LZMA': 'LZMA_PRESET'}.get(codec)
+        if level_option is not None and config.get('level') is not None:
+            option_list.append('{}={}'.format(level_option, config['level']))
+        if codec in ['ZSTD', 'DEFLATE', 'LZW', 'LZMA'] and config.get('predictor'):
+            option_list.append('PREDICTOR={}'.format(config['predictor']))
+        if config.get('tiled'):
+            block_size = config.get('block_size', 256)
+            option_list.extend(['TILED=YES', 'BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size)])
+        option_list.append('BIGTIFF=IF_SAFER')
+        return option_list
+
+    @staticmethod
+    def creation_option_args(option_list, flag='-co'):
+        '''
+        Creation options as command line arguments, e.g., of gdal_merge.py (-co) or gdal_calc.py (--co)
+        '''
+        return ' '.join(['{} "{}"'.format(flag, option) for option in option_list])
+
+    def jp2_creation_options(self, profile='default', n_threads=None):
+        '''
+        JP2OpenJPEG creation options of a JPEG2000 profile
+        :param profile: string, key of jp2_profiles, e.g., 'udm2'
+        :param n_threads: int, the number of encoding threads, only passed (NUM_THREADS) when the JP2OpenJPEG driver
+                          of this GDAL build has that creation option, otherwise each image is encoded on one thread
+        :return: list, e.g., ['QUALITY=100', 'REVERSIBLE=YES', 'BLOCKXSIZE=1024', ...]
+        '''
+        config = dict(self.jp2_profiles['default'], **self.jp2_profiles.get(profile, {}))
+        if config.get('reversible'):
+            option_list = ['QUALITY=100', 'REVERSIBLE=YES']
+        else:
+            option_list = ['QUALITY={}'.format(config['quality'])]
+        block_size, codeblock = config.get('block_size', 1024), config.get('codeblock', 64)
+        option_list.extend(['BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size),
+                            'CODEBLOCK_WIDTH={}'.format(codeblock), 'CODEBLOCK_HEIGHT={}'.format(codeblock)])
+        if config.get('resolutions') is not None:
+            option_list.append('RESOLUTIONS={}'.format(config['resolutions']))
+        if n_threads is not None and jp2_creation_option_available('NUM_THREADS'):
+            option_list.append('NUM_THREADS={}'.format(n_threads))
+        return option_list
+
+    def netcdf_compression(self):
+        '''
+        Keyword arguments of netCDF4.Dataset.createVariable() from the 'netcdf' compression profile
+        :return: dictionary
+        '''
+        config = self.compression_profiles['netcdf']
+        kwargs = {'complevel': config.get('level', 4), 'shuffle': config.get('shuffle', True)}
+        if config.get('codec') in ['zlib', None, 'NONE']:
+            kwargs['zlib'] = config.get('codec') == 'zlib'
+        else:
+            # e.g., 'zstd', needs netCDF4 >= 1.6 and netCDF-C >= 4.9
+            kwargs['compression'] = config['codec']
+        return kwargs
+
+    def stage_dir(self, output_type):
+        '''
+        Folder of an output type, downloaded and merged images are kept in shared_dir, the others in work_dir
+        :param output_type: string, key of output_dirs, e.g., 'raw', 'merge' or 'clip'
+        :return: Path
+        '''
+        base_dir = self.shared_dir if output_type in self.shared_outputs else self.work_dir
+        return Path(base_dir) / self.output_dirs[output_type]
 
     def create_track_file(self):
         '''
@@ -300,12 +1068,204 @@ class Utilities:
         # self.create_track_file()
         self.setup_dirs()
 
+    @property
+    def api_key(self):
+        '''
+        Planet API key, read from default_api_file on first use if not given
+        :return: string
+        '''
+        if self._api_key is None:
+            with open(self.default_api_file, 'r') as f:
+                self._api_key = f.readlines()[0].strip()
+        return self._api_key
+
+    @api_key.setter
+    def api_key(self, api_key):
+        self._api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        '''
+        Planet API client, created on first use so that offline stages neither import planet nor need an API key
+        :return: planet.api.ClientV1
+        '''
+        if self._client is None:
+            from planet import api
+            self._client = api.ClientV1(api_key=self.api_key)
+        return self._client
+
+    @property
+    def manifest(self):
+        '''
+        Manifest of the outputs in the work directory, loaded on first use
+        :return: Manifest
+        '''
+        if self._manifest is None:
+            self._manifest = Manifest(self.manifest_path)
+        return self._manifest
+
+    def run_task(self, task):
+        '''
+        Build the output of a task and record it in the manifest
+        :param task: Task
+        :return: boolean, True if the output was built
+        '''
+
+        # Outdated outputs are kept until atomic_output() replaces them, a failed rebuild leaves them unchanged and is
+        # told apart by the signature of the output
+        signature = self.output_signature(task.output_path)
+        try:
+            getattr(self, task.func)(**task.kwargs)
+        except Exception as e:
+            print('Failed to build {}: {}'.format(task.output_path, e))
+            return False
+        if self.output_signature(task.output_path) in [None, signature]:
+            return False
+        self.manifest.record(task.output_path, task.input_paths, task.params, task.stage)
+        return True
+
+    def adopt_settings(self):
+        '''
+        How existing outputs without a record in the manifest are handled: accepted if they are newer than their
+        inputs and, with remove_latest, pass validate_output(), unless rebuild_unrecorded is True
+        :return: dictionary, keyword arguments adopt and validate of Manifest.is_up_to_date()
+        '''
+        return {'adopt': self.rebuild_unrecorded is not True,
+                'validate': self.validate_output if self.remove_latest is True else None}
+
+    def run_tasks(self, task_list, desc):
+        '''
+        Build the outputs of the tasks whose inputs or settings changed since they were built
+        :param task_list: list, a list of Task
+        :param desc: string, description of the progress bar
+        :return: list, tasks that were (re)built
+        '''
+
+        n_total = len(task_list)
+        task_list = [task for task in task_list if not self.manifest.is_up_to_date(
+            task.output_path, task.input_paths, task.params, **self.adopt_settings())]
+        n_failed = 0
+        if self.queue_dir is not None and task_list:
+            # run by the workers of the queue, the outputs of done tasks are recorded here
+            from work_queue import WorkQueue
+            queue = WorkQueue(self.queue_dir, lease_s=self.queue_lease_s, max_attempts=self.queue_max_attempts)
+            done_list, failed_list = queue.run(self, task_list, desc, self.queue_workers)
+            for task in done_list:
+                task = Task(*task)
+                if task.output_path is not None and os.path.exists(str(task.output_path)):
+                    self.manifest.record(task.output_path, task.input_paths, task.params, task.stage)
+            n_failed = len(failed_list)
+        else:
+            # tasks whose function has its own process pool run one after the other, the others are spread over
+            # n_workers processes and only this process records their outputs in the manifest
+            serial_list = [task for task in task_list if task.func in self.pool_funcs or self.n_workers <= 1 or
+                           current_process().daemon]
+            pool_list = [task for task in task_list if task not in serial_list]
+            progress = tqdm(total=len(task_list), unit="item", desc=desc)
+            for task in serial_list:
+                n_failed += self.run_task(task) is False
+                progress.update(1)
+            if pool_list:
+                from stream_pipeline import init_worker, run_task
+                stage = self._stage_stack[-1] if self._stage_stack else None
+                with Pool(self.n_workers, initializer=init_worker,
+                          initargs=(self.worker_copy(), self.gdal_settings(stage, self.n_workers))) as pool:
+                    for task, built, error in pool.imap_unordered(run_task, [list(task) for task in pool_list]):
+                        task = Task(*task)
+                        if built is True:
+                            self.manifest.record(task.output_path, task.input_paths, task.params, task.stage)
+                        else:
+                            n_failed += 1
+                            print('Failed to build {}: {}'.format(task.output_path, (error or 'no output').strip()
+                                                                  .splitlines()[-1]))
+                        progress.update(1)
+            progress.close()
+        self.manifest.save()
+        self.count_tasks(n_total, len(task_list), n_failed)
+        return task_list
+
+    def count_tasks(self, n_total, n_run, n_failed=0):
+        '''
+        Add task counts to the performance record of the running stage
+        :param n_total: int, the number of tasks
+        :param n_run: int, the number of tasks that were (re)built
+        :param n_failed: int, the number of tasks that failed
+        :return:
+        '''
+        if self._stage_stack:
+            counts = self._stage_tasks[self._stage_stack[-1]]
+            counts['tasks_total'] += n_total
+            counts['tasks_run'] += n_run
+            counts['tasks_failed'] += n_failed
+
+    def write_run_log(self, record):
+        '''
+        Append a record to the run log
+        :param record: dictionary
+        :return:
+        '''
+        if not os.path.exists(str(Path(self.run_log_path).parent)):
+            return
+        with open(self.run_log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    @staticmethod
+    def summarize_run_log(run_log_path, run_id=None):
+        '''
+        Summarize the run log per stage, nested stages (e.g., udm2_setnull() called by merge()) are listed but not
+        counted in the total time
+        :param run_log_path: string, file path of the run log
+        :param run_id: string, only summarize one run, all runs if None
+        :return: list, one dictionary per stage
+        '''
+
+        with open(run_log_path, 'r') as f:
+            record_list = [json.loads(line) for line in f if line.strip()]
+        if run_id is not None:
+            record_list = [record for record in record_list if record['run_id'] == run_id]
+        summary = {}
+        for record in record_list:
+            row = summary.setdefault(record['stage'], {
+                'stage': record['stage'], 'calls': 0, 'nested': 0, 'errors': 0, 'wall_s': 0., 'cpu_s': 0.,
+                'cpu_children_s': 0., 'read_gb': 0., 'write_gb': 0., 'tasks_run': 0, 'tasks_total': 0,
+                'peak_rss_mb': 0.})
+            row['calls'] += 1
+            row['nested'] += record['parent'] is not None
+            row['errors'] += record['error'] is not None
+            for key, record_key, scale in [('wall_s', 'wall_s', 1), ('cpu_s', 'cpu_s', 1),
+                                           ('cpu_children_s', 'cpu_children_s', 1),
+                                           ('read_gb', 'read_bytes', 1024 ** 3), ('write_gb', 'write_bytes', 1024 ** 3),
+                                           ('read_gb', 'read_bytes_children', 1024 ** 3),
+                                           ('write_gb', 'write_bytes_children', 1024 ** 3),
+                                           ('tasks_run', 'tasks_run', 1), ('tasks_total', 'tasks_total', 1)]:
+                if record.get(record_key) is not None:
+                    row[key] += record[record_key] / scale
+            row['peak_rss_mb'] = max(row['peak_rss_mb'], record.get('peak_rss_mb') or 0.,
+                                     record.get('peak_rss_children_mb') or 0.)
+        total_wall = sum([record['wall_s'] for record in record_list if record['parent'] is None])
+        row_list = sorted(summary.values(), key=lambda row: row['wall_s'], reverse=True)
+        for row in row_list:
+            row['share'] = row['wall_s'] / total_wall if total_wall > 0 and row['nested'] == 0 else None
+        return row_list
+
+    def setnull_path(self, input_path):
+        '''
+        File path of the udm2 image with background pixels set as no data
+        :param input_path: string, file path of the raw udm2 image
+        :return: string, a VRT if virtual_intermediates is True
+        '''
+        return str(self.stage_dir('raw') / str(Path(input_path).stem.split('.')[0] + '_setnull.{}'.format(
+            'vrt' if self.virtual_intermediates is True else 'tif')))
+
     def create_filter(self):
         '''
         Creater filters
         :return: filter
         '''
 
+        from planet.api import filters
+
         if 'date' in list(self.filter_items):
             date_filter = filters.date_range('acquired', gte=self.start_date, lte=self.end_date)
             and_filter = date_filter
@@ -318,7 +1278,44 @@ class Utilities:
             and_filter = filters.and_filter(and_filter, aoi_filter)
         return and_filter
 
-    def download_one(self, item_id, asset_type, item_type):
+    def coverage_filter(self, item_list):
+        '''
+        Drop the items of a search whose footprint covers too little of the AOI (min_aoi_coverage) or whose clear area
+        over the AOI is too small (min_usable_area). The footprints of the search results are intersected with the AOI
+        in the projected coordinate system of proj_code, nothing is downloaded or activated.
+        :param item_list: list, items (GeoJSON features) of the search results
+        :return: list, the items passing the filter
+        '''
+
+        if self.min_aoi_coverage is None and self.min_usable_area is None:
+            return item_list
+        if not item_list:
+            return item_list
+
+        import geopandas as gpd
+        from shapely.geometry import shape
+        from shapely.ops import unary_union
+
+        aoi_list = self.aoi_shp if isinstance(self.aoi_shp, (list, tuple)) else [self.aoi_shp]
+        aoi = unary_union([geom for aoi_shp in aoi_list
+                           for geom in gpd.read_file(aoi_shp).to_crs(epsg=self.proj_code)['geometry']])
+        footprints = gpd.GeoSeries([shape(item['geometry']) for item in item_list],
+                                   crs='epsg:4326').to_crs(epsg=self.proj_code)
+        covered_area = footprints.intersection(aoi).area.values
+        # clear fraction of the scene, PSScene items have clear_percent, older item types only cloud_cover
+        clear_fraction = np.array([item['properties']['clear_percent'] / 100.
+                                   if item['properties'].get('clear_percent') is not None
+                                   else 1. - (item['properties'].get('cloud_cover') or 0.) for item in item_list])
+        keep = np.ones(len(item_list), dtype=bool)
+        if self.min_aoi_coverage is not None:
+            keep &= covered_area / aoi.area >= self.min_aoi_coverage
+        if self.min_usable_area is not None:
+            keep &= covered_area * clear_fraction / 1e6 >= self.min_usable_area
+        print('Coverage filter: {} of {} items kept, {} dropped'.format(int(keep.sum()), len(item_list),
+                                                                         int((~keep).sum())))
+        return [item for item, keep_item in zip(item_list, keep) if keep_item]
+
+    def download_one(self, item_id, asset_type, item_type, output_dir=None):
         '''
         Download individual asset without using Planet client
         :param item_id: string, item id
@@ -326,10 +1323,13 @@ class Utilities:
                             https://developers.planet.com/docs/data/psscene4band/
         :param item_type: string, one item in the list of item type, more info:
                             https://developers.planet.com/docs/data/items-assets/
+        :param output_dir: string, the directory of downloaded assets, [work_dir]/raw if None
         :return: asset_exist, boolean, existence of required asset
         '''
 
-        output_dir = Path(self.work_dir) / self.output_dirs['raw']
+        import requests
+        from requests.auth import HTTPBasicAuth
+
         # records_file = open(self.records_path, "a+")
 
         # Request asset with item id
@@ -364,8 +1364,8 @@ class Utilities:
             # print(download_link)
             response = requests.get(download_url, stream=True)
             total_length = response.headers.get('content-length')
-            with open(Path(output_dir) / '{}_{}_{}.tif'.format(item_id, self.process_level,
-                                                               self.asset_attrs(asset_type)['suffix']), "wb") as handle:
+            with self.atomic_output(self.raw_path(item_id, asset_type, output_dir)) as temp_path, \
+                    open(temp_path, "wb") as handle:
                 if total_length is None:
                     for data in response.iter_content():
                         handle.write(data)
@@ -397,7 +1397,9 @@ class Utilities:
         :return: asset_exist, boolean, existence of required asset
         '''
 
-        output_dir = Path(self.work_dir) / self.output_dirs['raw']
+        from planet import api
+
+        output_dir = self.stage_dir('raw')
         # records_file = open(self.records_path, "a+")
 
         assets = self.client.get_assets_by_id(item_type, item_id).get()
@@ -444,8 +1446,10 @@ class Utilities:
         :return: asset_exist, boolean, existence of required asset
         '''
 
+        import requests
+
         # Create new folder
-        output_dir = Path(self.work_dir) / self.output_dirs['clipped_raw']
+        output_dir = self.stage_dir('clipped_raw')
         self.create_dir(output_dir)
         # records_file = open(self.records_path, "a+")
         print('The clipped raw images will be saved in this directory: ' + output_dir)
@@ -483,9 +1487,9 @@ class Utilities:
             # Download clipped asset
             response = requests.get(clip_download_url, stream=True)
             total_length = response.headers.get('content-length')
-            with open(Path(output_dir) / '{}_{}_{}.tif'.format(item_id, self.process_level,
-                                                               self.asset_attrs(asset_type)['suffix']),
-                      "wb") as handle:
+            with self.atomic_output(Path(output_dir) / '{}_{}_{}.tif'.format(
+                    item_id, self.process_level, self.asset_attrs(asset_type)['suffix'])) as temp_path, \
+                    open(temp_path, "wb") as handle:
                 if total_length is None:
                     for data in response.iter_content():
                         handle.write(data)
@@ -505,6 +1509,34 @@ class Utilities:
         # records_file.close()
         return asset_exist
 
+    def raw_path(self, item_id, asset_type, output_dir=None):
+        '''
+        File path of a downloaded asset
+        :param item_id: string, item id
+        :param asset_type: string, one item in the list of asset type
+        :param output_dir: string, the directory of downloaded assets, [work_dir]/raw if None
+        :return: string
+        '''
+        output_dir = self.stage_dir('raw') if output_dir is None else output_dir
+        return str(Path(output_dir) / '{}_{}_{}.tif'.format(item_id, self.process_level,
+                                                            self.asset_attrs(asset_type)['suffix']))
+
+    def search_items(self):
+        '''
+        Search items with the filters of create_filter() and coverage_filter()
+        :return: list, items (GeoJSON features)
+        '''
+
+        from planet.api import filters
+
+        # Create filter
+        and_filter = self.create_filter()
+        # records_file.write('Filter settings: {}\n\n'.format(and_filter))
+        req = filters.build_search_request(and_filter, self.item_types)
+        res = self.client.quick_search(req)
+        return self.coverage_filter(list(res.items_iter(250)))
+
+    @track_stage
     def download_assets(self, clipped=None, output_dir=None):
         '''
         Download all required assets
@@ -520,36 +1552,38 @@ class Utilities:
         # records_file.write('Execute download_assets():\nArguments: clipped={} output_dir={}\nStart time: {}\n\n'
         #                    .format(clipped, output_dir, time_str))
         if output_dir is None:
-            output_dir = Path(self.work_dir) / self.output_dirs['raw']
+            output_dir = self.stage_dir('raw')
 
         # Download clipped assets or not
         if clipped is None:
             clipped = False
 
-        # Create filter
-        and_filter = self.create_filter()
-        # records_file.write('Filter settings: {}\n\n'.format(and_filter))
-        # Search items
-        req = filters.build_search_request(and_filter, self.item_types)
-        res = self.client.quick_search(req)
+        # Search items, items barely covering the AOI are dropped
+        item_list = self.search_items()
         # List id of all items in the search result
-        id_list_search = [i['id'] for i in res.items_iter(250)]
+        id_list_search = [i['id'] for i in item_list]
 
         for asset_type in self.asset_types:
-            # Retrieve id of existing assets in the folder used to save all downloaded assets
-            file_list = glob('{}\\*{}.tif'.format(output_dir, self.asset_attrs(asset_type)['suffix']))
-            id_list_exist = [i.split('\\')[-1].split('_{}_'.format(self.process_level))[0] for i in file_list]
+            # Retrieve id of existing assets in the folder used to save all downloaded assets, assets downloaded
+            # before using this script (output_dir outside the work directory) are accepted as they are
+            adopt_settings = self.adopt_settings() if Path(output_dir) == self.stage_dir('raw') \
+                else {'adopt': True, 'validate': None}
+            id_list_exist = [i for i in id_list_search if self.manifest.is_up_to_date(
+                self.raw_path(i, asset_type, output_dir), [], {'asset_type': asset_type}, **adopt_settings)]
             # List id of all items to be downloaded
             self.id_list_download = [i for i in id_list_search if i not in id_list_exist]
+            self.count_tasks(len(id_list_search), len(self.id_list_download))
             # print(self.id_list_download)
             # Download (clipped) assets based on their item id
             for item_id in tqdm(self.id_list_download, total=len(self.id_list_download), unit="item",
                                 desc='Downloading assets'):
                 if not clipped:
                     for item_type in self.item_types:
-                        asset_exist = self.download_one(item_id, asset_type, item_type)
+                        asset_exist = self.download_one(item_id, asset_type, item_type, output_dir)
                         if asset_exist is True:
-                            metadata = [i for i in res.items_iter(250) if i['id'] == item_id]
+                            self.manifest.record(self.raw_path(item_id, asset_type, output_dir), [],
+                                                 {'asset_type': asset_type}, 'download')
+                            metadata = [i for i in item_list if i['id'] == item_id]
                             # records_file = open(self.records_path, "a+")
                             # records_file.write('File Exists: {}_{}_{} {}\n\n'
                             #                    .format(item_id, self.process_level,
@@ -562,43 +1596,193 @@ class Utilities:
                     for item_type in self.item_types:
                         self.download_clipped(item_id, item_type)
 
+        self.manifest.save()
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         print('Finish downloading assets :)')
-        print('The raw images have been saved in this directory: ' + output_dir)
+        print('The raw images have been saved in this directory: ' + str(output_dir))
         # print('The information of missing assets has be saved in this file: ' + self.records_path)
         # records_file.write('The outputs have been saved in this directory: {}\n\n'.format(output_dir))
         # records_file.write('End time: {}\n\n'.format(time_str))
         # records_file.close()
 
-    def gdal_udm2_setnull(self, input_path, output_path, compression='LZW'):
+    def use_tiles(self, input_path):
+        '''
+        Large images are processed tile by tile in a process pool, see tile_min_pixels
+        :param input_path: string, file path of the input image
+        :return: boolean
+        '''
+        if self.tile_min_pixels is None:
+            return False
+        raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+        return raster.RasterXSize * raster.RasterYSize >= self.tile_min_pixels
+
+    @staticmethod
+    def calc_block(args):
+        '''
+        Band algebra of one block, evaluated as gdal_calc.py does: the bands are read in their own data type, pixels
+        where an input band equals its no data value are set to the no data value of the output, and the result is
+        rounded and clamped to the output data type as GDAL does when writing it
+        :param args: tuple, (expression of the band names, e.g., '(A-B)/(A+B)*10000', list of {band name: (file path,
+                     band number)} per output band, window (x offset, y offset, x size, y size), output data type,
+                     e.g., 'UInt16', no data value of the output)
+        :return: tuple, (window, numpy array (output bands, y size, x size))
+        '''
+
+        calc, band_list, window, data_type, no_data = args
+        dtype = np.dtype({'Byte': 'uint8'}.get(data_type, data_type.lower()))
+        raster_dict = {}
+        output = np.empty((len(band_list), window[3], window[2]), dtype=dtype)
+        for output_idx, band_dict in enumerate(band_list):
+            array_dict = {}
+            masked = np.zeros((window[3], window[2]), dtype=bool)
+            for name, (path, band_idx) in band_dict.items():
+                if path not in raster_dict:
+                    raster_dict[path] = gdal.Open(path, gdal.GA_ReadOnly)
+                band = raster_dict[path].GetRasterBand(band_idx)
+                array_dict[name] = band.ReadAsArray(*window)
+                if band.GetNoDataValue() is not None:
+                    masked |= array_dict[name] == band.GetNoDataValue()
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                result = np.asarray(eval(calc, {'numpy': np}, array_dict), dtype=np.float64)
+                # same as gdal_calc.py, NaN stays NaN where masked
+                result = ~masked * result + no_data * masked
+            if np.issubdtype(dtype, np.integer):
+                result = np.clip(np.nan_to_num(result, nan=0.), np.iinfo(dtype).min, np.iinfo(dtype).max)
+                result = np.where(result >= 0, np.floor(result + 0.5), np.ceil(result - 0.5))
+            output[output_idx] = result
+        return window, output
+
+    def gdal_calc_tiled(self, calc, band_list, output_path, data_type, no_data, compression=None):
+        '''
+        Equivalent of gdal_calc.py for large images: the blocks, aligned to the tiles of the output, are computed by
+        calc_block() in a process pool and written to the output by this process as they come back. Within a worker
+        process (e.g., run_streaming()) the blocks are computed one after the other.
+        :param calc: string, expression of the band names, e.g., 'A*B'
+        :param band_list: list, {band name: (file path, band number)} of each output band, the first file is the grid
+        :param output_path: string, file path of the output
+        :param data_type: string, GDAL data type of the output, e.g., 'UInt16'
+        :param no_data: float, no data value of the output
+        :param compression: string, codec overriding the compression profile of the output
+        :return:
+        '''
+
+        ref_raster = gdal.Open(list(band_list[0].values())[0][0], gdal.GA_ReadOnly)
+        x_size, y_size = ref_raster.RasterXSize, ref_raster.RasterYSize
+        geo_transform, projection = ref_raster.GetGeoTransform(), ref_raster.GetProjection()
+        ref_raster = None
+
+        # input bands, float64 result and output of each output band
+        window_list = self.block_windows(x_size, y_size, len(band_list) * (len(band_list[0]) * 2 + 18),
+                                         align=self.output_block_size(output_path), min_blocks=2 * self.n_workers)
+        args_list = [(calc, band_list, window, data_type, no_data) for window in window_list]
+        driver = gdal.GetDriverByName('GTiff')
+        with self.atomic_output(output_path) as temp_path:
+            out_raster = driver.Create(temp_path, x_size, y_size, len(band_list), gdal.GetDataTypeByName(data_type),
+                                       options=self.creation_options(output_path, compression))
+            out_raster.SetGeoTransform(geo_transform)
+            out_raster.SetProjection(projection)
+            for band_idx in range(len(band_list)):
+                out_raster.GetRasterBand(band_idx + 1).SetNoDataValue(no_data)
+            # daemonic pool workers cannot start a pool of their own
+            with (nullcontext() if current_process().daemon else self.worker_pool()) as pool:
+                block_iter = map(self.calc_block, args_list) if pool is None \
+                    else pool.imap_unordered(self.calc_block, args_list)
+                for (x0, y0, _, _), output in block_iter:
+                    for band_idx in range(len(band_list)):
+                        out_raster.GetRasterBand(band_idx + 1).WriteArray(output[band_idx], x0, y0)
+            out_raster = None
+
+    def gdal_udm2_setnull(self, input_path, output_path, compression=None):
         '''
         Set the value of background pixels as no data
         :param input_path:
         :param output_path:
+        :param compression: string, codec overriding the compression profile of udm2
         :return:
         '''
 
-        temp_output_path = Path(self.work_dir) / 'TempFile.tif'
-        gdal_calc_str = 'python {0} --calc "A+B+C+D+E+F+G" --co "COMPRESS=LZW" --format GTiff ' \
-                        '--type Byte -A {1} --A_band 1 -B {2} --B_band 2 -C {3} --C_band 3 -D {4} --D_band 4 ' \
-                        '-E {5} --E_band 5 -F {6} --F_band 6 -G {7} --G_band 7 --NoDataValue 0.0 ' \
+        # the intermediate sum is not compressed
+        temp_output_path = self.temp_path(output_path, tag='sum')
+        gdal_calc_str = 'python {0} --calc "A+B+C+D+E+F+G" ' + \
+                        self.creation_option_args(self.creation_options(output_path, 'NONE'), '--co') + \
+                        ' --format GTiff --type Byte -A {1} --A_band 1 -B {2} --B_band 2 -C {3} --C_band 3 ' \
+                        '-D {4} --D_band 4 -E {5} --E_band 5 -F {6} --F_band 6 -G {7} --G_band 7 --NoDataValue 0.0 ' \
                         '--outfile {8} --overwrite'
         gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, input_path, input_path, input_path,
                                                  input_path, input_path, input_path, temp_output_path)
-        os.system(gdal_calc_process)
-
-        gdal_calc_str = 'python {0} --calc "A*(B>0)" --format GTiff ' \
-                        '--type Byte -A {1} -B {2} --outfile {3} --allBands A --overwrite'
-        gdal_calc_str = gdal_calc_str + f' --co "COMPRESS={compression}"' if compression is not None else gdal_calc_str
-
-        gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, temp_output_path, output_path)
-        os.system(gdal_calc_process)
-        os.remove(temp_output_path)
+        try:
+            if self.use_tiles(input_path):
+                # same expressions, no data of gdal_calc.py: 0 for the sum, 255 (Byte) for the output
+                n_band = gdal.Open(input_path, gdal.GA_ReadOnly).RasterCount
+                self.gdal_calc_tiled('A+B+C+D+E+F+G', [dict([(name, (input_path, band_idx + 1))
+                                                             for band_idx, name in enumerate('ABCDEFG')])],
+                                     temp_output_path, 'Byte', 0, 'NONE')
+                self.gdal_calc_tiled('A*(B>0)', [{'A': (input_path, band_idx + 1), 'B': (temp_output_path, 1)}
+                                                 for band_idx in range(n_band)], output_path, 'Byte', 255, compression)
+                return
+
+            self.run_command(gdal_calc_process)
+
+            gdal_calc_str = 'python {0} --calc "A*(B>0)" --format GTiff ' \
+                            '--type Byte -A {1} -B {2} --outfile {3} --allBands A --overwrite ' + \
+                            self.creation_option_args(self.creation_options(output_path, compression), '--co')
+
+            with self.atomic_output(output_path) as temp_path:
+                gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, temp_output_path, temp_path)
+                self.run_command(gdal_calc_process)
+        finally:
+            if os.path.exists(temp_output_path):
+                os.remove(temp_output_path)
+
+    def gdal_udm2_setnull_vrt(self, input_path, output_path):
+        '''
+        Virtual equivalent of gdal_udm2_setnull(): a VRT whose bands are computed from the raw udm2 image by
+        pixel_functions.udm2_setnull() when it is read
+        :param input_path: string, file path of the raw udm2 image
+        :param output_path: string, file path of the VRT
+        :return: string, output_path
+        '''
 
-    def udm2_setnull(self, file_list=None, compression='LZW'):
+        raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+        x_size, y_size, n_band = raster.RasterXSize, raster.RasterYSize, raster.RasterCount
+        geo_transform, projection = raster.GetGeoTransform(), raster.GetProjection()
+        raster = None
+        band_list = []
+        for band_idx in range(1, n_band + 1):
+            # bands 1 - 7 for the background, then the band itself
+            source_list = [self.vrt_source(input_path, source_band) for source_band in list(range(1, 8)) + [band_idx]]
+            band_list.append('  <VRTRasterBand dataType="Byte" band="{}" subClass="VRTDerivedRasterBand">\n'
+                             '    <NoDataValue>255</NoDataValue>\n'
+                             '    <PixelFunctionLanguage>Python</PixelFunctionLanguage>\n'
+                             '    <PixelFunctionType>pixel_functions.udm2_setnull</PixelFunctionType>\n'
+                             '    <SourceTransferType>Byte</SourceTransferType>\n'
+                             '{}  </VRTRasterBand>\n'.format(band_idx, ''.join(source_list)))
+        return self.write_vrt(output_path, x_size, y_size, geo_transform, projection, band_list)
+
+    def setnull_tasks(self, file_list, compression=None):
+        '''
+        Tasks of udm2_setnull()
+        :param file_list: list, file paths of raw udm2 images
+        :param compression: string, codec overriding the compression profile of udm2
+        :return: list, Task
+        '''
+        if self.virtual_intermediates is True:
+            return [Task('setnull', self.setnull_path(input_path), [input_path], {'format': 'VRT'},
+                         'gdal_udm2_setnull_vrt',
+                         {'input_path': input_path, 'output_path': self.setnull_path(input_path)})
+                    for input_path in file_list]
+        return [Task('setnull', self.setnull_path(input_path), [input_path],
+                     {'creation_options': self.creation_options(self.setnull_path(input_path), compression)},
+                     'gdal_udm2_setnull', {'input_path': input_path, 'output_path': self.setnull_path(input_path),
+                                           'compression': compression})
+                for input_path in file_list]
+
+    @track_stage
+    def udm2_setnull(self, file_list=None, compression=None):
         '''
         Set the value of background pixels as no data
         :param file_list:
+        :param compression: string, codec overriding the compression profile of udm2, e.g., 'LZW'
         :return:
         '''
 
@@ -608,7 +1792,7 @@ class Utilities:
         # records_file.write('Execute udm2_setnull():\nArguments: file_list={}\nStart time: {}\n\n'
         #                    .format(file_list, time_str))
 
-        input_dir = str(Path(self.work_dir) / self.output_dirs['raw'])
+        input_dir = str(self.stage_dir('raw'))
         output_dir = input_dir
 
         if file_list is None:
@@ -618,34 +1802,11 @@ class Utilities:
                 for j in a:
                     file_list.append(j)
         else:
-            file_list = [file for file in file_list if 'udm2' in file]
+            file_list = [file for file in file_list if 'udm2' in file and not file.endswith('_setnull.tif')]
         # print(file_list)
 
-        # Check existing setnull data and remove the latest one in case it was not complete
-        item_id_list = list(set([Path(file).stem.split('_{}_'.format(self.process_level))[0]
-                                 for file in file_list]))
-        exist_setnull = list(
-            set([Path(file).stem.split('_{}_'.format(self.process_level))[0]
-                 for file in glob(str(Path('{}/*setnull*.tif'.format(output_dir))))]))
-        new_setnull = [i for i in item_id_list if i not in exist_setnull]
-        if new_setnull:
-            if exist_setnull:
-                file_list_exist_setnull = glob(str(Path('{}/*setnull.tif'.format(output_dir))))
-                if self.remove_latest is True:
-                    latest_file = max(file_list_exist_setnull, key=os.path.getctime)
-                    # Remove the latest file, in case it is not complete
-                    os.remove(latest_file)
-                    file_list_exist_setnull.remove(latest_file)
-                # Add the removed one to the file list
-                new_setnull.append(Path(latest_file).stem.split('_{}_'.format(self.process_level))[0])
-        file_list = [file for file in file_list for i in new_setnull if i in file]
-
-        for input_path in tqdm(file_list, total=len(file_list), unit="item", desc='Processing udm2 data'):
-            output_path = str(Path(output_dir) / str(Path(input_path).stem.split('.')[0] + '_setnull.tif'))
-            try:
-                self.gdal_udm2_setnull(input_path=input_path, output_path=output_path, compression=compression)
-            except:
-                pass
+        # Only files whose input or settings changed since the last run
+        self.run_tasks(self.setnull_tasks(file_list, compression), desc='Processing udm2 data')
 
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         print('Finish processing udm2 data :)')
@@ -654,14 +1815,15 @@ class Utilities:
         # records_file.write('End time: {}\n\n'.format(time_str))
         # records_file.close()
 
-    def gdal_merge(self, input_path, output_path, data_type, separate=False, compression=None):
+    def gdal_merge(self, input_path, output_path, data_type, separate=False, compression=None, nodata=None):
         '''
         GDAL merge function. More info: https://gdal.org/programs/gdal_merge.html
         :param output_path:
         :param input_path:
-        :param data_type:
+        :param data_type: string, data type of the output, the type of the first input if None
         :param separate:
-        :param compression:
+        :param compression: string, codec overriding the compression profile of the output, e.g., 'LZW' or 'NONE'
+        :param nodata: float, input pixel value to be ignored (-n)
         :return:
         '''
 
@@ -669,13 +1831,54 @@ class Utilities:
         # ERROR 1: TIFFReadEncodedStrip() failed.
         # ERROR 1: /mnt/raid5/Planet/pre_processed/Sierra_Nevada_AOI1/raw/20190509_172738_0f46_3B_udm2_clip_setnull.tif,
         # band 8: IReadBlock failed at X offset 0, Y offset 1339: TIFFReadEncodedStrip() failed.
+        # -> gdal_merge.py reads back blocks it already wrote, so it writes an uncompressed temporary file which is
+        # compressed in one pass by gdal.Translate()
+
+        option_list = self.creation_options(output_path, compression)
+        gdal_merge_str = 'python {0} -o {1} {2}'
+        gdal_merge_str = gdal_merge_str + ' -ot {}'.format(data_type) if data_type is not None else gdal_merge_str
+        gdal_merge_str = gdal_merge_str + ' -separate' if separate is True else gdal_merge_str
+        gdal_merge_str = gdal_merge_str + ' -n {}'.format(nodata) if nodata is not None else gdal_merge_str
+        with self.atomic_output(output_path) as temp_path:
+            if option_list[0] == 'COMPRESS=NONE':
+                gdal_merge_process = ' '.join([gdal_merge_str.format(self.gdal_merge_path, temp_path, input_path),
+                                               self.creation_option_args(option_list)])
+                self.run_command(gdal_merge_process)
+                return
+            raw_path = self.temp_path(output_path, tag='raw')
+            try:
+                gdal_merge_process = ' '.join([gdal_merge_str.format(self.gdal_merge_path, raw_path, input_path),
+                                               self.creation_option_args(['BIGTIFF=IF_SAFER'])])
+                self.run_command(gdal_merge_process)
+                out_raster = gdal.Translate(temp_path, raw_path, format='GTiff', creationOptions=option_list)
+                if out_raster is None:
+                    raise RuntimeError('Failed to compress {}'.format(output_path))
+                out_raster = None
+            finally:
+                if os.path.exists(raw_path):
+                    os.remove(raw_path)
+
+    def gdal_mosaic_vrt(self, input_list, output_path):
+        '''
+        Virtual equivalent of gdal_merge(): a mosaic VRT of the images, the later images are on top and their no data
+        is not transparent, with the pixel size of the first image, like gdal_merge.py without -n
+        :param input_list: list, file paths of the images
+        :param output_path: string, file path of the VRT
+        :return: string, output_path
+        '''
 
-        gdal_merge_str = 'python {0} -o {1} {2} -ot {3}' if separate is False \
-            else 'python {0} -o {1} {2} -ot {3} -separate'
-        gdal_merge_str = ' '.join([gdal_merge_str, f'-co COMPRESS={compression}']) if compression is not None else gdal_merge_str
-        gdal_merge_process = gdal_merge_str.format(self.gdal_merge_path, output_path, input_path, data_type)
-        os.system(gdal_merge_process)
+        raster = gdal.Open(input_list[0], gdal.GA_ReadOnly)
+        geo_transform = raster.GetGeoTransform()
+        raster = None
+        with self.atomic_output(output_path) as temp_path:
+            out_raster = gdal.BuildVRT(temp_path, input_list, resolution='user', xRes=geo_transform[1],
+                                       yRes=abs(geo_transform[5]), srcNodata='None', VRTNodata='None')
+            if out_raster is None:
+                raise RuntimeError('Failed to build {}'.format(output_path))
+            out_raster = None
+        return output_path
 
+    @track_stage
     def merge(self, input_dir=None, file_list=None, asset_type_list=default_asset_types):
         '''
         Merge images acquired in the same day with the same satellite id
@@ -695,8 +1898,8 @@ class Utilities:
         # records_file = open(self.records_path, "a+")
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         # records_file.write('Execute merge():\nArguments: file_list={}\nStart time: {}\n\n'.format(file_list, time_str))
-        input_dir = str(Path(self.work_dir) / self.output_dirs['raw']) if input_dir is None else input_dir
-        output_dir = str(Path(self.work_dir) / self.output_dirs['merge'])
+        input_dir = str(self.stage_dir('raw')) if input_dir is None else input_dir
+        output_dir = str(self.stage_dir('merge'))
 
         if file_list is None:
             file_list = []
@@ -706,35 +1909,7 @@ class Utilities:
                     file_list.append(j)
             # print(file_list)
 
-        for asset_type in asset_type_list:
-            date_list = list(set([Path(file).stem.split('_')[0]
-                                  for file in file_list if self.asset_attrs(asset_type)['suffix'] in file]))
-            # Check existing merged data and remove the latest file in case it was not complete
-            file_list_exist = glob(str(Path('{}/*{}.tif'.format(output_dir, self.asset_attrs(asset_type)['suffix']))))
-            if file_list_exist:
-                date_list_exist = list(set([Path(file).stem.split('_')[0] for file in file_list_exist]))
-                if self.remove_latest is True:
-                    latest_file = max(file_list_exist, key=os.path.getctime)
-                    latest_file_date = Path(latest_file).stem.split('_')[0]
-                    os.remove(latest_file)
-                    date_list_exist.remove(latest_file_date)
-                date_list = [date for date in date_list if date not in date_list_exist]
-
-            for date in tqdm(date_list, total=len(date_list), unit="item", desc='Merging images'):
-                if asset_type == 'udm2':
-                    file_list_new = glob(str(Path('{}/{}*{}*_setnull.tif'
-                                                  .format(input_dir, date, self.asset_attrs(asset_type)['suffix']))))
-                else:
-                    file_list_new = [i for i in file_list if
-                                     date in Path(i).stem and self.asset_attrs(asset_type)['suffix'] in Path(i).stem]
-                satellite_id_list = list(set([Path(x).stem.split('_{}_'.format(self.process_level))[0]
-                                             .split('_')[-1] for x in file_list_new]))
-                for satellite_id in satellite_id_list:
-                    output_path = str(Path(output_dir) / str(date + '_' + satellite_id + '_{}.tif'
-                                                             .format(self.asset_attrs(asset_type)['suffix'])))
-                    input_path = ' '.join(str(i) for i in file_list_new if satellite_id in i)
-                    self.gdal_merge(input_path, output_path, self.asset_attrs(asset_type)['data type'],
-                                    separate=False, compression=None)
+        self.run_tasks(self.merge_tasks(file_list, asset_type_list), desc='Merging images')
 
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         print('Finish merging images :)')
@@ -743,6 +1918,43 @@ class Utilities:
         # records_file.write('End time: {}\n\n'.format(time_str))
         # records_file.close()
 
+    def merge_tasks(self, file_list, asset_type_list=default_asset_types):
+        '''
+        Tasks of merge(), one per asset type, day and satellite id
+        :param file_list: list, file paths of raw images, udm2 images are merged from their setnull outputs
+        :param asset_type_list: list, a list of asset types
+        :return: list, Task
+        '''
+
+        output_dir = str(self.stage_dir('merge'))
+        # Group images acquired in the same day with the same satellite id
+        task_list = []
+        for asset_type in asset_type_list:
+            suffix = self.asset_attrs(asset_type)['suffix']
+            data_type = self.asset_attrs(asset_type)['data type']
+            group_dict = {}
+            for file in file_list:
+                if suffix not in Path(file).stem or file.endswith('_setnull.tif'):
+                    continue
+                date = Path(file).stem.split('_')[0]
+                satellite_id = Path(file).stem.split('_{}_'.format(self.process_level))[0].split('_')[-1]
+                input_path = self.setnull_path(file) if asset_type == 'udm2' else file
+                if os.path.exists(input_path):
+                    group_dict.setdefault((date, satellite_id), []).append(input_path)
+            for (date, satellite_id), input_list in sorted(group_dict.items()):
+                input_list = sorted(input_list)
+                if self.virtual_intermediates is True:
+                    output_path = str(Path(output_dir) / str(date + '_' + satellite_id + '_{}.vrt'.format(suffix)))
+                    task_list.append(Task('merge', output_path, input_list, {'data_type': data_type, 'format': 'VRT'},
+                                          'gdal_mosaic_vrt', {'input_list': input_list, 'output_path': output_path}))
+                    continue
+                output_path = str(Path(output_dir) / str(date + '_' + satellite_id + '_{}.tif'.format(suffix)))
+                task_list.append(Task('merge', output_path, input_list,
+                                      {'data_type': data_type, 'creation_options': self.creation_options(output_path)},
+                                      'gdal_merge', {'input_path': ' '.join(input_list), 'output_path': output_path,
+                                                     'data_type': data_type, 'separate': False}))
+        return task_list
+
     def gdal_clip(self, input_path, pixel_res, shapefile_path, output_path, data_type, compression=None):
         '''
         GDAL clip function
@@ -769,7 +1981,8 @@ class Utilities:
         if data_type == 'Byte':
             gdal_data_type = gdal.GDT_Byte
         # Create raster
-        OutTile = gdal.Warp('temp.vrt', raster, format='VRT',
+        vrt_path = '/vsimem/{}_{}.vrt'.format(Path(output_path).stem, os.getpid())
+        OutTile = gdal.Warp(vrt_path, raster, format='VRT',
                             outputType=gdal_data_type,
                             outputBounds=[minX, minY, maxX, maxY],
                             xRes=pixel_res, yRes=pixel_res,
@@ -780,23 +1993,148 @@ class Utilities:
                             cutlineLayer=Path(shapefile_path).stem.split('.')[0],
                             cropToCutline=True,
                             # dstNodata=-9999,
-                            options=['COMPRESS=LZW'])
+                            **self.warp_kwargs())
 
         # Compression
-        if compression is not None:
-            translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine(f"-of Gtiff -co COMPRESS={compression}"))
-        else:
-            translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine("-of Gtiff"))
-        gdal.Translate(output_path, 'temp.vrt', options=translateoptions)
+        translateoptions = gdal.TranslateOptions(format='GTiff',
+                                                 creationOptions=self.creation_options(output_path, compression))
+        with self.atomic_output(output_path) as temp_path:
+            out_raster = gdal.Translate(temp_path, vrt_path, options=translateoptions)
+            if out_raster is None:
+                raise RuntimeError('Failed to clip {}'.format(input_path))
+            out_raster = None
         # gdal_translate_str = 'python {0} -co COMPRESS=LZW temp.vrt {1}'
         # gdal_translate_process = gdal_translate_str.format(self.gdal_translate_path, output_path)
         # os.system(gdal_translate_process)
 
         # Close dataset
         OutTile = None
+        gdal.Unlink(vrt_path)
         raster = None
         vector_dataset.Destroy()
 
+    @staticmethod
+    def create_spatial_index(shapefile_path):
+        '''
+        Create a spatial index (.qix) for a shapefile if it does not exist, so that spatial filters do not scan all
+        features. The shapefile is opened in update mode and a file is added next to it, so this is only done on
+        request (clip(spatial_index=True)) and when its folder is writable.
+        :param shapefile_path: string, file path of the shapefile
+        :return:
+        '''
+
+        if Path(shapefile_path).suffix.lower() != '.shp' or \
+                os.path.exists(str(Path(shapefile_path).with_suffix('.qix'))) or \
+                not os.access(str(Path(shapefile_path).resolve().parent), os.W_OK):
+            return
+        vector_dataset = ogr.Open(shapefile_path, 1)
+        if vector_dataset is None:
+            # Read-only location, features will be scanned instead
+            return
+        vector_dataset.ExecuteSQL('CREATE SPATIAL INDEX ON "{}"'.format(vector_dataset.GetLayer().GetName()))
+        vector_dataset = None
+
+    def clip_multi_tasks(self, input_path, shapefile_path, output_dir, data_type, id_field=None, mask=True,
+                         suffix=''):
+        '''
+        Tasks of clip(multi_feature=True), one output per polygon of a shapefile intersecting the raster. Each task only
+        reads the window covering its polygon, see gdal_clip_feature().
+        :param input_path: string, file path of the raster
+        :param shapefile_path: string, file path of the shapefile
+        :param output_dir: string, the folder for saving the clipped images
+        :param data_type: string, data type of the outputs, e.g., 'UInt16'
+        :param id_field: string, attribute used to name the outputs, feature id is used if None
+        :param mask: boolean, True means pixels outside the polygon are set to no data
+        :param suffix: string, suffix of the output file names
+        :return: list, Task
+        '''
+
+        raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+        geo_transform = raster.GetGeoTransform()
+        raster_srs_wkt = raster.GetProjection()
+        x_size, y_size = raster.RasterXSize, raster.RasterYSize
+        raster = None
+
+        # Footprint of the scene
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for col, row in [(0, 0), (x_size, 0), (x_size, y_size), (0, y_size), (0, 0)]:
+            ring.AddPoint_2D(geo_transform[0] + col * geo_transform[1], geo_transform[3] + row * geo_transform[5])
+        footprint = ogr.Geometry(ogr.wkbPolygon)
+        footprint.AddGeometry(ring)
+
+        # Only features intersecting the footprint, filtered by the spatial index of the shapefile
+        vector_dataset = ogr.Open(shapefile_path, 0)
+        layer = vector_dataset.GetLayer()
+        layer_srs = layer.GetSpatialRef()
+        layer_srs_wkt = layer_srs.ExportToWkt() if layer_srs is not None else ''
+        footprint_layer = self.geometry_to_raster_srs(footprint.ExportToWkt(), raster_srs_wkt, layer_srs_wkt)
+        minX, maxX, minY, maxY = footprint_layer.GetEnvelope()
+        layer.SetSpatialFilterRect(minX, minY, maxX, maxY)
+        task_list = []
+        for feature in layer:
+            if feature.GetGeometryRef() is None:
+                continue
+            geom = self.geometry_to_raster_srs(feature.GetGeometryRef().ExportToWkt(), layer_srs_wkt, raster_srs_wkt)
+            if not geom.Intersects(footprint):
+                continue
+            window = self.geometry_window(geom, geo_transform, x_size, y_size)
+            if window is None:
+                continue
+            name = feature.GetFID() if id_field is None else feature.GetField(id_field)
+            output_path = str(Path(output_dir) / '{}_{}{}.tif'.format(Path(input_path).stem, name, suffix))
+            geom_wkt = geom.ExportToWkt()
+            task_list.append(Task('clip', output_path, [input_path, shapefile_path],
+                                  {'geometry': hashlib.sha1(geom_wkt.encode('utf-8')).hexdigest(),
+                                   'window': list(window), 'mask': mask, 'data_type': data_type,
+                                   'creation_options': self.creation_options(output_path)},
+                                  'gdal_clip_feature', {'input_path': input_path, 'geom_wkt': geom_wkt,
+                                                        'window': window, 'output_path': output_path,
+                                                        'data_type': data_type, 'mask': mask}))
+        vector_dataset = None
+        return task_list
+
+    def gdal_clip_feature(self, input_path, geom_wkt, window, output_path, data_type, mask=True, compression=None):
+        '''
+        Clip one raster to one polygon by reading the window covering the polygon, see clip_multi_tasks()
+        :param input_path: string, file path of the raster
+        :param geom_wkt: string, WKT of the polygon in the spatial reference of the raster
+        :param window: tuple, (xoff, yoff, xsize, ysize), pixel window covering the polygon
+        :param output_path: string, file path of the output
+        :param data_type: string, data type of the output, e.g., 'UInt16'
+        :param mask: boolean, True means pixels outside the polygon are set to no data
+        :param compression: string, codec overriding the compression profile, e.g., 'LZW'
+        :return:
+        '''
+
+        xoff, yoff, xsize, ysize = window
+        raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+        geo_transform = raster.GetGeoTransform()
+        raster_srs_wkt = raster.GetProjection()
+        nodata = raster.GetRasterBand(1).GetNoDataValue()
+        nodata = 0 if nodata is None else nodata
+        n_band = raster.RasterCount
+        array = raster.ReadAsArray(xoff, yoff, xsize, ysize)
+        raster = None
+        if n_band == 1:
+            array = array[np.newaxis]
+        if mask is True:
+            geom_mask = self.rasterize_geometry(ogr.CreateGeometryFromWkt(geom_wkt), raster_srs_wkt, geo_transform,
+                                                window)
+            array = np.where(geom_mask, array, np.array(nodata, dtype=array.dtype))
+
+        driver = gdal.GetDriverByName('GTiff')
+        with self.atomic_output(output_path) as temp_path:
+            out_raster = driver.Create(temp_path, xsize, ysize, n_band, gdal.GetDataTypeByName(data_type),
+                                       options=self.creation_options(output_path, compression))
+            out_raster.SetGeoTransform((geo_transform[0] + xoff * geo_transform[1], geo_transform[1], 0,
+                                        geo_transform[3] + yoff * geo_transform[5], 0, geo_transform[5]))
+            out_raster.SetProjection(raster_srs_wkt)
+            # no band is kept referenced, it would keep the dataset open past the end of atomic_output()
+            for band_idx in range(n_band):
+                out_raster.GetRasterBand(band_idx + 1).SetNoDataValue(nodata)
+                out_raster.GetRasterBand(band_idx + 1).WriteArray(array[band_idx])
+            out_raster = None
+
     @staticmethod
     def get_aoi_scenes(all_scenes, aoi):
         """
@@ -806,18 +2144,150 @@ class Utilities:
         :return: GeoDataFrame,
         """
 
+        import geopandas as gpd
+
         all_scenes_gdf = gpd.GeoDataFrame.from_file(all_scenes)
         aoi_gdf = gpd.GeoDataFrame.from_file(aoi)
         out = gpd.overlay(all_scenes_gdf, aoi_gdf, how='intersection')
         return out
 
-    def clip(self, file_list=None, aoi_shp=None, suffix='', discard_empty_scene=None, all_scenes=None):
+    @staticmethod
+    def load_footprint_index(all_scenes):
+        '''
+        Spatial index (STRtree) over the scene footprints of a GeoPackage. The footprints are persisted alongside the
+        GeoPackage ([all_scenes].sindex.pkl) if its folder is writable, and rebuilt when the GeoPackage changes or the
+        persisted file cannot be read.
+        :param all_scenes: string, file path of the GeoPackage of all scenes, with an 'id' column
+        :return: dictionary, 'ids' - scene id, 'geoms' - footprints, 'tree' - STRtree of footprints, 'crs' - crs
+        '''
+
+        import geopandas as gpd
+        from shapely import wkb
+        from shapely.strtree import STRtree
+
+        stat = os.stat(all_scenes)
+        signature = (stat.st_size, stat.st_mtime)
+        index = _footprint_index_cache.get(all_scenes)
+        if index is not None and index['signature'] == signature:
+            return index
+
+        index_path = all_scenes + '.sindex.pkl'
+        persisted = None
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'rb') as f:
+                    persisted = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError, ImportError):
+                # unreadable or truncated, rebuilt from the GeoPackage
+                persisted = None
+            if not isinstance(persisted, dict) or persisted.get('signature') != signature:
+                persisted = None
+        if persisted is None:
+            all_scenes_gdf = gpd.read_file(all_scenes)
+            persisted = {'signature': signature,
+                         'crs': all_scenes_gdf.crs.to_wkt() if hasattr(all_scenes_gdf.crs, 'to_wkt')
+                         else all_scenes_gdf.crs,
+                         'ids': all_scenes_gdf['id'].tolist(),
+                         'wkb': [geom.wkb for geom in all_scenes_gdf.geometry]}
+            # only persisted where the folder of the GeoPackage is writable, the index is kept in memory otherwise
+            if os.access(str(Path(index_path).resolve().parent), os.W_OK):
+                try:
+                    with Utilities.atomic_output(index_path) as temp_path:
+                        with open(temp_path, 'wb') as f:
+                            pickle.dump(persisted, f)
+                except OSError:
+                    pass
+
+        geoms = [wkb.loads(geom_wkb) for geom_wkb in persisted['wkb']]
+        index = {'signature': signature, 'crs': persisted['crs'], 'ids': persisted['ids'], 'geoms': geoms,
+                 'tree': STRtree(geoms)}
+        _footprint_index_cache[all_scenes] = index
+        return index
+
+    @staticmethod
+    def query_footprint_index(index, geom):
+        '''
+        Scenes whose footprint intersects a geometry
+        :param index: dictionary, output of load_footprint_index()
+        :param geom: shapely geometry, in the crs of the index
+        :return: list, scene id
+        '''
+
+        candidates = index['tree'].query(geom)
+        if len(candidates) and not isinstance(candidates[0], (int, np.integer)):
+            # Shapely < 2.0 returns geometries instead of their positions
+            if 'positions' not in index:
+                index['positions'] = {id(footprint): i for i, footprint in enumerate(index['geoms'])}
+            candidates = [index['positions'][id(footprint)] for footprint in candidates]
+        return [index['ids'][i] for i in candidates if index['geoms'][i].intersects(geom)]
+
+    def get_aoi_scene_ids(self, all_scenes, aoi):
+        '''
+        Retrieve the id of scenes intersecting an aoi, using the cached footprint index
+        :param all_scenes: string, file path of the GeoPackage of all scenes
+        :param aoi: string, file path of AOI.shp
+        :return: set, scene id
+        '''
+
+        import geopandas as gpd
+
+        index = self.load_footprint_index(all_scenes)
+        aoi_gdf = gpd.read_file(aoi)
+        if aoi_gdf.crs is not None and index['crs'] is not None:
+            aoi_gdf = aoi_gdf.to_crs(index['crs'])
+        return set(self.query_footprint_index(index, aoi_gdf.unary_union))
+
+    def clip_data_type(self, input_path):
+        '''
+        Data type of an image from the suffix of its asset type
+        '''
+        data_type = None
+        if self.asset_attrs('udm2')['suffix'] in input_path:
+            data_type = self.asset_attrs('udm2')['data type']
+        if self.asset_attrs('analytic_sr')['suffix'] in input_path:
+            data_type = self.asset_attrs('analytic_sr')['data type']
+        return data_type
+
+    def clip_tasks(self, file_list, aoi_shp=None, suffix=''):
+        '''
+        Tasks of clip(), one output per image
+        :param file_list: list, file paths of merged images
+        :param aoi_shp: string, file path of AOI.shp, self.aoi_shp if None
+        :param suffix: string, suffix of the output file names
+        :return: list, Task
+        '''
+        aoi_shp = self.aoi_shp if aoi_shp is None else aoi_shp
+        output_dir = str(Path(self.work_dir) / self.output_dirs['clip'])
+        task_list = []
+        for input_path in file_list:
+            data_type = self.clip_data_type(input_path)
+            # merged VRTs are clipped to GeoTIFFs
+            output_name = str(Path(input_path).stem) + f'{suffix}' + '.tif'
+            output_path = str(Path(output_dir) / output_name)
+            task_list.append(Task('clip', output_path, [input_path, aoi_shp],
+                                  {'pixel_res': self.pixel_res(self.satellite), 'data_type': data_type,
+                                   'creation_options': self.creation_options(output_path)},
+                                  'gdal_clip', {'input_path': input_path,
+                                                'pixel_res': self.pixel_res(self.satellite),
+                                                'shapefile_path': aoi_shp, 'output_path': output_path,
+                                                'data_type': data_type}))
+        return task_list
+
+    @track_stage
+    def clip(self, file_list=None, aoi_shp=None, suffix='', discard_empty_scene=None, all_scenes=None,
+             multi_feature=False, id_field=None, mask=True, spatial_index=False):
         '''
         Clip imagery to the extent of AOI
         :param discard_empty_scene:
         :param suffix:
         :param aoi_shp:
         :param file_list:
+        :param multi_feature: boolean, True means clipping each image to every polygon of aoi_shp separately, the
+                            outputs are named after the polygons
+        :param id_field: string, attribute used to name the outputs when multi_feature is True, feature id if None
+        :param mask: boolean, True means pixels outside the polygons are set to no data when multi_feature is True
+        :param spatial_index: boolean, True means a spatial index (.qix) is written next to aoi_shp when multi_feature
+                              is True, if its folder is writable, see create_spatial_index()
         :return:
         '''
 
@@ -825,7 +2295,7 @@ class Utilities:
         # records_file = open(self.records_path, "a+")
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         # records_file.write('Execute clip():\nArguments: file_list={}\nStart time: {}\n\n'.format(file_list, time_str))
-        input_dir = str(Path(self.work_dir) / self.output_dirs['merge'])
+        input_dir = str(self.stage_dir('merge'))
         output_dir = str(Path(self.work_dir) / self.output_dirs['clip'])
 
         aoi_shp = self.aoi_shp if aoi_shp is None else aoi_shp
@@ -838,29 +2308,24 @@ class Utilities:
                     file_list.append(j)
             # print(file_list)
 
-        # Check existing clipped images and remove the latest file, in case it is not complete
-        file_list_exist = glob(str(Path('{}/*.tif'.format(output_dir))))
-        if file_list_exist:
-            if self.remove_latest is True:
-                latest_file = max(file_list_exist, key=os.path.getctime)
-                os.remove(latest_file)
-                file_list_exist.remove(latest_file)
-            file_list = [file for file in file_list if file not in file_list_exist]
-
         if discard_empty_scene is True:
             all_scenes = self.all_scenes if all_scenes is None else all_scenes
-            overlayed_gdf = self.get_aoi_scenes(all_scenes=all_scenes, aoi=aoi_shp)
-            date_orbit_list = overlayed_gdf['id'].apply(lambda x: x.split('_')).apply(lambda x: '_'.join([x[0], x[-1]])).tolist()
-            file_list = [fp for date_orbit in date_orbit_list for fp in file_list if date_orbit in fp]
-
-        for input_path in tqdm(file_list, total=len(file_list), unit="item", desc='Clipping images'):
-            output_name = str(Path(input_path).stem) + f'{suffix}' + str(Path(input_path).suffix)
-            output_path = str(Path(output_dir) / output_name)
-            if self.asset_attrs('udm2')['suffix'] in input_path:
-                data_type = self.asset_attrs('udm2')['data type']
-            if self.asset_attrs('analytic_sr')['suffix'] in input_path:
-                data_type = self.asset_attrs('analytic_sr')['data type']
-            self.gdal_clip(input_path, self.pixel_res(self.satellite), aoi_shp, output_path, data_type)
+            scene_id_set = self.get_aoi_scene_ids(all_scenes=all_scenes, aoi=aoi_shp)
+            date_orbit_set = set(['_'.join([x.split('_')[0], x.split('_')[-1]]) for x in scene_id_set])
+            file_list = [fp for fp in file_list if '_'.join(Path(fp).stem.split('_')[:2]) in date_orbit_set]
+
+        if multi_feature is True and spatial_index is True:
+            self.create_spatial_index(aoi_shp)
+
+        if multi_feature is True:
+            # One output per polygon
+            task_list = []
+            for input_path in file_list:
+                task_list += self.clip_multi_tasks(input_path, aoi_shp, output_dir, self.clip_data_type(input_path),
+                                                   id_field, mask, suffix)
+        else:
+            task_list = self.clip_tasks(file_list, aoi_shp, suffix)
+        self.run_tasks(task_list, desc='Clipping images')
 
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         print('Finish clipping images :)')
@@ -876,10 +2341,16 @@ class Utilities:
         :param output_path:
         :return:
         '''
-        gdal_calc_str = 'python {0} --calc "(A-B)/(A+B)*10000" --co "COMPRESS=LZW" --format GTiff ' \
-                        '--type UInt16 -A {1} --A_band 4 -B {2} --B_band 3 --outfile {3} --overwrite'
-        gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, input_path, output_path)
-        os.system(gdal_calc_process)
+        if self.use_tiles(input_path):
+            self.gdal_calc_tiled('(A-B)/(A+B)*10000', [{'A': (input_path, 4), 'B': (input_path, 3)}], output_path,
+                                 'UInt16', 65535)
+            return
+        gdal_calc_str = 'python {0} --calc "(A-B)/(A+B)*10000" --format GTiff ' \
+                        '--type UInt16 -A {1} --A_band 4 -B {2} --B_band 3 --outfile {3} --overwrite ' + \
+                        self.creation_option_args(self.creation_options(output_path), '--co')
+        with self.atomic_output(output_path) as temp_path:
+            gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, input_path, temp_path)
+            self.run_command(gdal_calc_process)
 
     def gdal_calc_clear_prob(self, input_path, output_path):
         '''
@@ -888,11 +2359,47 @@ class Utilities:
         :param output_path:
         :return:
         '''
-        gdal_calc_str = 'python {0} --calc "A*B" --co "COMPRESS=LZW" --format GTiff --type UInt16 -A {1} ' \
-                        '--A_band 1 -B {2} --B_band 7 --outfile {3} --overwrite'
-        gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, input_path, output_path)
-        os.system(gdal_calc_process)
+        if self.use_tiles(input_path):
+            self.gdal_calc_tiled('A*B', [{'A': (input_path, 1), 'B': (input_path, 7)}], output_path, 'UInt16', 65535)
+            return
+        gdal_calc_str = 'python {0} --calc "A*B" --format GTiff --type UInt16 -A {1} ' \
+                        '--A_band 1 -B {2} --B_band 7 --outfile {3} --overwrite ' + \
+                        self.creation_option_args(self.creation_options(output_path), '--co')
+        with self.atomic_output(output_path) as temp_path:
+            gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, input_path, input_path, temp_path)
+            self.run_command(gdal_calc_process)
+
+    def band_algebra_attrs(self, output_type):
+        '''
+        :param output_type: string, 'clear prob' or 'NDVI'
+        :return: tuple, (suffix of the input images, output folder, output file name pattern, function name)
+        '''
+        if output_type == 'clear prob':
+            return (self.asset_attrs('udm2')['suffix'], str(Path(self.work_dir) / self.output_dirs['clear prob']),
+                    '{}_clearprob.tif', 'gdal_calc_clear_prob')
+        if output_type == 'NDVI':
+            return (self.asset_attrs('analytic_sr')['suffix'], str(Path(self.work_dir) / self.output_dirs['NDVI']),
+                    '{}_ndvi.tif', 'gdal_calc_ndvi')
+        raise ValueError('Unknown output type: {}'.format(output_type))
 
+    def band_algebra_tasks(self, output_type, file_list):
+        '''
+        Tasks of band_algebra()
+        :param output_type: string, 'clear prob' or 'NDVI'
+        :param file_list: list, file paths of clipped images
+        :return: list, Task
+        '''
+        suffix, output_dir, output_name, func = self.band_algebra_attrs(output_type)
+        task_list = []
+        for input_path in [file for file in file_list if suffix in file]:
+            scene_name = Path(input_path).name.split('_{}'.format(suffix))[0]
+            output_path = str(Path(output_dir) / output_name.format(scene_name))
+            task_list.append(Task(output_type, output_path, [input_path],
+                                  {'creation_options': self.creation_options(output_path)}, func,
+                                  {'input_path': input_path, 'output_path': output_path}))
+        return task_list
+
+    @track_stage
     def band_algebra(self, output_type, file_list=None):
         '''
         Band algebra for clear probablity or NDVI
@@ -906,62 +2413,462 @@ class Utilities:
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         # records_file.write('Execute band_algebra():\nArguments: output_type={} file_list={}\nStart time: {}\n\n'
         #                    .format(output_type, file_list, time_str))
-        input_dir = self.work_dir + '\\' + self.output_dirs['clip']
+        input_dir = str(Path(self.work_dir) / self.output_dirs['clip'])
+        suffix, output_dir, _, _ = self.band_algebra_attrs(output_type)
 
-        if output_type == 'clear prob':
-            asset_type = 'udm2'
-            clear_prob_dir = self.work_dir + '\\' + self.output_dirs['clear prob']
-            if file_list is None:
-                file_list = []
-                for i in self.id_list_download:
-                    a = glob("{}\\{}*{}.tif".format(input_dir, i, self.asset_attrs('udm2')['suffix']))
-                    for j in a:
-                        file_list.append(j)
-            else:
-                file_list = [file for file in file_list if self.asset_attrs('udm2')['suffix'] in file]
-
-            # Check existing clipped images and remove the latest file, in case it is not complete
-            file_list_exist = glob('{}\\*.tif'.format(clear_prob_dir))
-            if file_list_exist:
-                item_id_list_exist = [
-                    file.split('\\')[-1].split('_{}'.format(self.asset_attrs(asset_type)['suffix']))[0]
-                    for file in file_list_exist]
-                if self.remove_latest is True:
-                    latest_file = max(file_list_exist, key=os.path.getctime)
-                    os.remove(latest_file)
-                    file_list_exist.remove(latest_file)
-                file_list = [file for file in file_list if file.split('\\')[-1].split(
-                    '_{}'.format(self.asset_attrs(asset_type)['suffix']))[0] not in item_id_list_exist]
-
-            for udm2_path in file_list:
-                clear_prob_path = clear_prob_dir + '\\' + \
-                                  udm2_path.split('\\')[-1].split('_{}'.format(self.asset_attrs('udm2')['suffix']))[
-                                      0] + '_clearprob.tif'
-                self.gdal_calc_clear_prob(input_path=udm2_path, output_path=clear_prob_path)
-            print('Finish GDAL Calculation :)')
-            print('The outputs have been saved in this directory: ' + clear_prob_dir)
+        if file_list is None:
+            file_list = []
+            for i in self.id_list_download:
+                a = glob(str(Path(input_dir) / '{}*{}.tif'.format(i, suffix)))
+                for j in a:
+                    file_list.append(j)
 
-        if output_type == 'NDVI':
-            ndvi_dir = Path(self.work_dir) / self.output_dirs['NDVI']
-            if file_list is None:
-                file_list = []
-                for i in self.id_list_download:
-                    a = glob("{}\\{}*SR.tif".format(input_dir, i))
-                    for j in a:
-                        file_list.append(j)
+        self.run_tasks(self.band_algebra_tasks(output_type, file_list), desc='Band calculation')
+
+        time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
+        print('Finish GDAL Calculation :)')
+        print('The outputs have been saved in this directory: ' + output_dir)
+        # records_file.write('The outputs have been saved in this directory: {}\n\n'.format(output_dir))
+        # records_file.write('End time: {}\n\n'.format(time_str))
+        # records_file.close()
+
+    @staticmethod
+    def period_start(date, period=None):
+        '''
+        First day of the compositing period of a date
+        :param date: datetime
+        :param period: string, 'month', 'season' (DJF, MAM, JJA, SON) or None (one period)
+        :return: datetime
+        '''
+        if period == 'month':
+            return date.replace(day=1)
+        if period == 'season':
+            month = date.month // 3 * 3
+            return date.replace(year=date.year - 1, month=12, day=1) if month == 0 else date.replace(month=month, day=1)
+        raise ValueError('Unknown compositing period: {}'.format(period))
+
+    def block_windows(self, x_size, y_size, pixel_bytes, memory_mb=None, align=64, min_blocks=1):
+        '''
+        Square blocks covering a grid, sized so that the blocks processed by the n_workers at the same time fit in a
+        memory budget
+        :param x_size: int, the number of columns
+        :param y_size: int, the number of rows
+        :param pixel_bytes: float, memory needed per pixel of a block
+        :param memory_mb: float, memory budget of all workers, a quarter of the physical memory if None
+        :param align: int, the block size is a multiple of it, e.g., the tile size of the output, see
+                      output_block_size()
+        :param min_blocks: int, smaller blocks are used if needed to have at least that many blocks
+        :return: list, windows (x offset, y offset, x size, y size)
+        '''
+        memory_mb = physical_memory_mb() / 4 if memory_mb is None else memory_mb
+        block_pixels = min(memory_mb * 1024 ** 2 / (max(1, self.n_workers) * max(1, pixel_bytes)),
+                           x_size * y_size / max(1, min_blocks))
+        block_size = int(min(max(1, 4096 // align) * align, max(align, np.sqrt(block_pixels) // align * align)))
+        return [(x0, y0, min(block_size, x_size - x0), min(block_size, y_size - y0))
+                for y0 in range(0, y_size, block_size) for x0 in range(0, x_size, block_size)]
+
+    def output_block_size(self, output_path):
+        '''
+        Tile size of a GeoTIFF output from its compression profile, 64 for outputs written in strips
+        :param output_path: string, file path of the output
+        :return: int
+        '''
+        config = self.compression_profile(output_path)
+        return config.get('block_size', 256) if config.get('tiled') else 64
+
+    def align_to_grid(self, path_list, ref_path, output_path):
+        '''
+        Images on a different grid than a reference image are aligned to it by warped VRTs next to the output
+        :param path_list: list, file paths of images
+        :param ref_path: string, file path of the reference image
+        :param output_path: string, the VRTs are temporary files of this output
+        :return: tuple, (list of aligned file paths, list of VRTs to be removed)
+        '''
+        ref_raster = gdal.Open(ref_path, gdal.GA_ReadOnly)
+        grid = (ref_raster.GetGeoTransform(), ref_raster.GetProjection(), ref_raster.RasterXSize,
+                ref_raster.RasterYSize)
+        ref_raster = None
+        aligned_list, vrt_list = [], []
+        for idx, fp in enumerate(path_list):
+            raster = gdal.Open(fp, gdal.GA_ReadOnly)
+            same_grid = (raster.GetGeoTransform(), raster.GetProjection(), raster.RasterXSize,
+                         raster.RasterYSize) == grid
+            raster = None
+            if not same_grid:
+                vrt_path = str(Path(self.temp_path(output_path, tag='align{}'.format(idx))).with_suffix('.vrt'))
+                fp = self.warped_vrt(fp, vrt_path, target_grid=ref_path)
+                vrt_list.append(vrt_path)
+            aligned_list.append(fp)
+        return aligned_list, vrt_list
+
+    @staticmethod
+    def composite_block(args):
+        '''
+        Composite of one block of a time series, observations are masked with udm2 clear (band 1), confidence (band 7)
+        and the no data of sr
+        :param args: tuple, (sr file paths, udm2 file paths, window (x offset, y offset, x size, y size), method
+                     'median', 'max_ndvi' or 'clearest', minimum udm2 confidence or None, days of the observations
+                     since the start of the period)
+        :return: tuple, (window, numpy array (5, y size, x size) UInt16, sr bands and source date, i.e., days since the
+                 start of the period + 1, 0 where there is no clear observation)
+        '''
+
+        sr_paths, udm2_paths, window, method, min_confidence, day_list = args
+        sr = np.stack([gdal.Open(fp, gdal.GA_ReadOnly).ReadAsArray(*window).reshape(-1, window[3], window[2])
+                       for fp in sr_paths])
+        clear = np.empty((len(udm2_paths), window[3], window[2]), dtype=np.uint8)
+        confidence = np.empty_like(clear)
+        for idx, fp in enumerate(udm2_paths):
+            raster = gdal.Open(fp, gdal.GA_ReadOnly)
+            clear[idx] = raster.GetRasterBand(1).ReadAsArray(*window)
+            confidence[idx] = raster.GetRasterBand(7).ReadAsArray(*window)
+            raster = None
+        valid = (clear == 1) & (sr[:, 0] > 0)
+        if min_confidence is not None:
+            valid &= confidence >= min_confidence
+        any_valid = valid.any(axis=0)
+
+        if method == 'median':
+            # float32 copy of sr, NaN where masked, the median temporaries are those of one band at a time
+            sr_float = sr.astype(np.float32)
+            np.copyto(sr_float, np.nan, where=~valid[:, None])
+            with warnings.catch_warnings():
+                # all-NaN pixels, i.e., no clear observation
+                warnings.simplefilter('ignore', RuntimeWarning)
+                value = np.stack([np.nanmedian(sr_float[:, band_idx], axis=0) for band_idx in range(sr.shape[1])])
+            # source date of the observation closest to the median, the distances are computed in place
+            sr_float -= value[None]
+            np.abs(sr_float, out=sr_float)
+            distance = np.nan_to_num(sr_float, copy=False, nan=0.).sum(axis=1)
+            distance[~valid] = np.inf
+            idx = distance.argmin(axis=0)
+            value = np.nan_to_num(np.round(value), nan=0.)
+        else:
+            if method == 'max_ndvi':
+                red, nir = sr[:, 2].astype(np.float32), sr[:, 3].astype(np.float32)
+                score = (nir - red) / np.maximum(nir + red, 1.)
+            elif method == 'clearest':
+                score = confidence.astype(np.float32)
             else:
-                file_list = [file for file in file_list if 'SR' in file]
-            for sr_path in file_list:
-                ndvi_path = Path(ndvi_dir) / sr_path.split('\\')[-1].split(
-                    '_{}'.format(self.asset_attrs('analytic_sr')['suffix']))[0] + '_ndvi.tif'
-                self.gdal_calc_ndvi(input_path=sr_path, output_path=ndvi_path)
-            time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
-            print('Finish GDAL Calculation :)')
-            print('The outputs have been saved in this directory: ' + ndvi_dir)
-            # records_file.write('The outputs have been saved in this directory: {}\n\n'.format(ndvi_dir))
-            # records_file.write('End time: {}\n\n'.format(time_str))
-            # records_file.close()
+                raise ValueError('Unknown compositing method: {}'.format(method))
+            score[~valid] = -np.inf
+            idx = score.argmax(axis=0)
+            value = np.take_along_axis(sr, idx[None, None], axis=0)[0]
+
+        output = np.zeros((sr.shape[1] + 1, window[3], window[2]), dtype=np.uint16)
+        output[:-1] = np.where(any_valid[None], value, 0)
+        output[-1] = np.where(any_valid, np.asarray(day_list, dtype=np.uint16)[idx] + 1, 0)
+        return window, output
+
+    def gdal_composite(self, sr_paths, udm2_paths, output_path, method='median', min_confidence=None,
+                       period_start=None, memory_mb=None):
+        '''
+        Composite of a time series of clipped sr and udm2 images, computed block by block in a process pool within a
+        memory budget. Images on a different grid than the first sr image are aligned to it by warped VRTs.
+        :param sr_paths: list, file paths of sr images named '[YYYYMMDD]_...'
+        :param udm2_paths: list, file paths of the udm2 images of the same scenes
+        :param output_path: string, 4 sr bands and the source date (days since period_start + 1, 0 = no data)
+        :param method: string, 'median', 'max_ndvi' or 'clearest' (highest udm2 confidence)
+        :param min_confidence: int, minimum udm2 confidence (band 7) of an observation, 0 - 100
+        :param period_start: string, 'YYYYMMDD', the date of the first image if None
+        :param memory_mb: float, memory budget of all workers, a quarter of the physical memory if None
+        :return:
+        '''
+
+        date_list = [datetime.strptime(Path(fp).name.split('_')[0], '%Y%m%d') for fp in sr_paths]
+        period_start = min(date_list) if period_start is None else datetime.strptime(period_start, '%Y%m%d')
+        day_list = [(date - period_start).days for date in date_list]
+
+        ref_raster = gdal.Open(sr_paths[0], gdal.GA_ReadOnly)
+        x_size, y_size, n_band = ref_raster.RasterXSize, ref_raster.RasterYSize, ref_raster.RasterCount
+        geo_transform, projection = ref_raster.GetGeoTransform(), ref_raster.GetProjection()
+        ref_raster = None
+
+        # ~40 bytes per observation and pixel (sr, udm2, masks, the float32 copy of sr and the median of one band)
+        window_list = self.block_windows(x_size, y_size, len(sr_paths) * 40, memory_mb,
+                                         align=self.output_block_size(output_path), min_blocks=2 * self.n_workers)
+        vrt_list = []
+        try:
+            aligned_list, vrt_list = self.align_to_grid(sr_paths + udm2_paths, sr_paths[0], output_path)
+            sr_paths, udm2_paths = aligned_list[:len(sr_paths)], aligned_list[len(sr_paths):]
+            args_list = [(sr_paths, udm2_paths, window, method, min_confidence, day_list) for window in window_list]
+            driver = gdal.GetDriverByName('GTiff')
+            with self.atomic_output(output_path) as temp_path:
+                out_raster = driver.Create(temp_path, x_size, y_size, n_band + 1, gdal.GDT_UInt16,
+                                           options=self.creation_options(output_path))
+                out_raster.SetGeoTransform(geo_transform)
+                out_raster.SetProjection(projection)
+                out_raster.SetMetadata({'METHOD': method, 'PERIOD_START': period_start.strftime('%Y%m%d'),
+                                        'N_OBSERVATIONS': str(len(sr_paths))})
+                for band_idx in range(n_band + 1):
+                    out_raster.GetRasterBand(band_idx + 1).SetNoDataValue(0)
+                out_raster.GetRasterBand(n_band + 1).SetDescription(
+                    'source date, days since {} + 1'.format(period_start.strftime('%Y%m%d')))
+                with self.worker_pool() as pool:
+                    for (x0, y0, _, _), output in pool.imap_unordered(self.composite_block, args_list):
+                        for band_idx in range(n_band + 1):
+                            out_raster.GetRasterBand(band_idx + 1).WriteArray(output[band_idx], x0, y0)
+                out_raster = None
+        finally:
+            list([os.remove(fp) for fp in vrt_list if os.path.exists(fp)])
+
+    @track_stage
+    def composite(self, file_list=None, start_date=None, end_date=None, method='median', period=None,
+                  min_confidence=None, memory_mb=None):
+        '''
+        Cloud free temporal composites of the clipped sr images, e.g., monthly median or seasonal max-NDVI composites
+        saved as [work_dir]/composite/[method]_[start]_[end].tif
+        :param file_list: list, file paths of clipped sr images, the udm2 images are found by their suffix
+        :param start_date: string, 'YYYYMMDD' or 'YYYY-MM-DD', images before are ignored
+        :param end_date: string, 'YYYYMMDD' or 'YYYY-MM-DD', images after are ignored
+        :param method: string, 'median', 'max_ndvi' or 'clearest', see composite_block()
+        :param period: string, 'month', 'season' or None (one composite of all images)
+        :param min_confidence: int, minimum udm2 confidence of an observation, 0 - 100
+        :param memory_mb: float, memory budget of the workers, see gdal_composite()
+        :return: list, file paths of the composites
+        '''
+
+        sr_suffix, udm2_suffix = self.asset_attrs('analytic_sr')['suffix'], self.asset_attrs('udm2')['suffix']
+        file_list = self.stage_inputs('composite') if file_list is None else file_list
+        start_date = start_date.replace('-', '') if start_date is not None else '00000000'
+        end_date = end_date.replace('-', '') if end_date is not None else '99999999'
+        group_dict = {}
+        for sr_path in sorted(file_list):
+            date = Path(sr_path).name.split('_')[0]
+            udm2_path = sr_path.replace(sr_suffix, udm2_suffix)
+            if sr_suffix not in Path(sr_path).name or not start_date <= date <= end_date or \
+                    not os.path.exists(udm2_path):
+                continue
+            key = self.period_start(datetime.strptime(date, '%Y%m%d'), period).strftime('%Y%m%d') \
+                if period is not None else None
+            group_dict.setdefault(key, []).append((sr_path, udm2_path))
+
+        output_dir = self.stage_dir('composite')
+        self.create_dir(output_dir)
+        task_list = []
+        for key, pair_list in sorted(group_dict.items(), key=lambda item: str(item[0])):
+            sr_paths, udm2_paths = [list(paths) for paths in zip(*pair_list)]
+            first, last = Path(sr_paths[0]).name.split('_')[0], Path(sr_paths[-1]).name.split('_')[0]
+            output_path = str(output_dir / '{}_{}_{}.tif'.format(method, key or first, last))
+            task_list.append(Task('composite', output_path, sr_paths + udm2_paths,
+                                  {'method': method, 'min_confidence': min_confidence, 'period_start': key,
+                                   'creation_options': self.creation_options(output_path)}, 'gdal_composite',
+                                  {'sr_paths': sr_paths, 'udm2_paths': udm2_paths, 'output_path': output_path,
+                                   'method': method, 'min_confidence': min_confidence, 'period_start': key,
+                                   'memory_mb': memory_mb}))
+        self.run_tasks(task_list, desc='Compositing')
+        return [task.output_path for task in task_list]
+
+    @staticmethod
+    def savgol_coeffs(window, order):
+        '''
+        Savitzky-Golay smoothing coefficients, least squares fit of a polynomial to a centred window
+        :param window: int, odd number of samples
+        :param order: int, polynomial order, smaller than window
+        :return: numpy array, (window,)
+        '''
+        half = window // 2
+        vander = np.vander(np.arange(-half, half + 1, dtype=np.float64), order + 1, increasing=True)
+        return np.linalg.pinv(vander)[0]
+
+    @staticmethod
+    def gap_fill_block(args):
+        '''
+        Daily gap filled NDVI of one block, all pixels are interpolated at once. Observations are masked with udm2 clear
+        (band 1), confidence (band 7) and the no data of sr, observations of the same day are averaged.
+        :param args: tuple, (observations, window (x offset, y offset, x size, y size), days of the observations since
+                     the start, the number of output days, method 'linear' or 'savgol', Savitzky-Golay window (days)
+                     and order, minimum udm2 confidence or None, step between output days).
+                     An observation is (sr path, index of its first sr band, udm2 path, index of its first udm2 band),
+                     1-based, so that images and band sequential stacks are read alike.
+        :return: tuple, (window, numpy array (output days, y size, x size) Int16, NDVI * 10000, -32768 = no data)
+        '''
 
+        obs_list, window, day_list, n_days, method, sg_window, sg_order, min_confidence, step = args
+        x_size, y_size = window[2], window[3]
+        day_array, obs_day_idx = np.unique(np.asarray(day_list), return_inverse=True)
+        ndvi_sum = np.zeros((len(day_array), y_size * x_size), dtype=np.float32)
+        ndvi_count = np.zeros((len(day_array), y_size * x_size), dtype=np.uint16)
+        for (sr_path, sr_band, udm2_path, udm2_band), day_idx in zip(obs_list, obs_day_idx):
+            sr_raster, udm2_raster = gdal.Open(sr_path, gdal.GA_ReadOnly), gdal.Open(udm2_path, gdal.GA_ReadOnly)
+            red = sr_raster.GetRasterBand(sr_band + 2).ReadAsArray(*window).astype(np.float32).ravel()
+            nir = sr_raster.GetRasterBand(sr_band + 3).ReadAsArray(*window).astype(np.float32).ravel()
+            valid = (udm2_raster.GetRasterBand(udm2_band).ReadAsArray(*window).ravel() == 1) & (nir > 0)
+            if min_confidence is not None:
+                valid &= udm2_raster.GetRasterBand(udm2_band + 6).ReadAsArray(*window).ravel() >= min_confidence
+            sr_raster, udm2_raster = None, None
+            ndvi_sum[day_idx] += np.where(valid, (nir - red) / np.maximum(nir + red, 1.), 0.)
+            ndvi_count[day_idx] += valid
+
+        # daily series, NaN on days without a clear observation
+        daily = np.full((n_days, y_size * x_size), np.nan, dtype=np.float32)
+        in_range = (day_array >= 0) & (day_array < n_days)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            daily[day_array[in_range]] = ndvi_sum[in_range] / ndvi_count[in_range]
+        valid = ~np.isnan(daily)
+
+        # linear interpolation between the previous and next observation of each day, nearest one at the ends, with
+        # int32 indices and float32 values updated in place
+        day_index = np.arange(n_days, dtype=np.int32)[:, None]
+        prev_idx = np.where(valid, day_index, np.int32(-1))
+        np.maximum.accumulate(prev_idx, axis=0, out=prev_idx)
+        next_idx = np.where(valid, day_index, np.int32(n_days))
+        np.minimum.accumulate(next_idx[::-1], axis=0, out=next_idx[::-1])
+        del valid
+        np.copyto(prev_idx, next_idx, where=prev_idx < 0)
+        np.copyto(next_idx, prev_idx, where=next_idx >= n_days)
+        np.clip(prev_idx, 0, n_days - 1, out=prev_idx)
+        np.clip(next_idx, 0, n_days - 1, out=next_idx)
+        pixel_index = np.arange(daily.shape[1])[None, :]
+        filled, next_value = daily[prev_idx, pixel_index], daily[next_idx, pixel_index]
+        weight = (day_index - prev_idx).astype(np.float32)
+        next_idx -= prev_idx
+        weight /= np.maximum(next_idx, 1)
+        weight[next_idx <= 0] = 0.
+        del prev_idx, next_idx
+        next_value -= filled
+        next_value *= weight
+        filled += next_value
+        del next_value, weight
+
+        if method == 'savgol':
+            coeffs = Utilities.savgol_coeffs(sg_window, sg_order)
+            half = sg_window // 2
+            padded = np.concatenate([np.repeat(filled[:1], half, axis=0), filled, np.repeat(filled[-1:], half, axis=0)])
+            filled = np.zeros_like(filled)
+            for k, coeff in enumerate(coeffs):
+                filled += np.float32(coeff) * padded[k:k + n_days]
+        elif method != 'linear':
+            raise ValueError('Unknown gap filling method: {}'.format(method))
+
+        filled = filled[::step]
+        output = np.round(filled.clip(-1, 1) * np.float32(10000))
+        output[np.isnan(filled)] = -32768
+        return window, output.astype(np.int16).reshape(-1, y_size, x_size)
+
+    def gdal_gap_fill(self, obs_list, date_list, output_path, start_date, end_date, method='linear', sg_window=15,
+                      sg_order=2, min_confidence=None, step=1, memory_mb=None):
+        '''
+        Gap filled NDVI time series, computed block by block in a process pool within a memory budget. Each band is one
+        day from start_date with a step of step days, the band descriptions are the dates.
+        :param obs_list: list, observations, see gap_fill_block()
+        :param date_list: list, dates of the observations 'YYYYMMDD'
+        :param output_path: string
+        :param start_date: string, 'YYYYMMDD', first day of the series
+        :param end_date: string, 'YYYYMMDD', last day of the series
+        :param method: string, 'linear' or 'savgol' (linear interpolation smoothed with a Savitzky-Golay filter)
+        :param sg_window: int, odd window of the Savitzky-Golay filter in days
+        :param sg_order: int, polynomial order of the Savitzky-Golay filter
+        :param min_confidence: int, minimum udm2 confidence of an observation, 0 - 100
+        :param step: int, days between the output bands
+        :param memory_mb: float, memory budget of all workers, a quarter of the physical memory if None
+        :return:
+        '''
+
+        start = datetime.strptime(start_date, '%Y%m%d')
+        n_days = (datetime.strptime(end_date, '%Y%m%d') - start).days + 1
+        day_list = [(datetime.strptime(date, '%Y%m%d') - start).days for date in date_list]
+        output_dates = [(start + timedelta(days=day)).strftime('%Y%m%d') for day in range(0, n_days, step)]
+
+        ref_raster = gdal.Open(obs_list[0][0], gdal.GA_ReadOnly)
+        x_size, y_size = ref_raster.RasterXSize, ref_raster.RasterYSize
+        geo_transform, projection = ref_raster.GetGeoTransform(), ref_raster.GetProjection()
+        ref_raster = None
+
+        # ~40 bytes per day and pixel (daily series, int32 interpolation indices, float32 values and weights)
+        window_list = self.block_windows(x_size, y_size, n_days * 40 + len(obs_list) * 8, memory_mb,
+                                         align=self.output_block_size(output_path), min_blocks=2 * self.n_workers)
+        vrt_list = []
+        try:
+            path_list = sorted(set([obs[0] for obs in obs_list] + [obs[2] for obs in obs_list]))
+            aligned_list, vrt_list = self.align_to_grid(path_list, obs_list[0][0], output_path)
+            aligned_dict = dict(zip(path_list, aligned_list))
+            obs_list = [(aligned_dict[sr_path], sr_band, aligned_dict[udm2_path], udm2_band)
+                        for sr_path, sr_band, udm2_path, udm2_band in obs_list]
+            args_list = [(obs_list, window, day_list, n_days, method, sg_window, sg_order, min_confidence, step)
+                         for window in window_list]
+            driver = gdal.GetDriverByName('GTiff')
+            with self.atomic_output(output_path) as temp_path:
+                out_raster = driver.Create(temp_path, x_size, y_size, len(output_dates), gdal.GDT_Int16,
+                                           options=self.creation_options(output_path))
+                out_raster.SetGeoTransform(geo_transform)
+                out_raster.SetProjection(projection)
+                out_raster.SetMetadata({'METHOD': method, 'SCALE': '10000', 'DATES': ','.join(output_dates)})
+                for band_idx, date in enumerate(output_dates):
+                    out_raster.GetRasterBand(band_idx + 1).SetNoDataValue(-32768)
+                    out_raster.GetRasterBand(band_idx + 1).SetDescription(date)
+                with self.worker_pool() as pool:
+                    for (x0, y0, _, _), output in tqdm(pool.imap_unordered(self.gap_fill_block, args_list),
+                                                       total=len(args_list), unit="block", desc='Gap filling'):
+                        for band_idx in range(len(output_dates)):
+                            out_raster.GetRasterBand(band_idx + 1).WriteArray(output[band_idx], x0, y0)
+                out_raster = None
+        finally:
+            list([os.remove(fp) for fp in vrt_list if os.path.exists(fp)])
+
+    @track_stage
+    def gap_fill(self, file_list=None, start_date=None, end_date=None, method='linear', sg_window=15, sg_order=2,
+                 min_confidence=None, step=1, stack_dir=None, memory_mb=None):
+        '''
+        Daily gap filled and smoothed NDVI time series for phenology, from the clipped sr/udm2 images or from the
+        stacks of prep_pipline(), saved as [work_dir]/NDVI/NDVI_[method]_[start]_[end].tif
+        :param file_list: list, file paths of clipped sr images, the udm2 images are found by their suffix
+        :param start_date: string, 'YYYYMMDD' or 'YYYY-MM-DD', first day of the series, the first image if None
+        :param end_date: string, 'YYYYMMDD' or 'YYYY-MM-DD', last day of the series, the last image if None
+        :param method: string, 'linear' or 'savgol', see gap_fill_block()
+        :param sg_window: int, odd window of the Savitzky-Golay filter in days
+        :param sg_order: int, polynomial order of the Savitzky-Golay filter
+        :param min_confidence: int, minimum udm2 confidence of an observation, 0 - 100
+        :param step: int, days between the output bands, e.g., 5 for a 5-day series
+        :param stack_dir: string, output folder of prep_pipline() run with the same start_date and end_date, its
+                          stacks are used instead of the clipped images
+        :param memory_mb: float, memory budget of the workers, see gdal_gap_fill()
+        :return: string, file path of the output
+        '''
+
+        if method == 'savgol' and (sg_window % 2 == 0 or sg_order >= sg_window):
+            raise ValueError('sg_window must be odd and larger than sg_order')
+        sr_suffix, udm2_suffix = self.asset_attrs('analytic_sr')['suffix'], self.asset_attrs('udm2')['suffix']
+        start_date = start_date.replace('-', '') if start_date is not None else None
+        end_date = end_date.replace('-', '') if end_date is not None else None
+        obs_list, date_list = [], []
+        if stack_dir is not None:
+            stack_name = 'PS_{}_stack_{}_{}.tif'
+            with open(os.path.join(stack_dir, f'PS_stack_dates_{start_date}_{end_date}.txt'), 'r') as txt:
+                date_list = [date for date in txt.read().split(',') if date]
+            sr_stack = os.path.join(stack_dir, stack_name.format(sr_suffix, start_date, end_date))
+            udm2_stack = os.path.join(stack_dir, stack_name.format(udm2_suffix, start_date, end_date))
+            obs_list = [(sr_stack, idx * 4 + 1, udm2_stack, idx * 8 + 1) for idx in range(len(date_list))]
+        else:
+            file_list = self.stage_inputs('gap fill') if file_list is None else file_list
+            for sr_path in sorted(file_list):
+                date = Path(sr_path).name.split('_')[0]
+                udm2_path = sr_path.replace(sr_suffix, udm2_suffix)
+                if sr_suffix not in Path(sr_path).name or not os.path.exists(udm2_path) or \
+                        (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+                    continue
+                obs_list.append((sr_path, 1, udm2_path, 1))
+                date_list.append(date)
+        if not obs_list:
+            print('No images to gap fill')
+            return None
+        start_date = min(date_list) if start_date is None else start_date
+        end_date = max(date_list) if end_date is None else end_date
+
+        output_dir = self.stage_dir('NDVI')
+        self.create_dir(output_dir)
+        output_path = str(output_dir / 'NDVI_{}_{}_{}.tif'.format(method, start_date, end_date))
+        params = {'method': method, 'sg_window': sg_window, 'sg_order': sg_order, 'min_confidence': min_confidence,
+                  'step': step, 'creation_options': self.creation_options(output_path)}
+        input_paths = sorted(set([obs[0] for obs in obs_list] + [obs[2] for obs in obs_list]))
+        kwargs = {'obs_list': obs_list, 'date_list': date_list, 'output_path': output_path, 'start_date': start_date,
+                  'end_date': end_date, 'method': method, 'sg_window': sg_window, 'sg_order': sg_order,
+                  'min_confidence': min_confidence, 'step': step, 'memory_mb': memory_mb}
+        self.run_tasks([Task('gap fill', output_path, input_paths, params, 'gdal_gap_fill', kwargs)],
+                       desc='Gap filling')
+        return output_path
+
+    @track_stage
     def stack_as_nc(self, input_dir, output_dir, output_name, ref_image, base_date='19000101', date_list=None,
                     input_suffix=None, udm2=None, udm2_suffix=None, ref_udm2=None, proj=True):
         """
@@ -970,6 +2877,8 @@ class Utilities:
         :return:
         """
 
+        import netCDF4
+
         print('Start!')
         if udm2_suffix is None:
             udm2_suffix = ''
@@ -1006,7 +2915,10 @@ class Utilities:
         basedate = datetime.strptime(base_date, '%Y-%m-%d')
 
         # create NetCDF file
-        nco = netCDF4.Dataset(str(Path(output_dir) / output_name), 'w', clobber=True)
+        # written under a temporary name and renamed when complete
+        output_path = str(Path(output_dir) / output_name)
+        temp_output_path = self.temp_path(output_path)
+        nco = netCDF4.Dataset(temp_output_path, 'w', clobber=True)
 
         # chunking is optional, but can improve access a lot:
         # (see: http://www.unidata.ucar.edu/blogs/developer/entry/chunking_data_choosing_shapes)
@@ -1038,8 +2950,8 @@ class Utilities:
         # create variable for surface reflectance, quality layers, and additional information (metadata), with chunking
         def create_variables(var, name, fmt, dims=('time', 'y', 'x'), chunksizes=[chunk_time, chunk_y, chunk_x],
                              fill_value=None, least_significant_digit=None):
-            out = nco.createVariable(var, fmt, dims, chunksizes=chunksizes, zlib=True,
-                                     fill_value=fill_value, least_significant_digit=least_significant_digit)
+            out = nco.createVariable(var, fmt, dims, chunksizes=chunksizes, fill_value=fill_value,
+                                     least_significant_digit=least_significant_digit, **self.netcdf_compression())
             out.standard_name = name
             return out
 
@@ -1092,9 +3004,10 @@ class Utilities:
 
         list(map(func, tqdm(date_orbit_list, total=len(date_orbit_list), unit='file', desc='tif_to_netCDF')))
 
+        nco.close()
+        os.replace(temp_output_path, output_path)
         print('Done!')
         print('Check your output: ' + output_dir)
-        nco.close()
 
     # def gdal_vrtmerge(self, out_filename, data_type, input_file_list, separate=False):
     #     # has bugs to be fixed
@@ -1127,13 +3040,14 @@ class Utilities:
         merge two images based on cloud probability in udm2
         :param input_path0:a
         :param input_path1:
-        :param output_path:
-        :return:
+        :param output_path: string, a temporary file next to input_path0 if None
+        :return: string, output_path
         """
 
-        # mask individual image
-        masked_img0 = 'TempFile0.tif'
-        masked_img1 = 'TempFile1.tif'
+        # the output and the masked images are temporary files next to the output, or next to input_path0
+        output_path = self.temp_path(input_path0, tag='merge') if output_path is None else output_path
+        masked_img0 = self.temp_path(output_path, tag='masked0')
+        masked_img1 = self.temp_path(output_path, tag='masked1')
         cal_exp0 = '"Y*(logical_or(' \
                    'logical_and(logical_and((A*B*C*D*E*F*G*H*I*J*K*L)!=1, (A+B+C+D+E+F+G+H+I+J+K+L)!=0), logical_and((E*K+Q*W)==0, K>=W)), ' \
                    'logical_and((A*B*C*D*E*F*G*H*I*J*K*L)!=1, logical_and((E*K+Q*W)>0, (E*K)>=(Q*W)))' \
@@ -1148,42 +3062,42 @@ class Utilities:
         str1 = ' '.join(
             ["-{} {} --{}_band {}".format(string.ascii_uppercase[i+12], '{3}', string.ascii_uppercase[i+12], i + 1) for i in
              list(range(12))])
-        gdal_calc_str = 'python {0} --calc {1} -Y {2} -Z {3} --allBands {4} --outfile {5} --co "COMPRESS=LZW" ' \
-                        '--overwrite' + ' ' + str0 + ' ' + str1
-
-        for (current_img, cal_exp, masked_img) in list(zip(['Y', 'Z'], [cal_exp0, cal_exp1],
-                                                            [masked_img0, masked_img1])):
-            gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, cal_exp, input_path0, input_path1,
-                                                     current_img, masked_img)
-            os.system(gdal_calc_process)
-
-        # merge images
-        input_file_list = [masked_img0, masked_img1]
-        temp_filepath = 'TempFile.tif'
-        output_path = temp_filepath if output_path is None else output_path
-        gdal_merge_str = 'python {0} -n 0.0 -o {1} {2} -co COMPRESS=LZW'
-        gdal_merge_process = gdal_merge_str.format(self.gdal_merge_path, output_path, ' '.join(input_file_list))
-        os.system(gdal_merge_process)
-        list([os.remove(fp) for fp in [masked_img0, masked_img1]])
-        if output_path != temp_filepath and os.path.exists(temp_filepath):
-            os.remove(temp_filepath)
+        # the masked images are intermediate, not compressed
+        gdal_calc_str = 'python {0} --calc {1} -Y {2} -Z {3} --allBands {4} --outfile {5} ' + \
+                        self.creation_option_args(self.creation_options(output_path, 'NONE'), '--co') + \
+                        ' --overwrite' + ' ' + str0 + ' ' + str1
+
+        try:
+            for (current_img, cal_exp, masked_img) in list(zip(['Y', 'Z'], [cal_exp0, cal_exp1],
+                                                                [masked_img0, masked_img1])):
+                gdal_calc_process = gdal_calc_str.format(self.gdal_calc_path, cal_exp, input_path0, input_path1,
+                                                         current_img, masked_img)
+                self.run_command(gdal_calc_process)
+
+            # merge images
+            input_file_list = [masked_img0, masked_img1]
+            self.gdal_merge(' '.join(input_file_list), output_path, data_type=None, nodata=0.0)
+        finally:
+            list([os.remove(fp) for fp in [masked_img0, masked_img1] if os.path.exists(fp)])
         return output_path
 
     def iterative_merge(self, input_file_list, output_path):
         """merge images acquired in the same day based on cloud probability in udm2"""
 
-        if len(input_file_list) == 2:
-            self.complex_gdal_merge(input_file_list[0], input_file_list[1], output_path)
-        else:
-            temp_filepath = self.complex_gdal_merge(input_file_list[0], input_file_list[1])
-            for idx, fp in enumerate(input_file_list[2:]):
-                if idx != len(input_file_list[2:]) - 1:
-                    self.complex_gdal_merge(temp_filepath, fp)
-                else:
-                    self.complex_gdal_merge(temp_filepath, fp, output_path)
-
+        # the images are merged one after the other through temporary files next to the output
+        temp_list = []
+        try:
+            merged_path = input_file_list[0]
+            for idx, fp in enumerate(input_file_list[1:-1]):
+                temp_list.append(self.temp_path(output_path, tag='merge{}'.format(idx)))
+                merged_path = self.complex_gdal_merge(merged_path, fp, temp_list[-1])
+            self.complex_gdal_merge(merged_path, input_file_list[-1], output_path)
+        finally:
+            list([os.remove(fp) for fp in temp_list if os.path.exists(fp)])
+
+    @track_stage
     def prep_pipline(self, input_dir, output_dir, start_date, end_date, crs=None,  jp2=True, clean=True,
-                     complex_merge=None):
+                     complex_merge=None, temp_dir=None, target_grid=None, resample_alg='near', patch_size=None):
         """
         Prepare input datasets for the deep learning models.
         1. (prerequisite) download raw tiles, i.e., no clipping <- planetmosaic python project.
@@ -1193,20 +3107,32 @@ class Utilities:
         5. merge stacked images in the same day (regardless of orbits).
         6. separate sr and udm2.
         7. stack image time series into one file for sr and udm2 independently (in sequence of acquisition date), and save time stamps into a pickle file.
-        8. (optional) convert CRS and data format.
+        8. (optional) convert CRS and data format. The CRS is converted on the fly by warped VRTs of the images of each
+        day (step 6), which are stacked in step 7 without writing reprojected copies.
         :param input_dir:
         :param output_dir:
         :param start_date:
         :param end_date:
+        :param crs: string, target spatial reference, e.g., 'EPSG:4326', the CRS of the inputs if None. Without
+                    target_grid, the images of all days are warped to one grid, see common_grid()
         :param jp2:
+        :param temp_dir: string, folder for the intermediate outputs, the work directory if None
+        :param target_grid: string or dictionary, the outputs are aligned to the grid of a reference image (file path)
+                            or to {'pixel_res': float or (x, y), 'bounds': (min x, min y, max x, max y)}, bounds are
+                            optional, pixels are aligned to multiples of pixel_res, see warp_options()
+        :param resample_alg: string, resampling of sr when reprojected, e.g., 'bilinear', udm2 is always resampled
+                             with 'near'
+        :param patch_size: int, the stacks are also exported to a memory-mapped patch store of this patch size in
+                           [output_dir]/patches, see export_patch_store()
         :return:
         """
         # To be updated: use multiprocessing and on-the-fly processes
 
         # create folders
-        sr_udm2_dir = '/mnt/raid5/Planet/pre_processed/Sierra_Nevada_AOI1/stack_sr_udm2'
-        merge_orbit_dir = '/mnt/raid5/Planet/pre_processed/Sierra_Nevada_AOI1/merge_combine_orbits'
-        merge_orbit_sep_dir = '/mnt/raid5/Planet/pre_processed/Sierra_Nevada_AOI1/merge_orbits_sr_udm2'
+        temp_dir = self.work_dir if temp_dir is None else temp_dir
+        sr_udm2_dir = os.path.join(temp_dir, 'stack_sr_udm2')
+        merge_orbit_dir = os.path.join(temp_dir, 'merge_combine_orbits')
+        merge_orbit_sep_dir = os.path.join(temp_dir, 'merge_orbits_sr_udm2')
         folder_list = [output_dir, sr_udm2_dir, merge_orbit_dir, merge_orbit_sep_dir]
         for folder_path in folder_list:
             if not os.path.exists(folder_path):
@@ -1219,13 +3145,26 @@ class Utilities:
         date0 = None
         orbit_list = []
         date_list = []
+        # images of each day are stacked through warped VRTs when reprojected
+        warp = crs is not None or target_grid is not None
+        if crs is not None and target_grid is None:
+            # one grid for all days, otherwise each day gets the extent and pixel size of its own warp
+            target_grid = self.common_grid([glob(os.path.join(input_dir, f'{date}_{orbit}*AnalyticMS_SR*.tif'))[0]
+                                            for date, orbit in date_orbit_list], crs)
+        # intermediates are VRTs and only the final stacks are written with virtual_intermediates
+        virtual = self.virtual_intermediates is True
+        ext = 'vrt' if virtual else 'tif'
+        sep_ext = 'vrt' if warp else 'tif'
         for idx, (date, orbit) in enumerate(date_orbit_list[:]):
             # stack sr and udm2 with the same date and orbit into one image.
-            self.gdal_merge(input_path=' '.join(
-                [glob(os.path.join(input_dir, f'{date}_{orbit}*AnalyticMS_SR*.tif'))[0],
-                 glob(os.path.join(input_dir, f'{date}_{orbit}*udm2*.tif'))[0]]),
-                output_path=os.path.join(sr_udm2_dir, f"{date}_{orbit}.tif"), data_type='UInt16',
-                separate=True, compression='LZW')
+            path_list = [glob(os.path.join(input_dir, f'{date}_{orbit}*AnalyticMS_SR*.tif'))[0],
+                         glob(os.path.join(input_dir, f'{date}_{orbit}*udm2*.tif'))[0]]
+            if virtual is True:
+                self.stack_vrt(path_list, os.path.join(sr_udm2_dir, f"{date}_{orbit}.vrt"), 'UInt16')
+            else:
+                self.gdal_merge(input_path=' '.join(path_list),
+                                output_path=os.path.join(sr_udm2_dir, f"{date}_{orbit}.tif"), data_type='UInt16',
+                                separate=True, compression='NONE')
 
             if idx == len(date_orbit_list):
                 date0 = date
@@ -1233,41 +3172,48 @@ class Utilities:
 
             if (date0 is not None) and (not date0 == date):
                 # merge images in the same day regardless of orbits.
-                input_file_list = [os.path.join(sr_udm2_dir, f'{date0}_{orbit}.tif') for orbit in orbit_list]
+                input_file_list = [os.path.join(sr_udm2_dir, f'{date0}_{orbit}.{ext}') for orbit in orbit_list]
+                merge_orbit_path = os.path.join(merge_orbit_dir, f'{date0}.{ext}')
                 if complex_merge is True and len(input_file_list) >= 2:
-                    self.iterative_merge(input_file_list=input_file_list,
-                                         output_path=os.path.join(merge_orbit_dir, f'{date0}.tif'))
+                    # gdal_calc.py, written to disk
+                    merge_orbit_path = os.path.join(merge_orbit_dir, f'{date0}.tif')
+                    self.iterative_merge(input_file_list=input_file_list, output_path=merge_orbit_path)
+                elif virtual is True:
+                    self.gdal_mosaic_vrt(input_file_list, merge_orbit_path)
                 else:
                     self.gdal_merge(
                         input_path=' '.join(input_file_list),
-                        output_path=os.path.join(merge_orbit_dir, f'{date0}.tif'), data_type='UInt16', separate=False,
-                        compression='LZW')
+                        output_path=merge_orbit_path, data_type='UInt16', separate=False,
+                        compression='NONE')
                 orbit_list = []
                 date_list.append(date0)
-                # split sr and udm2
-                translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine("-b 1 -b 2 -b 3 -b 4 -of Gtiff "
-                                                                               "-co COMPRESS=LZW -ot UInt16"))
-                gdal.Translate(os.path.join(merge_orbit_sep_dir, f'{date0}_AnalyticMS_SR.tif'),
-                               os.path.join(merge_orbit_dir, f'{date0}.tif'), options=translateoptions)
-                translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine("-b 5 -b 6 -b 7 -b 8 -b 9 -b 10 -b 11 "
-                                                                               "-b 12 -of Gtiff -co COMPRESS=LZW "
-                                                                               "-ot Byte"))
-                gdal.Translate(os.path.join(merge_orbit_sep_dir, f'{date0}_udm2.tif'),
-                               os.path.join(merge_orbit_dir, f'{date0}.tif'), options=translateoptions)
-                # stack all images into one file for both sr and udm2
-                if len(date_list) == 1:
+                # split sr and udm2, intermediate outputs are not compressed
+                for asset_type, band_list, output_type in [('analytic_sr', [1, 2, 3, 4], gdal.GDT_UInt16),
+                                                           ('udm2', [5, 6, 7, 8, 9, 10, 11, 12], gdal.GDT_Byte)]:
+                    sep_path = os.path.join(merge_orbit_sep_dir, f'{date0}_{self.asset_attrs(asset_type)["suffix"]}')
+                    # the split VRT is named apart from the warped one
+                    split_path = (sep_path + ('_split.vrt' if warp else '.vrt')) if virtual else sep_path + '.tif'
+                    translateoptions = gdal.TranslateOptions(
+                        bandList=band_list, format='VRT' if virtual else 'GTiff', outputType=output_type,
+                        creationOptions=[] if virtual else self.creation_options(compression='NONE'))
+                    gdal.Translate(split_path, merge_orbit_path, options=translateoptions)
+                    if warp is True:
+                        self.warped_vrt(split_path, sep_path + '.vrt', crs, target_grid,
+                                        resample_alg if asset_type == 'analytic_sr' else 'near')
+                # stack all images into one file for both sr and udm2, at once at the end with virtual_intermediates
+                if virtual is False and len(date_list) == 1:
                     list([self.gdal_merge(
-                        input_path=os.path.join(merge_orbit_sep_dir, f'{date_list[0]}_{self.asset_attrs(asset_type)["suffix"]}.tif'),
+                        input_path=os.path.join(merge_orbit_sep_dir, f'{date_list[0]}_{self.asset_attrs(asset_type)["suffix"]}.{sep_ext}'),
                         output_path=os.path.join(output_dir, f'stack0_{self.asset_attrs(asset_type)["suffix"]}.tif'),
                         data_type=self.asset_attrs(asset_type)['data type'],
-                        separate=True, compression='LZW') for asset_type in ['analytic_sr', 'udm2']])
-                elif len(date_list) > 1:
+                        separate=True, compression='NONE') for asset_type in ['analytic_sr', 'udm2']])
+                elif virtual is False and len(date_list) > 1:
                     list([self.gdal_merge(
                         input_path=' '.join([os.path.join(output_dir, f'stack0_{self.asset_attrs(asset_type)["suffix"]}.tif'),
-                                             os.path.join(merge_orbit_sep_dir, f'{date_list[-1]}_{self.asset_attrs(asset_type)["suffix"]}.tif')]),
+                                             os.path.join(merge_orbit_sep_dir, f'{date_list[-1]}_{self.asset_attrs(asset_type)["suffix"]}.{sep_ext}')]),
                         output_path=os.path.join(output_dir, f'stack_{self.asset_attrs(asset_type)["suffix"]}.tif'),
                         data_type=self.asset_attrs(asset_type)['data type'],
-                        separate=True, compression='LZW') for asset_type in ['analytic_sr', 'udm2']])
+                        separate=True, compression='NONE') for asset_type in ['analytic_sr', 'udm2']])
                     # delete stack0.tif
                     list([os.remove(os.path.join(output_dir, f'stack0_{self.asset_attrs(asset_type)["suffix"]}.tif'))
                           for asset_type in ['analytic_sr', 'udm2']])
@@ -1284,42 +3230,478 @@ class Utilities:
             for date in date_list:
                 txt.write(date + ",")
 
+        # the stacks are compressed once, when written to their final name, from the uncompressed stack0 or, with
+        # virtual_intermediates, in one pass through a stack VRT. They are left uncompressed when they are encoded
+        # to JPEG2000 and deleted right after.
+        for asset_type in ['analytic_sr', 'udm2']:
+            suffix = self.asset_attrs(asset_type)['suffix']
+            if virtual is True:
+                stack_path = self.stack_vrt(
+                    [os.path.join(merge_orbit_sep_dir, f'{date}_{suffix}.vrt') for date in date_list],
+                    os.path.join(merge_orbit_sep_dir, f'stack_{suffix}.vrt'), self.asset_attrs(asset_type)['data type'])
+            else:
+                stack_path = os.path.join(output_dir, f'stack0_{suffix}.tif')
+            output_path = os.path.join(output_dir, f'PS_{suffix}_stack_{start_date}_{end_date}.tif')
+            with self.atomic_output(output_path) as temp_path:
+                out_raster = gdal.Translate(temp_path, stack_path, format='GTiff', creationOptions=self.creation_options(
+                    output_path, 'NONE' if jp2 is True else None))
+                if out_raster is None:
+                    raise RuntimeError('Failed to write {}'.format(output_path))
+                out_raster = None
+            if virtual is False:
+                os.remove(stack_path)
+
         # delete temporary datasets and folders
         if clean is True:
             list([shutil.rmtree(i) for i in [sr_udm2_dir, merge_orbit_dir, merge_orbit_sep_dir]])
-        # rename
-        list([os.rename(
-            os.path.join(output_dir, f'stack0_{self.asset_attrs(asset_type)["suffix"]}.tif'),
-            os.path.join(output_dir, f'PS_{self.asset_attrs(asset_type)["suffix"]}_stack_{start_date}_{end_date}.tif')
-        ) for asset_type in ['analytic_sr', 'udm2']])
 
-        # change coordinate system
-        if crs is not None:
-            # to be completed
-            pass
-            # ref_img = None
-            # ds = gdal.Open(ref_img)
-            # crs_original = ds.GetProjection()
-            # options = None
-            # gdal.Warp()
+        # memory-mapped patch store for training
+        if patch_size is not None:
+            self.export_patch_store(output_dir, start_date, end_date, patch_size=patch_size)
 
-        # convert to jp2 format
+        # convert to jp2 format, sr and udm2 are encoded at the same time
         if jp2 is True:
-            options = dict(
-                format="JP2OpenJPEG",
-                creationOptions=["QUALITY=80"],
-                callback=self.gdal_progress_callback,
-                callback_data=tqdm(total=100, position=0, leave=True, desc="")
-            )
-            list([gdal.Translate(
-                os.path.join(output_dir,
-                             f'PS_{self.asset_attrs(asset_type)["suffix"]}_stack_{start_date}_{end_date}.jp2'),
-                os.path.join(output_dir,
-                             f'PS_{self.asset_attrs(asset_type)["suffix"]}_stack_{start_date}_{end_date}.tif'),
-                **options) for asset_type in ['analytic_sr', 'udm2']])
-            list([os.remove(os.path.join(
-                output_dir, f'PS_{self.asset_attrs(asset_type)["suffix"]}_stack_{start_date}_{end_date}.tif'))
-                  for asset_type in ['analytic_sr', 'udm2']])
+            self.export_jp2(dict([(os.path.join(
+                output_dir, f'PS_{self.asset_attrs(asset_type)["suffix"]}_stack_{start_date}_{end_date}.tif'),
+                asset_type) for asset_type in ['analytic_sr', 'udm2']]))
+
+    def export_patch_store(self, output_dir, start_date, end_date, store_dir=None, patch_size=256):
+        '''
+        Export the sr and udm2 stacks of prep_pipline() to a memory-mapped patch store (time, band, y, x per patch) with
+        an index of the patches, their clear fraction on each date and the dates, see patch_store.py
+        :param output_dir: string, output folder of prep_pipline()
+        :param start_date: string, 'YYYYMMDD'
+        :param end_date: string, 'YYYYMMDD'
+        :param store_dir: string, folder of the store, [output_dir]/patches if None
+        :param patch_size: int, rows and columns of a patch
+        :return: dictionary, the index of the store
+        '''
+
+        from patch_store import write_patch_store
+
+        store_dir = os.path.join(output_dir, 'patches') if store_dir is None else store_dir
+        with open(os.path.join(output_dir, f'PS_stack_dates_{start_date}_{end_date}.txt'), 'r') as txt:
+            date_list = [date for date in txt.read().split(',') if date]
+        asset_paths = dict([(name, os.path.join(
+            output_dir, f'PS_{self.asset_attrs(asset_type)["suffix"]}_stack_{start_date}_{end_date}.tif'))
+            for name, asset_type in [('sr', 'analytic_sr'), ('udm2', 'udm2')]])
+        return write_patch_store(store_dir, asset_paths, date_list, patch_size=patch_size)
+
+    @staticmethod
+    def warp_options(crs=None, target_grid=None, resample_alg='near'):
+        '''
+        Keyword arguments of gdal.Warp() reprojecting to a CRS and/or aligning to a target grid
+        :param crs: string, target spatial reference, e.g., 'EPSG:4326', the CRS of target_grid if it is an image, a
+                    different CRS raises a ValueError
+        :param target_grid: string or dictionary, file path of a reference image whose CRS, pixel size and extent are
+                            used, or {'pixel_res': float or (x, y), 'bounds': (min x, min y, max x, max y)} in the
+                            target CRS, pixels are aligned to multiples of pixel_res, see common_grid()
+        :param resample_alg: string, e.g., 'near' or 'bilinear'
+        :return: dictionary
+        '''
+
+        options = {'resampleAlg': resample_alg}
+        if isinstance(target_grid, (str, Path)):
+            ref_raster = gdal.Open(str(target_grid), gdal.GA_ReadOnly)
+            if ref_raster is None:
+                raise ValueError('Cannot open the reference image of the target grid: {}'.format(target_grid))
+            geo_transform = ref_raster.GetGeoTransform()
+            x_size, y_size = ref_raster.RasterXSize, ref_raster.RasterYSize
+            if crs is not None:
+                # the extent and pixel size of the reference image are only valid in its own CRS
+                crs_srs, ref_srs = osr.SpatialReference(), osr.SpatialReference(wkt=ref_raster.GetProjection())
+                crs_srs.SetFromUserInput(crs)
+                if not crs_srs.IsSame(ref_srs):
+                    raise ValueError('crs {} differs from the CRS of the reference image of the target grid {}, '
+                                     'leave crs None to use the CRS of the reference image'.format(crs, target_grid))
+            options.update({'dstSRS': ref_raster.GetProjection(),
+                            'xRes': geo_transform[1], 'yRes': abs(geo_transform[5]),
+                            'outputBounds': (geo_transform[0], geo_transform[3] + geo_transform[5] * y_size,
+                                             geo_transform[0] + geo_transform[1] * x_size, geo_transform[3])})
+            ref_raster = None
+            return options
+        if crs is not None:
+            options['dstSRS'] = crs
+        if target_grid is not None:
+            pixel_res = target_grid['pixel_res']
+            x_res, y_res = pixel_res if isinstance(pixel_res, (tuple, list)) else (pixel_res, pixel_res)
+            options.update({'xRes': x_res, 'yRes': y_res, 'targetAlignedPixels': True})
+            if target_grid.get('bounds') is not None:
+                options['outputBounds'] = tuple(target_grid['bounds'])
+        return options
+
+    @staticmethod
+    def common_grid(path_list, crs):
+        '''
+        One grid for images reprojected to a CRS, so that the images of every day are stacked pixel to pixel: the
+        pixel size of the first image in the CRS and the union of the extents of all images in the CRS, aligned to
+        multiples of the pixel size
+        :param path_list: list, file paths of the images
+        :param crs: string, target spatial reference, e.g., 'EPSG:4326'
+        :return: dictionary, target_grid of warp_options()
+        '''
+
+        pixel_res, bounds = None, None
+        for path in path_list:
+            # in-memory warped VRT, only its grid is read
+            out_raster = gdal.Warp('', path, format='VRT', dstSRS=crs)
+            if out_raster is None:
+                raise RuntimeError('Failed to warp {}'.format(path))
+            gt, x_size, y_size = out_raster.GetGeoTransform(), out_raster.RasterXSize, out_raster.RasterYSize
+            out_raster = None
+            pixel_res = (gt[1], abs(gt[5])) if pixel_res is None else pixel_res
+            path_bounds = (gt[0], gt[3] + gt[5] * y_size, gt[0] + gt[1] * x_size, gt[3])
+            bounds = path_bounds if bounds is None else (min(bounds[0], path_bounds[0]), min(bounds[1], path_bounds[1]),
+                                                         max(bounds[2], path_bounds[2]), max(bounds[3], path_bounds[3]))
+        if bounds is None:
+            return None
+        # same alignment as targetAlignedPixels
+        x_res, y_res = pixel_res
+        bounds = (np.floor(bounds[0] / x_res) * x_res, np.floor(bounds[1] / y_res) * y_res,
+                  np.ceil(bounds[2] / x_res) * x_res, np.ceil(bounds[3] / y_res) * y_res)
+        return {'pixel_res': pixel_res, 'bounds': tuple([float(value) for value in bounds])}
+
+    @staticmethod
+    def vrt_source(path, band, src_rect=None, dst_rect=None):
+        '''
+        XML of a SimpleSource of a VRT band
+        :param path: string, file path of the source image
+        :param band: int, band number in the source image
+        :param src_rect: tuple, (x offset, y offset, x size, y size) in the source, the whole image if None
+        :param dst_rect: tuple, (x offset, y offset, x size, y size) in the VRT, the whole VRT if None
+        :return: string
+        '''
+        rect_list = ['      <{} xOff="{}" yOff="{}" xSize="{}" ySize="{}" />\n'.format(name, *rect)
+                     for name, rect in [('SrcRect', src_rect), ('DstRect', dst_rect)] if rect is not None]
+        return '    <SimpleSource>\n      <SourceFilename relativeToVRT="0">{}</SourceFilename>\n' \
+               '      <SourceBand>{}</SourceBand>\n{}    </SimpleSource>\n'.format(
+                   escape(str(Path(path).resolve())), band, ''.join(rect_list))
+
+    @staticmethod
+    def write_vrt(output_path, x_size, y_size, geo_transform, projection, band_list):
+        '''
+        Write a VRT
+        :param output_path: string, file path of the VRT
+        :param x_size: int, the number of columns
+        :param y_size: int, the number of rows
+        :param geo_transform: tuple
+        :param projection: string, WKT
+        :param band_list: list, XML of the VRTRasterBand elements
+        :return: string, output_path
+        '''
+        with Utilities.atomic_output(output_path) as temp_path:
+            with open(temp_path, 'w') as f:
+                f.write('<VRTDataset rasterXSize="{}" rasterYSize="{}">\n  <SRS>{}</SRS>\n'
+                        '  <GeoTransform>{}</GeoTransform>\n{}</VRTDataset>\n'.format(
+                            x_size, y_size, escape(projection),
+                            ', '.join([repr(float(value)) for value in geo_transform]), ''.join(band_list)))
+        return output_path
+
+    def stack_vrt(self, path_list, output_path, data_type):
+        '''
+        Virtual equivalent of gdal_merge(separate=True): a VRT of all bands of the images in sequence, the extent is
+        the union of the images and the pixel size that of the first one, like gdal_merge.py -separate.
+        gdal.BuildVRT(separate=True) only takes the first band of each image before GDAL 3.8.
+        :param path_list: list, file paths of the images
+        :param output_path: string, file path of the VRT
+        :param data_type: string, GDAL data type of the bands, e.g., 'UInt16'
+        :return: string, output_path
+        '''
+
+        grid_list = []
+        projection = None
+        for path in path_list:
+            raster = gdal.Open(path, gdal.GA_ReadOnly)
+            grid_list.append((raster.GetGeoTransform(), raster.RasterXSize, raster.RasterYSize, raster.RasterCount))
+            projection = raster.GetProjection() if projection is None else projection
+            raster = None
+        x_res, y_res = grid_list[0][0][1], grid_list[0][0][5]
+        min_x = min([gt[0] for gt, _, _, _ in grid_list])
+        max_y = max([gt[3] for gt, _, _, _ in grid_list])
+        max_x = max([gt[0] + gt[1] * x_size for gt, x_size, _, _ in grid_list])
+        min_y = min([gt[3] + gt[5] * y_size for gt, _, y_size, _ in grid_list])
+        # same rounding as gdal_merge.py
+        x_size, y_size = int((max_x - min_x) / x_res + 0.5), int((min_y - max_y) / y_res + 0.5)
+        band_list = []
+        for path, (gt, src_x_size, src_y_size, n_band) in zip(path_list, grid_list):
+            x_off, y_off = int((gt[0] - min_x) / x_res + 0.1), int((gt[3] - max_y) / y_res + 0.1)
+            dst_rect = (x_off, y_off, int((gt[0] + gt[1] * src_x_size - min_x) / x_res + 0.5) - x_off,
+                        int((gt[3] + gt[5] * src_y_size - max_y) / y_res + 0.5) - y_off)
+            for band_idx in range(1, n_band + 1):
+                band_list.append('  <VRTRasterBand dataType="{}" band="{}">\n{}  </VRTRasterBand>\n'.format(
+                    data_type, len(band_list) + 1,
+                    self.vrt_source(path, band_idx, (0, 0, src_x_size, src_y_size), dst_rect)))
+        return self.write_vrt(output_path, x_size, y_size, (min_x, x_res, 0., max_y, 0., y_res), projection,
+                              band_list)
+
+    def warped_vrt(self, input_path, output_path, crs=None, target_grid=None, resample_alg='near'):
+        '''
+        Warped VRT of an image in the target CRS and grid, pixels are only reprojected when the VRT is read
+        :param input_path: string
+        :param output_path: string, file path of the VRT
+        :param crs: string, see warp_options()
+        :param target_grid: string or dictionary, see warp_options()
+        :param resample_alg: string, e.g., 'near' or 'bilinear'
+        :return: string, output_path
+        '''
+
+        in_raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+        nodata = in_raster.GetRasterBand(1).GetNoDataValue()
+        in_raster = None
+        out_raster = gdal.Warp(output_path, input_path, format='VRT',
+                               srcNodata=nodata, dstNodata=nodata if nodata is not None else 0,
+                               **dict(self.warp_kwargs(), **self.warp_options(crs, target_grid, resample_alg)))
+        if out_raster is None:
+            raise RuntimeError('Failed to warp {}'.format(input_path))
+        out_raster = None
+        return output_path
+
+    @staticmethod
+    def gdal_to_jp2(args):
+        '''
+        Encode one image as JPEG2000
+        :param args: tuple, (input path, output path, JP2OpenJPEG creation options)
+        :return: tuple, (output path, encode time in seconds, error message or None)
+        '''
+
+        input_path, output_path, option_list = args
+        start = time.perf_counter()
+        try:
+            with Utilities.atomic_output(output_path) as temp_path:
+                out_raster = gdal.Translate(temp_path, input_path, format='JP2OpenJPEG', creationOptions=option_list)
+                if out_raster is None:
+                    raise RuntimeError('Failed to encode {}'.format(output_path))
+                out_raster = None
+        except Exception as e:
+            return output_path, time.perf_counter() - start, str(e)
+        return output_path, time.perf_counter() - start, None
+
+    def export_jp2(self, input_dict, remove_input=True):
+        '''
+        Convert GeoTIFFs to JPEG2000, all images are encoded at the same time, each with its share of the threads if
+        the GDAL build supports multithreaded encoding, see jp2_creation_options()
+        :param input_dict: dictionary, {input path: key of jp2_profiles}, e.g., {'PS_udm2_stack.tif': 'udm2'}
+        :param remove_input: boolean, True means the GeoTIFFs are deleted once encoded
+        :return: dictionary, {output path: encode time in seconds}
+        '''
+
+        n_jobs = max(1, len(input_dict))
+        stage = self._stage_stack[-1] if self._stage_stack else None
+        settings = self.gdal_settings(stage, n_jobs)
+        args_list = [(input_path, str(Path(input_path).with_suffix('.jp2')),
+                      self.jp2_creation_options(profile, settings['GDAL_NUM_THREADS']))
+                     for input_path, profile in input_dict.items()]
+        elapsed_dict = {}
+        failed_list = []
+        with Pool(n_jobs, initializer=apply_gdal_config, initargs=(settings,)) as pool:
+            for output_path, elapsed, error in pool.imap_unordered(self.gdal_to_jp2, args_list):
+                if error is not None:
+                    failed_list.append(output_path)
+                    print('Failed to encode {}: {}'.format(output_path, error))
+                    continue
+                elapsed_dict[output_path] = elapsed
+                print('Encoded {} in {:.1f} s'.format(output_path, elapsed))
+        if remove_input is True:
+            list([os.remove(input_path) for input_path, output_path, _ in args_list if output_path in elapsed_dict])
+        self.count_tasks(len(args_list), len(args_list), len(failed_list))
+        return elapsed_dict
+
+    def resolve_stages(self, stages, with_dependencies=False):
+        '''
+        Order processing stages by their dependencies
+        :param stages: list, stage names, keys of default_stage_dependencies
+        :param with_dependencies: boolean, True means the upstream stages of the given stages are included
+        :return: list, stage names in order of execution
+        '''
+
+        stage_set = set(stages)
+        unknown = stage_set - set(self.default_stage_dependencies.keys())
+        if unknown:
+            raise ValueError('Unknown stages: {}'.format(sorted(unknown)))
+        if with_dependencies is True:
+            queue = list(stage_set)
+            while queue:
+                for upstream in self.default_stage_dependencies[queue.pop()]:
+                    if upstream not in stage_set:
+                        stage_set.add(upstream)
+                        queue.append(upstream)
+        return [stage for stage in self.default_stage_dependencies.keys() if stage in stage_set]
+
+    def stage_inputs(self, stage):
+        '''
+        Input files of a processing stage in the work directory
+        :param stage: string, stage name
+        :return: list, file path
+        '''
+
+        raw_dir = self.stage_dir('raw')
+        if stage == 'setnull':
+            return sorted(glob(str(raw_dir / '*udm2.tif')))
+        if stage == 'merge':
+            return sorted([fp for fp in glob(str(raw_dir / '*.tif')) if not fp.endswith('_setnull.tif')])
+        if stage == 'clip':
+            return sorted(glob(str(self.stage_dir('merge') / '*.{}'.format(
+                'vrt' if self.virtual_intermediates is True else 'tif'))))
+        if stage in ['clear prob', 'NDVI', 'stack']:
+            return sorted(glob(str(Path(self.work_dir) / self.output_dirs['clip'] / '*.tif')))
+        if stage in ['composite', 'gap fill']:
+            sr_suffix = self.asset_attrs('analytic_sr')['suffix']
+            return sorted(glob(str(self.stage_dir('clip') / '*{}*.tif'.format(sr_suffix))))
+        return []
+
+    def run_pipeline(self, stages, with_dependencies=False, stage_kwargs=None, validate=False):
+        '''
+        Run processing stages in order of their dependencies: download -> setnull -> merge -> clip -> clear prob/NDVI/
+        stack/composite/gap fill. Every stage records the inputs and settings of its outputs in the manifest and only
+        rebuilds outputs whose inputs or settings changed, so rerunning over an up-to-date work directory only checks
+        the files.
+        :param stages: list, stage names, 'download', 'setnull', 'merge', 'clip', 'clear prob', 'NDVI', 'stack',
+                       'composite' or 'gap fill'
+        :param with_dependencies: boolean, True means the upstream stages of the given stages are run as well
+        :param stage_kwargs: dictionary, keyword arguments of each stage, e.g., {'clip': {'suffix': '_clip'}}. The
+                            'stack' stage takes the arguments of stack_as_nc() and uses the clip folder as input_dir by
+                            default.
+        :param validate: boolean, True means existing outputs of the stages are checked with validate_geotiff() first
+                        and the broken ones are rebuilt
+        :return:
+        '''
+
+        stage_kwargs = {} if stage_kwargs is None else stage_kwargs
+        stage_list = self.resolve_stages(stages, with_dependencies)
+        if validate is True:
+            stage_dirs = {'download': 'raw', 'setnull': 'raw', 'merge': 'merge', 'clip': 'clip',
+                          'clear prob': 'clear prob', 'NDVI': 'NDVI', 'composite': 'composite',
+                          'gap fill': 'NDVI'}
+            dir_list = set([self.stage_dir(stage_dirs[stage]) for stage in stage_list if stage in stage_dirs])
+            self.validate_outputs([fp for folder in dir_list for fp in glob(str(folder / '*.tif'))])
+        for stage in stage_list:
+            kwargs = dict(stage_kwargs.get(stage, {}))
+            print('Run stage: {}'.format(stage))
+            if stage == 'download':
+                self.download_assets(**kwargs)
+            elif stage == 'setnull':
+                self.udm2_setnull(file_list=kwargs.pop('file_list', self.stage_inputs(stage)), **kwargs)
+            elif stage == 'merge':
+                self.merge(file_list=kwargs.pop('file_list', self.stage_inputs(stage)), **kwargs)
+            elif stage == 'clip':
+                self.clip(file_list=kwargs.pop('file_list', self.stage_inputs(stage)), **kwargs)
+            elif stage in ['clear prob', 'NDVI']:
+                self.band_algebra(stage, file_list=kwargs.pop('file_list', self.stage_inputs(stage)))
+            elif stage == 'composite':
+                self.composite(file_list=kwargs.pop('file_list', self.stage_inputs(stage)), **kwargs)
+            elif stage == 'gap fill':
+                self.gap_fill(file_list=kwargs.pop('file_list', self.stage_inputs(stage)), **kwargs)
+            elif stage == 'stack':
+                kwargs.setdefault('input_dir', str(Path(self.work_dir) / self.output_dirs['clip']))
+                date_list = kwargs.get('date_list')
+                input_paths = [fp for fp in sorted(glob(os.path.join(kwargs['input_dir'], '*.tif')))
+                               if date_list is None or Path(fp).stem.split('_')[0] in date_list]
+                output_path = str(Path(kwargs['output_dir']) / kwargs['output_name'])
+                params = {key: value for key, value in kwargs.items() if key not in ['input_dir', 'output_dir']}
+                self.run_tasks([Task('stack', output_path, input_paths, params, 'stack_as_nc', kwargs)],
+                               desc='Stacking images')
+
+    @track_stage
+    def run_streaming(self, stages=None, download_workers=4, max_groups=None):
+        '''
+        Run download -> setnull -> merge -> clip -> clear prob/NDVI as a stream: the images of a day and satellite id
+        are processed as soon as they are downloaded, while the next ones are downloading, instead of waiting for the
+        whole search to be downloaded. The outputs and the manifest are the same as run_pipeline(), see
+        stream_pipeline.py
+        :param stages: list, stages run after the download, 'setnull', 'merge', 'clip', 'clear prob' and 'NDVI' if None
+        :param download_workers: int, the number of concurrent downloads
+        :param max_groups: int, the maximum number of downloaded groups waiting to be processed, 2 x n_workers if None
+        :return: dictionary, task counts
+        '''
+
+        from stream_pipeline import StreamPipeline
+
+        counts = StreamPipeline(self, stages, download_workers, max_groups).run(self.search_items())
+        self.count_tasks(counts['tasks_total'], counts['tasks_run'], counts['tasks_failed'])
+        return counts
+
+    def for_aoi(self, aoi_shp, work_dir):
+        '''
+        Copy of the settings for one AOI, with its own work directory, manifest and run log, reading downloaded and
+        merged images from the shared directory of this instance
+        :param aoi_shp: string, file path of AOI.shp
+        :param work_dir: string, the work directory of the AOI
+        :return: Utilities
+        '''
+        ut = copy.copy(self)
+        ut.aoi_shp = aoi_shp
+        ut.work_dir = work_dir
+        ut.shared_dir = self.shared_dir
+        ut.manifest_path = str(Path(work_dir) / 'manifest.json')
+        ut._manifest = None
+        ut.run_log_path = str(Path(work_dir) / 'run_log.jsonl')
+        ut._stage_stack = []
+        ut._stage_tasks = {}
+        return ut
+
+    def aoi_file_list(self, file_list, aoi_shp):
+        '''
+        Images whose extent intersects an AOI, e.g., the merged images in shared_dir that cover one of several AOIs
+        :param file_list: list, file paths of images
+        :param aoi_shp: string, file path of AOI.shp
+        :return: list, file path
+        '''
+
+        geom_wkt, geom_srs_wkt = self.read_aoi_geometry(aoi_shp)
+        if geom_wkt is None:
+            return []
+        geom_dict = {}
+        aoi_file_list = []
+        for input_path in file_list:
+            raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+            x_min, x_res, _, y_max, _, y_res = raster.GetGeoTransform()
+            x_max, y_min = x_min + x_res * raster.RasterXSize, y_max + y_res * raster.RasterYSize
+            extent = ogr.CreateGeometryFromWkt('POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(
+                x_min, y_min, x_max, y_max))
+            # the AOI is reprojected once per spatial reference of the images
+            raster_srs_wkt = raster.GetProjection()
+            if raster_srs_wkt not in geom_dict:
+                geom_dict[raster_srs_wkt] = self.geometry_to_raster_srs(geom_wkt, geom_srs_wkt, raster_srs_wkt)
+            raster = None
+            if geom_dict[raster_srs_wkt].Intersects(extent):
+                aoi_file_list.append(input_path)
+        return aoi_file_list
+
+    def run_multi_aoi(self, aoi_work_dirs, stages, with_dependencies=False, stage_kwargs=None, validate=False):
+        '''
+        Run processing stages for several AOIs whose scenes overlap. The AOI independent stages (shared_stages, i.e.,
+        download, setnull and merge) run once in shared_dir over the union of the AOIs, so that each scene is
+        downloaded and each date/orbit merged once. The stages from clip onward run per AOI in its own work directory,
+        clip only on the merged images whose extent intersects the AOI unless stage_kwargs gives its file_list.
+        :param aoi_work_dirs: dictionary, {file path of AOI.shp: work directory of the AOI}
+        :param stages: list, stage names, see run_pipeline()
+        :param with_dependencies: boolean, True means the upstream stages of the given stages are run as well
+        :param stage_kwargs: dictionary, keyword arguments of each stage, see run_pipeline()
+        :param validate: boolean, True means existing outputs are checked with validate_geotiff() first
+        :return: dictionary, {file path of AOI.shp: Utilities of the AOI}
+        '''
+
+        stage_list = self.resolve_stages(stages, with_dependencies)
+        shared_list = [stage for stage in stage_list if stage in self.shared_stages]
+        aoi_list = [stage for stage in stage_list if stage not in self.shared_stages]
+
+        ut_dict = {}
+        if shared_list:
+            shared = self.for_aoi(list(aoi_work_dirs.keys()), self.shared_dir)
+            shared.setup_dirs()
+            shared.run_pipeline(shared_list, stage_kwargs=stage_kwargs, validate=validate)
+        for aoi_shp, work_dir in aoi_work_dirs.items():
+            ut = self.for_aoi(aoi_shp, work_dir)
+            ut_dict[aoi_shp] = ut
+            if aoi_list:
+                print('AOI: {}'.format(aoi_shp))
+                ut.setup_dirs()
+                aoi_kwargs = {} if stage_kwargs is None else dict(stage_kwargs)
+                if 'clip' in aoi_list and 'file_list' not in aoi_kwargs.get('clip', {}):
+                    aoi_kwargs['clip'] = dict(aoi_kwargs.get('clip', {}),
+                                              file_list=ut.aoi_file_list(ut.stage_inputs('clip'), aoi_shp))
+                ut.run_pipeline(aoi_list, stage_kwargs=aoi_kwargs, validate=validate)
+        return ut_dict
 
     def plot_time_series(self):
         '''
@@ -1327,32 +3709,460 @@ class Utilities:
         :return:
         '''
 
-    def normalize(self, array, percentile=None):
+    @staticmethod
+    def band_percentiles(array, percentile=None, nodata=None, valid=None):
+        '''
+        Per band minimum and maximum, or lower and upper percentile, ignoring no data. For 8 and 16 bit unsigned integers
+        the percentiles are exact values derived from a histogram (np.bincount) in one linear pass, without sorting or
+        copying the band.
+        :param array: numpy array, (band, row, column) or (row, column)
+        :param percentile: list, a list of percentile, [2, 98] - 2nd and 98th percentile, min and max if None
+        :param nodata: int or float, no data value to be ignored
+        :param valid: numpy array, boolean mask of (row, column), True for the pixels to be used
+        :return: numpy array, (band, 2), lower and upper value of each band
         '''
-        Normalize bands into 0.0 - 1.0 scale
-        :param array: list or numpy array
+
+        array = np.asarray(array)
+        if array.ndim == 2:
+            array = array[np.newaxis]
+        q = np.array([0., 100.]) if percentile is None else np.array([min(percentile), max(percentile)], dtype=float)
+        stats = np.zeros((array.shape[0], 2))
+        for band_idx, band in enumerate(array):
+            values = band.ravel() if valid is None else band[valid]
+            if band.dtype in (np.uint8, np.uint16):
+                hist = np.bincount(values, minlength=256 if band.dtype == np.uint8 else 65536)
+                if nodata is not None and 0 <= nodata < hist.size:
+                    hist[int(nodata)] = 0
+                cum_hist = np.cumsum(hist)
+                n = cum_hist[-1]
+                if n == 0:
+                    continue
+                # Linear interpolation between the closest ranks, same as np.percentile
+                rank = q / 100 * (n - 1)
+                rank_floor = np.floor(rank)
+                value_floor = np.searchsorted(cum_hist, rank_floor, side='right')
+                value_ceil = np.searchsorted(cum_hist, np.ceil(rank), side='right')
+                stats[band_idx] = value_floor + (value_ceil - value_floor) * (rank - rank_floor)
+            else:
+                values = values.astype(float)
+                if nodata is not None:
+                    values = values[values != nodata]
+                values = values[~np.isnan(values)]
+                if values.size == 0:
+                    continue
+                stats[band_idx] = np.percentile(values, q)
+        return stats
+
+    @staticmethod
+    def normalize(array, percentile=None, nodata=None, stats=None):
+        '''
+        Normalize bands into 0.0 - 1.0 scale, each band is stretched independently
+        :param array: list or numpy array, (band, row, column) or (row, column)
         :param percentile: list, a list of percentile, [20, 50] - 20th and 50th percentile
+        :param nodata: int or float, no data value to be ignored when deriving the statistics
+        :param stats: numpy array or list, (band, 2), cached lower and upper value of each band, e.g., the output of
+                    band_percentiles(), the statistics are derived from the array if None
         :return: numpy array, normalized array
         '''
-        array_np = np.array(array)
-        array_flat = np.array(array_np).flatten()
-        if percentile is None:
-            array_min, array_max = array_flat.min(), array_flat.max()
-        else:
-            array_min = np.percentile(array_flat, min(percentile))
-            array_max = np.percentile(array_flat, max(percentile))
-        return (array_np - array_min) / (array_max - array_min)
+        array_np = np.asarray(array)
+        if stats is None:
+            stats = Utilities.band_percentiles(array_np, percentile, nodata)
+        stats = np.asarray(stats, dtype=np.float32).reshape(-1, 2)
+        array_min = stats[:, 0].reshape((-1,) + (1,) * (array_np.ndim - 1)) if array_np.ndim == 3 else stats[0, 0]
+        array_max = stats[:, 1].reshape((-1,) + (1,) * (array_np.ndim - 1)) if array_np.ndim == 3 else stats[0, 1]
+        return (array_np - array_min) / np.maximum(array_max - array_min, np.float32(1e-6))
 
-    def clip_clear_perc(self, shapefile_path, clear_perc_min, save_rgb=True, save_clip=False, file_list=None):
+    @staticmethod
+    def read_aoi_geometry(shapefile_path):
+        '''
+        Read the union of all features in a shapefile
+        :param shapefile_path: string, file path of AOI.shp
+        :return: tuple, (WKT of the union geometry, WKT of the spatial reference of the shapefile)
+        '''
+
+        vector_dataset = ogr.Open(shapefile_path, 0)
+        layer = vector_dataset.GetLayer()
+        union = None
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            union = geom.Clone() if union is None else union.Union(geom)
+        srs = layer.GetSpatialRef()
+        srs_wkt = srs.ExportToWkt() if srs is not None else ''
+        vector_dataset = None
+        return union.ExportToWkt() if union is not None else None, srs_wkt
+
+    @staticmethod
+    def geometry_to_raster_srs(geom_wkt, geom_srs_wkt, raster_srs_wkt):
+        '''
+        Reproject a geometry to the spatial reference of a raster, if they differ
+        :param geom_wkt: string, WKT of the geometry
+        :param geom_srs_wkt: string, WKT of the spatial reference of the geometry, empty if unknown
+        :param raster_srs_wkt: string, WKT of the spatial reference of the raster, empty if unknown
+        :return: ogr.Geometry
+        '''
+
+        geom = ogr.CreateGeometryFromWkt(geom_wkt)
+        if geom_srs_wkt and raster_srs_wkt:
+            source_srs = osr.SpatialReference(wkt=geom_srs_wkt)
+            target_srs = osr.SpatialReference(wkt=raster_srs_wkt)
+            if not source_srs.IsSame(target_srs):
+                if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                    source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                    target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                geom.Transform(osr.CoordinateTransformation(source_srs, target_srs))
+        return geom
+
+    @staticmethod
+    def geometry_window(geom, geo_transform, x_size, y_size):
+        '''
+        Pixel window of a raster covering the bounding box of a geometry
+        :param geom: ogr.Geometry, in the spatial reference of the raster
+        :param geo_transform: tuple, geotransform of the raster
+        :param x_size: int, the number of columns of the raster
+        :param y_size: int, the number of rows of the raster
+        :return: tuple, (xoff, yoff, xsize, ysize), None if the geometry does not overlap the raster
+        '''
+
+        minX, maxX, minY, maxY = geom.GetEnvelope()
+        x0 = int(np.floor((minX - geo_transform[0]) / geo_transform[1]))
+        x1 = int(np.ceil((maxX - geo_transform[0]) / geo_transform[1]))
+        y0 = int(np.floor((maxY - geo_transform[3]) / geo_transform[5]))
+        y1 = int(np.ceil((minY - geo_transform[3]) / geo_transform[5]))
+        x0, x1 = max(x0, 0), min(x1, x_size)
+        y0, y1 = max(y0, 0), min(y1, y_size)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1 - x0, y1 - y0
+
+    @staticmethod
+    def rasterize_geometry(geom, raster_srs_wkt, geo_transform, window):
+        '''
+        Rasterize a geometry to a window of a raster grid
+        :param geom: ogr.Geometry, in the spatial reference of the raster
+        :param raster_srs_wkt: string, WKT of the spatial reference of the raster
+        :param geo_transform: tuple, geotransform of the raster
+        :param window: tuple, (xoff, yoff, xsize, ysize)
+        :return: numpy array, boolean mask of the window, True inside the geometry
+        '''
+
+        xoff, yoff, xsize, ysize = window
+        mem_raster = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+        mem_raster.SetGeoTransform((geo_transform[0] + xoff * geo_transform[1], geo_transform[1], 0,
+                                    geo_transform[3] + yoff * geo_transform[5], 0, geo_transform[5]))
+        mem_raster.SetProjection(raster_srs_wkt)
+        mem_vector = ogr.GetDriverByName('Memory').CreateDataSource('')
+        srs = osr.SpatialReference(wkt=raster_srs_wkt) if raster_srs_wkt else None
+        layer = mem_vector.CreateLayer('mask', srs=srs)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geom)
+        layer.CreateFeature(feature)
+        gdal.RasterizeLayer(mem_raster, [1], layer, burn_values=[1])
+        mask = mem_raster.GetRasterBand(1).ReadAsArray().astype(bool)
+        mem_raster = None
+        mem_vector = None
+        return mask
+
+    @staticmethod
+    def geometry_mask(raster, geom_wkt, geom_srs_wkt):
+        '''
+        Window of a raster covering a polygon and the mask of the polygon in the window, cached per scene grid
+        :param raster: gdal.Dataset
+        :param geom_wkt: string, WKT of the polygon
+        :param geom_srs_wkt: string, WKT of the spatial reference of the polygon
+        :return: tuple, (window (xoff, yoff, xsize, ysize) or None if they do not overlap, boolean numpy array)
+        '''
+        geo_transform = raster.GetGeoTransform()
+        raster_srs_wkt = raster.GetProjection()
+        key = (geom_wkt, geom_srs_wkt, geo_transform, raster_srs_wkt, raster.RasterXSize, raster.RasterYSize)
+        if key not in _mask_cache:
+            geom = Utilities.geometry_to_raster_srs(geom_wkt, geom_srs_wkt, raster_srs_wkt)
+            window = Utilities.geometry_window(geom, geo_transform, raster.RasterXSize, raster.RasterYSize)
+            mask = Utilities.rasterize_geometry(geom, raster_srs_wkt, geo_transform, window) \
+                if window is not None else None
+            _mask_cache[key] = (window, mask)
+        return _mask_cache[key]
+
+    @staticmethod
+    def udm2_statistics(args):
+        '''
+        Quality statistics of a udm2 image over the whole scene and within polygons: the fraction of the valid (not
+        no data) pixels that are clear, snow, shadow, light haze, heavy haze and cloud (bands 1 - 6) and the mean
+        confidence (band 7). Windows of rows (whole scene) or covering a polygon are read.
+        :param args: tuple, (udm2 file path, list of regions (name, id, see region_id(), WKT of the polygon or None
+                     for the whole scene, WKT of the spatial reference of the polygon))
+        :return: list, a dictionary of statistics per region
+        '''
+
+        udm2_path, region_list = args
+        raster = gdal.Open(udm2_path, gdal.GA_ReadOnly)
+        x_size, y_size = raster.RasterXSize, raster.RasterYSize
+        band_list = [raster.GetRasterBand(band_idx + 1) for band_idx in range(7)]
+        size, mtime = Manifest.file_signature(udm2_path)
+        row_list = []
+        for name, region_id, geom_wkt, geom_srs_wkt in region_list:
+            if geom_wkt is None:
+                block_list = [((0, y0, x_size, min(512, y_size - y0)), None) for y0 in range(0, y_size, 512)]
+            else:
+                window, mask = Utilities.geometry_mask(raster, geom_wkt, geom_srs_wkt)
+                block_list = [(window, mask)] if window is not None else []
+            n_pixel, n_valid, confidence_sum = 0, 0, 0.
+            counts = np.zeros(6, dtype=np.int64)
+            for window, mask in block_list:
+                array = np.stack([band.ReadAsArray(*window) for band in band_list])
+                mask = np.ones(array.shape[1:], dtype=bool) if mask is None else mask
+                valid = mask & array[:6].any(axis=0)
+                n_pixel += int(np.count_nonzero(mask))
+                n_valid += int(np.count_nonzero(valid))
+                counts += np.count_nonzero(array[:6, valid], axis=1)
+                confidence_sum += float(array[6, valid].sum(dtype=np.float64))
+            row = {'scene_id': Path(udm2_path).name.split('_udm2')[0], 'date': Path(udm2_path).name.split('_')[0],
+                   'file': str(udm2_path), 'size': size, 'mtime': mtime, 'region': name, 'region_id': region_id,
+                   'n_pixels': n_pixel,
+                   'n_valid': n_valid, 'valid_fraction': n_valid / n_pixel if n_pixel else 0.,
+                   'confidence': confidence_sum / n_valid if n_valid else np.nan}
+            for key, count in zip(Utilities.udm2_classes, counts):
+                row[key] = count / n_valid if n_valid else np.nan
+            row_list.append(row)
+        raster = None
+        return row_list
+
+    @staticmethod
+    def region_id(shapefile_path, geom_wkt):
+        '''
+        Key of a region of the udm2 quality catalog: the resolved path of the AOI shapefile and a hash of its geometry,
+        so that AOIs with the same file name (e.g., aoi.shp) in different folders, or an edited AOI, are told apart
+        :param shapefile_path: string, file path of AOI.shp, None for the whole scene
+        :param geom_wkt: string, WKT of the union of the polygons, see read_aoi_geometry()
+        :return: string, 'scene' for the whole scene
+        '''
+        if shapefile_path is None:
+            return 'scene'
+        return '{}#{}'.format(Path(shapefile_path).resolve(), hashlib.sha1(str(geom_wkt).encode()).hexdigest()[:16])
+
+    @staticmethod
+    def udm2_clear_fraction(args):
+        '''
+        Fraction of clear pixels of a udm2 image within a polygon. The polygon is rasterized once per scene grid and only
+        the window of band 1 (clear) covering the polygon is read.
+        :param args: tuple, (udm2 file path, WKT of the polygon, WKT of the spatial reference of the polygon)
+        :return: tuple, (udm2 file path, fraction of clear pixels)
+        '''
+
+        udm2_path, geom_wkt, geom_srs_wkt = args
+        raster = gdal.Open(udm2_path, gdal.GA_ReadOnly)
+        window, mask = Utilities.geometry_mask(raster, geom_wkt, geom_srs_wkt)
+        if window is None or not mask.any():
+            raster = None
+            return udm2_path, 0.0
+        clear_band_array = raster.GetRasterBand(1).ReadAsArray(*window)
+        raster = None
+        clear_perc = np.count_nonzero(clear_band_array[mask]) / np.count_nonzero(mask)
+        return udm2_path, clear_perc
+
+    @staticmethod
+    def render_thumbnail(args):
+        '''
+        Render a color composite thumbnail without matplotlib. Bands are read at the thumbnail size, so that GDAL reads
+        from overviews or decimates the window, and stretched with the given band statistics.
+        :param args: tuple, (input path, output path, band list, WKT of the AOI polygon or None, WKT of the spatial
+                    reference of the polygon, maximum thumbnail size in pixels, percentile, band statistics or None,
+                    output format 'PNG' or 'JPEG')
+        :return: tuple, (output path, band statistics, error message or None)
+        '''
+
+        input_path, output_path, band_list, geom_wkt, geom_srs_wkt, thumbnail_size, percentile, stats, fmt = args
+        try:
+            raster = gdal.Open(input_path, gdal.GA_ReadOnly)
+            geo_transform = raster.GetGeoTransform()
+            raster_srs_wkt = raster.GetProjection()
+            geom = None
+            window = (0, 0, raster.RasterXSize, raster.RasterYSize)
+            if geom_wkt is not None:
+                geom = Utilities.geometry_to_raster_srs(geom_wkt, geom_srs_wkt, raster_srs_wkt)
+                window = Utilities.geometry_window(geom, geo_transform, raster.RasterXSize, raster.RasterYSize)
+                if window is None:
+                    raster = None
+                    return output_path, stats, 'no overlap with the AOI'
+            xoff, yoff, xsize, ysize = window
+            scale = min(1.0, thumbnail_size / max(xsize, ysize))
+            buf_xsize, buf_ysize = max(1, int(round(xsize * scale))), max(1, int(round(ysize * scale)))
+            array = np.stack([raster.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize,
+                                                                     buf_xsize=buf_xsize, buf_ysize=buf_ysize)
+                              for band in band_list])
+            nodata = raster.GetRasterBand(band_list[0]).GetNoDataValue()
+            raster = None
+
+            # Pixels inside the AOI and with data
+            valid = np.ones((buf_ysize, buf_xsize), dtype=bool) if nodata is None else np.all(array != nodata, axis=0)
+            if geom is not None:
+                decimated_transform = (geo_transform[0] + xoff * geo_transform[1], geo_transform[1] * xsize / buf_xsize,
+                                       0, geo_transform[3] + yoff * geo_transform[5],
+                                       0, geo_transform[5] * ysize / buf_ysize)
+                valid &= Utilities.rasterize_geometry(geom, raster_srs_wkt, decimated_transform,
+                                                      (0, 0, buf_xsize, buf_ysize))
+
+            # Stretch to 0 - 255
+            if stats is None:
+                stats = Utilities.band_percentiles(array, percentile, valid=valid).tolist()
+            stats_array = np.asarray(stats, dtype=np.float32)
+            array_norm = (array - stats_array[:, 0, np.newaxis, np.newaxis]) / \
+                np.maximum(stats_array[:, 1] - stats_array[:, 0], np.float32(1e-6))[:, np.newaxis, np.newaxis]
+            rgb = np.clip(array_norm * 255, 0, 255).astype(np.uint8)
+            rgb[:, ~valid] = 0
+
+            mem_raster = gdal.GetDriverByName('MEM').Create('', buf_xsize, buf_ysize, 3, gdal.GDT_Byte)
+            for band_idx in range(3):
+                mem_raster.GetRasterBand(band_idx + 1).WriteArray(rgb[band_idx])
+            with Utilities.atomic_output(output_path) as temp_path:
+                gdal.GetDriverByName(fmt).CreateCopy(temp_path, mem_raster)
+            mem_raster = None
+        except Exception as e:
+            return output_path, stats, str(e)
+        return output_path, stats, None
+
+    def quality_catalog_path(self, catalog_path=None):
+        '''
+        File path of the udm2 quality catalog, [work_dir]/udm2_quality.parquet, or .csv without a parquet engine
+        '''
+        if catalog_path is None:
+            catalog_path = str(Path(self.work_dir) / 'udm2_quality.parquet')
+        csv_path = str(Path(catalog_path).with_suffix('.csv'))
+        return csv_path if not os.path.exists(catalog_path) and os.path.exists(csv_path) else catalog_path
+
+    def load_quality_catalog(self, catalog_path=None):
+        '''
+        Read the udm2 quality catalog
+        :param catalog_path: string, see quality_catalog_path()
+        :return: pandas.DataFrame, one row per scene and region, None if there is no catalog
+        '''
+        import pandas as pd
+
+        catalog_path = self.quality_catalog_path(catalog_path)
+        if not os.path.exists(catalog_path):
+            return None
+        if catalog_path.endswith('.csv'):
+            return pd.read_csv(catalog_path, dtype={'date': str})
+        return pd.read_parquet(catalog_path)
+
+    @track_stage
+    def quality_catalog(self, file_list=None, aoi_shp=None, catalog_path=None):
+        '''
+        Catalog of the quality statistics of the clipped udm2 images per scene and per AOI, see udm2_statistics(),
+        computed in parallel once per image and saved in a columnar file (parquet, csv if no parquet engine is
+        installed). Images whose size and modification time did not change keep their statistics. The catalog is
+        updated in place: the rows of other images and regions are kept, those of images that no longer exist dropped.
+        :param file_list: list, file paths of udm2 images, the udm2 images in the clip folder if None
+        :param aoi_shp: string or list, file paths of AOI shapefiles, the region of each is named after the file,
+                        self.aoi_shp if None
+        :param catalog_path: string, see quality_catalog_path()
+        :return: pandas.DataFrame
+        '''
+        import pandas as pd
+
+        if file_list is None:
+            file_list = glob(str(self.stage_dir('clip') / '*{}*.tif'.format(self.asset_attrs('udm2')['suffix'])))
+        file_list = sorted([file for file in file_list if self.asset_attrs('udm2')['suffix'] in Path(file).name])
+        aoi_shp = self.aoi_shp if aoi_shp is None else aoi_shp
+        aoi_list = [aoi_shp] if isinstance(aoi_shp, (str, Path)) else list(aoi_shp or [])
+        region_list = [('scene', 'scene', None, None)]
+        for shp in aoi_list:
+            geom_wkt, geom_srs_wkt = self.read_aoi_geometry(str(shp))
+            region_list.append((Path(shp).stem, self.region_id(shp, geom_wkt), geom_wkt, geom_srs_wkt))
+        region_ids = set([region[1] for region in region_list])
+
+        catalog = self.load_quality_catalog(catalog_path)
+        if catalog is not None and 'region_id' not in catalog.columns:
+            # catalog of a previous version, whose regions were keyed by the name of the shapefile only
+            catalog = None
+        row_list = []
+        todo_list = file_list
+        if catalog is not None:
+            signature = dict([(file, Manifest.file_signature(file)) for file in file_list])
+            exists = dict([(file, os.path.exists(file)) for file in set(catalog['file'])])
+            # rows of images that were deleted or changed since are dropped, the modification time may lose its last
+            # digits in csv
+            keep = [exists[file] and (file not in signature or (signature[file][0] == size and
+                                                                abs(signature[file][1] - mtime) < 1e-3))
+                    for file, size, mtime in zip(catalog['file'], catalog['size'], catalog['mtime'])]
+            catalog = catalog[keep]
+            done = catalog.groupby('file')['region_id'].apply(set).to_dict()
+            todo_list = [file for file in file_list if not region_ids <= done.get(file, set())]
+            # only the regions of the images to do are replaced
+            todo_set = set(todo_list)
+            row_list = [row for row in catalog.to_dict('records')
+                        if row['file'] not in todo_set or row['region_id'] not in region_ids]
+
+        args_list = [(file, region_list) for file in todo_list]
+        with self.worker_pool() as pool:
+            for rows in tqdm(pool.imap_unordered(self.udm2_statistics, args_list, chunksize=4), total=len(args_list),
+                             unit="item", desc='Computing udm2 statistics'):
+                row_list.extend(rows)
+        self.count_tasks(len(file_list), len(todo_list))
+
+        catalog = pd.DataFrame(row_list, columns=['scene_id', 'date', 'file', 'size', 'mtime', 'region', 'region_id',
+                                                  'n_pixels', 'n_valid', 'valid_fraction'] + self.udm2_classes +
+                                                 ['confidence'])
+        catalog = catalog.sort_values(['date', 'scene_id', 'region', 'region_id']).reset_index(drop=True)
+        catalog_path = str(Path(self.work_dir) / 'udm2_quality.parquet') if catalog_path is None else catalog_path
+        with self.atomic_output(catalog_path) as temp_path:
+            try:
+                catalog.to_parquet(temp_path, index=False)
+            except ImportError:
+                catalog_path = str(Path(catalog_path).with_suffix('.csv'))
+        if catalog_path.endswith('.csv'):
+            with self.atomic_output(catalog_path) as temp_path:
+                catalog.to_csv(temp_path, index=False)
+        print('The udm2 quality catalog has been saved in ' + catalog_path)
+        return catalog
+
+    def select_scenes(self, min_clear=0., max_cloud=1., min_valid=0., region='scene', start_date=None, end_date=None,
+                      catalog_path=None):
+        '''
+        Scenes of the udm2 quality catalog meeting quality thresholds, without opening any image
+        :param min_clear: float, minimum fraction of clear valid pixels
+        :param max_cloud: float, maximum fraction of cloudy valid pixels
+        :param min_valid: float, minimum fraction of valid pixels in the region
+        :param region: string, 'scene', the name of an AOI shapefile, or its file path, which tells apart AOIs with the
+                       same name, see region_id()
+        :param start_date: string, 'YYYYMMDD'
+        :param end_date: string, 'YYYYMMDD'
+        :param catalog_path: string, see quality_catalog_path()
+        :return: list, file paths of udm2 images
+        '''
+        catalog = self.load_quality_catalog(catalog_path)
+        if catalog is None:
+            raise FileNotFoundError('No udm2 quality catalog, run quality_catalog() first')
+        if region != 'scene' and os.path.exists(region):
+            in_region = catalog['region_id'] == self.region_id(region, self.read_aoi_geometry(region)[0])
+        else:
+            in_region = catalog['region'] == region
+        selected = catalog[in_region & (catalog['clear'].fillna(0) >= min_clear) &
+                           (catalog['cloud'].fillna(1) <= max_cloud) & (catalog['valid_fraction'] >= min_valid)]
+        if start_date is not None:
+            selected = selected[selected['date'] >= start_date]
+        if end_date is not None:
+            selected = selected[selected['date'] <= end_date]
+        return selected['file'].tolist()
+
+    @track_stage
+    def clip_clear_perc(self, shapefile_path, clear_perc_min, save_rgb=True, save_clip=False, file_list=None,
+                        thumbnail_size=512, thumbnail_format='PNG', stats_cache=None):
         '''
         Clip images to the extent of AOI.shp if only the percentage of clear pixels within the extent of AOI.shp
         higher than the threshold
         :param shapefile_path: string, file path of AOI.shp
-        :param clear_perc_min: float, maximum percent of clear pixels
+        :param clear_perc_min: float, minimum percent of clear pixels within the polygons of AOI.shp
         :param save_rgb:
         :param save_clip:
         :param file_list: list, a list of udm2 images
-        :return:
+        :param thumbnail_size: int, maximum width or height of the thumbnails in pixels
+        :param thumbnail_format: string, 'PNG' or 'JPEG'
+        :param stats_cache: string, file path of a json file caching the band statistics of each scene for the
+                            thumbnail stretch, keyed by the image, its size and modification time, the bands, the
+                            percentile and the AOI, [output folder]/thumbnail_stats.json if None
+        :return: dictionary, percentage of clear pixels of each udm2 image
         '''
 
         print('Start to clip images :)')
@@ -1366,86 +4176,97 @@ class Utilities:
         output_dir = Path(self.work_dir) / self.output_dirs['clip clear perc']
 
         pixel_res = self.pixel_res(self.satellite)  # pixel resolution
-        shp_name = shapefile_path.split('\\')[-1].split('.shp')[0]
+        shp_name = Path(shapefile_path).stem
         # List merged and clipped udm2 file path
         if file_list is None:
-            file_list = glob('{}\\{}\\*udm2.tif'.format(self.work_dir, self.output_dirs['clip']))
+            file_list = glob(str(input_dir / '*udm2.tif'))
         else:
             file_list = [file for file in file_list if 'udm2' in file]
 
-        # Check existing file
-        # if save_clip is True:
-        #     file_list_exist = glob('{}\\*.tif'.format(output_dir))
-        #     if file_list_exist:
-        #         item_id_list_exist = [file.split('\\')[0].split('_{}'.format(self.asset_attrs('analytic_sr')['suffix']))[0]
-        #                               for file in file_list_exist]
-        #         if self.remove_latest is True:
-        #             latest_file = max(file_list_exist, key=os.path.getctime)
-        #             os.remove(latest_file)
-        #             file_list_exist.remove(latest_file)
-        #         file_list = [file for file in file_list if file.split('\\')[0].split(
-        #             '_{}'.format(self.asset_attrs('analytic_sr')['suffix']))[0] not in item_id_list_exist]
+        # Cached band statistics
+        stats_cache = str(output_dir / 'thumbnail_stats.json') if stats_cache is None else stats_cache
+        stats_dict = {}
+        if os.path.exists(stats_cache):
+            with open(stats_cache, 'r') as f:
+                stats_dict = json.load(f)
+
+        # Percentage of clear pixels within the polygons, from the udm2 quality catalog if it has the AOI, computed in
+        # parallel otherwise
+        clear_perc_dict = {}
+        geom_wkt, geom_srs_wkt = self.read_aoi_geometry(shapefile_path)
+        catalog = self.load_quality_catalog() if os.path.exists(self.quality_catalog_path()) else None
+        if catalog is not None and 'region_id' in catalog.columns:
+            # same shapefile and geometry, not only the same file name, and only the images asked for
+            catalog = catalog[(catalog['region_id'] == self.region_id(shapefile_path, geom_wkt)) &
+                              catalog['file'].isin(file_list)]
+            for file, size, mtime, clear, valid_fraction in zip(catalog['file'], catalog['size'], catalog['mtime'],
+                                                                catalog['clear'], catalog['valid_fraction']):
+                if not os.path.exists(file):
+                    continue
+                signature = Manifest.file_signature(file)
+                if signature[0] == size and abs(signature[1] - mtime) < 1e-3:
+                    clear_perc_dict[file] = 0. if np.isnan(clear) else clear * valid_fraction
+        args_list = [(file, geom_wkt, geom_srs_wkt) for file in file_list if file not in clear_perc_dict]
+        with self.worker_pool() as pool:
+            clear_perc_dict.update(dict(tqdm(pool.imap_unordered(self.udm2_clear_fraction, args_list, chunksize=8),
+                                             total=len(args_list), unit="item", desc='Calculating clear percentage')))
 
         asset_id_list = []
-        for file in file_list:
-            asset_name = file.split('\\')[-1].split('.')[0]
-            asset_id = asset_name.split('_udm2')[0]
-            # Clip udm2 to the extent of bomas AOI.shp and save in memory
-            vsimem_path = '/vsimem/' + asset_name + '.tif'
-            # print(vsimem_path)
-            self.gdal_clip(file, pixel_res, shapefile_path, vsimem_path, data_type='Byte')
-            raster = gdal.Open(vsimem_path)
-            # Convert the first band (clear) to numpy array
-            clear_band_array = np.array(raster.GetRasterBand(1).ReadAsArray())
-            # Calculate the number of pixels
-            n_all_pixels = clear_band_array.shape[0] * clear_band_array.shape[1]
-            # Calculate the number of clear pixels
-            n_clear_pixels = np.count_nonzero(clear_band_array != 0)
-            # Calculate the percentage of non-clear pixels
-            clear_perc = n_clear_pixels / n_all_pixels
-            raster = None
+        thumbnail_list = []
+        stats_key_dict = {}
+        for file in tqdm(file_list, total=len(file_list), unit="item", desc='Clipping images'):
             # If the percentage of clear pixels is larger than the threshold, clip and save the associated
             # analytic_sr imagery to specific folder
-            if clear_perc >= clear_perc_min:
-                asset_id_list.append(asset_id)
-                asset_name = asset_id + '_' + self.asset_attrs(asset_type='analytic_sr')['suffix']
-                input_path = '{}\\{}.tif'.format(input_dir, asset_name)
-                if save_clip is True:
-                    output_path = '{}\\{}_{}.tif'.format(output_dir, asset_name, shp_name)
-                    try:
-                        self.gdal_clip(input_path, pixel_res, shapefile_path, output_path, data_type='UInt16')
-                    except:
-                        pass
-                if save_rgb is True:
-                    vsimem_path = '/vsimem/{}.tif'.format(asset_name)
-                    try:
-                        self.gdal_clip(input_path, pixel_res, shapefile_path, vsimem_path, data_type='UInt16')
-                        with rasterio.open(vsimem_path) as raster:
-                            # Convert to numpy arrays
-                            nir = raster.read(self.rgb_composition['red'])
-                            red = raster.read(self.rgb_composition['green'])
-                            green = raster.read(self.rgb_composition['blue'])
-                            # Normalize band DN
-                            nir_norm = self.normalize(nir, self.percentile)
-                            red_norm = self.normalize(red, self.percentile)
-                            green_norm = self.normalize(green, self.percentile)
-                            # Stack bands
-                            nrg = np.dstack((nir_norm, red_norm, green_norm))
-                            # View the color composite
-                            fig = plt.figure()
-                            plt.imshow(nrg)
-                            plot_path = '{}\\{}_{}_thumbnail.png'.format(output_dir, asset_name, shp_name)
-                            fig.savefig(plot_path, dpi=self.dpi)
-                    except:
-                        pass
+            if clear_perc_dict[file] < clear_perc_min:
+                continue
+            asset_id = Path(file).stem.split('_udm2')[0]
+            asset_id_list.append(asset_id)
+            asset_name = asset_id + '_' + self.asset_attrs(asset_type='analytic_sr')['suffix']
+            input_path = str(input_dir / '{}.tif'.format(asset_name))
+            if save_clip is True:
+                output_path = str(output_dir / '{}_{}.tif'.format(asset_name, shp_name))
+                try:
+                    self.gdal_clip(input_path, pixel_res, shapefile_path, output_path, data_type='UInt16')
+                except:
+                    pass
+            if save_rgb is True:
+                extension = 'png' if thumbnail_format == 'PNG' else 'jpg'
+                plot_path = str(output_dir / '{}_{}_thumbnail.{}'.format(asset_name, shp_name, extension))
+                band_list = [self.rgb_composition['red'], self.rgb_composition['green'], self.rgb_composition['blue']]
+                # the statistics of an image that was rebuilt since are not reused
+                stats_key = '{}|{}|{}|{}|{}'.format(input_path, band_list, self.percentile, shp_name,
+                                                    Manifest.file_signature(input_path)
+                                                    if os.path.exists(input_path) else None)
+                stats_key_dict[plot_path] = stats_key
+                thumbnail_list.append((input_path, plot_path, band_list, geom_wkt, geom_srs_wkt, thumbnail_size,
+                                       self.percentile, stats_dict.get(stats_key), thumbnail_format))
+
+        self.count_tasks(len(file_list), len(asset_id_list))
+
+        # Render thumbnails in parallel
+        if thumbnail_list:
+            failed_list = []
+            with self.worker_pool() as pool:
+                for plot_path, stats, error in tqdm(pool.imap_unordered(self.render_thumbnail, thumbnail_list),
+                                                    total=len(thumbnail_list), unit="item",
+                                                    desc='Rendering thumbnails'):
+                    if error is not None:
+                        failed_list.append(plot_path)
+                    elif stats is not None:
+                        stats_dict[stats_key_dict[plot_path]] = stats
+            with open(stats_cache, 'w') as f:
+                json.dump(stats_dict, f)
+            if failed_list:
+                print('Failed to render {} thumbnails'.format(len(failed_list)))
 
         # records_file.write('List of asset id of processed images: {}\n\n'.format(asset_id_list))
         time_str = datetime.now().strftime("%Y%m%d-%H%M%S")
         print('Finish clipping images:)')
-        print('The outputs have been saved in this directory: ' + output_dir)
+        print('The outputs have been saved in this directory: ' + str(output_dir))
         # records_file.write('The outputs have been saved in this directory: {}\n\n'.format(output_dir))
         # records_file.write('End time: {}\n\n'.format(time_str))
         # records_file.close()
+        return clear_perc_dict
 
 
 # Testing
@@ -0,0 +1,296 @@
+'''
+======================================
+Batch runner of the processing stages in Utilities.py, configured by a YAML or TOML job file
+Jobs (AOIs x date ranges) run in parallel processes within a worker budget, each job runs its stages with
+Utilities.run_pipeline() and resumes from the manifest in its work directory, i.e., rerunning a batch only rebuilds
+missing or outdated outputs.
+Usage:
+    python batch_run.py jobs.yaml [--workers 16] [--parallel-jobs 2] [--job NAME ...] [--validate]
+Job file (see jobs_example.yaml):
+    workers: 16             # total worker budget, divided between the jobs running at the same time
+    parallel_jobs: 2        # number of jobs running at the same time
+    defaults:               # settings shared by all jobs, any argument of Utilities() plus the ones below
+      proj_code: 32737
+      stages: [clear prob, NDVI]
+      with_dependencies: true
+    jobs:
+      - name: sn_aoi1
+        work_dir: /data/{name}/{start}_{end}                # {name}, {aoi}, {start} and {end} are filled in
+        aoi_shp: [/data/aois/sn_aoi1.shp, /data/aois/sn_aoi2.shp]   # one job per AOI ...
+        date_ranges: [[2019-01-01, 2020-01-01], [2020-01-01, 2021-01-01]]  # ... and per date range
+        stage_kwargs: {clip: {suffix: _clip}}
+      - name: overlapping
+        shared_dir: /data/shared/{start}_{end}     # with a shared_dir, the AOIs are one job: scenes are searched over
+        work_dir: /data/{aoi}/{start}_{end}        # the union of the AOIs, downloaded and merged once in shared_dir,
+        aoi_shp: [/data/aois/a.shp, /data/aois/b.shp]  # and clipped per AOI into its work_dir
+======================================
+'''
+
+import argparse
+import inspect
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+# Job settings that are not arguments of Utilities()
+JOB_KEYS = ['name', 'stages', 'with_dependencies', 'stage_kwargs', 'validate', 'date_ranges', 'aoi_work_dirs']
+
+
+def load_job_file(path):
+    '''
+    Read a YAML (.yaml/.yml) or TOML (.toml) job file
+    :param path: string, file path of the job file
+    :return: dictionary
+    '''
+    if Path(path).suffix.lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:  # python < 3.11
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    import yaml
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def as_date_string(value):
+    '''
+    Dates may be parsed as date objects by YAML and TOML, Utilities() takes 'YYYY-MM-DD' strings
+    '''
+    return value.strftime('%Y-%m-%d') if isinstance(value, date) else str(value)
+
+
+def expand_jobs(config):
+    '''
+    One job per AOI and date range of each entry in the job file
+    :param config: dictionary, content of the job file
+    :return: list, one dictionary of settings per job
+    '''
+
+    defaults = config.get('defaults', {})
+    job_list = []
+    for idx, entry in enumerate(config['jobs']):
+        entry = dict(defaults, **entry)
+        aoi_list = entry.get('aoi_shp')
+        aoi_list = aoi_list if isinstance(aoi_list, list) else [aoi_list]
+        date_ranges = entry.pop('date_ranges', None)
+        if date_ranges is None:
+            date_ranges = [[entry.get('start_date'), entry.get('end_date')]]
+        name = entry.get('name', 'job{}'.format(idx))
+        # with a shared_dir, the AOIs of a date range are one job sharing downloads and merged images
+        shared = entry.get('shared_dir') is not None
+        for aoi_shp, (start_date, end_date) in itertools.product([aoi_list] if shared else aoi_list, date_ranges):
+            job = dict(entry, aoi_shp=aoi_shp)
+            if start_date is not None:
+                job['start_date'], job['end_date'] = as_date_string(start_date), as_date_string(end_date)
+            fields = {'name': name, 'aoi': Path(aoi_shp).stem if aoi_shp and not shared else '',
+                      'start': job.get('start_date', '').replace('-', ''),
+                      'end': job.get('end_date', '').replace('-', '')}
+            name_parts = [name]
+            if len(aoi_list) > 1 and not shared:
+                name_parts.append(fields['aoi'])
+            if len(date_ranges) > 1:
+                name_parts.extend([fields['start'], fields['end']])
+            job['name'] = '_'.join(name_parts)
+            if shared:
+                job['aoi_work_dirs'] = dict([(aoi, str(entry['work_dir']).format(**dict(fields, aoi=Path(aoi).stem)))
+                                             for aoi in aoi_list])
+                job['work_dir'] = job['shared_dir'] = str(entry['shared_dir']).format(**fields)
+            else:
+                job['work_dir'] = str(job['work_dir']).format(**fields)
+            job_list.append(job)
+
+    name_list = [job['name'] for job in job_list]
+    duplicates = set([name for name in name_list if name_list.count(name) > 1])
+    if duplicates:
+        raise ValueError('Duplicated job names: {}'.format(', '.join(sorted(duplicates))))
+    work_dir_list = [job['work_dir'] for job in job_list]
+    if len(set(work_dir_list)) < len(work_dir_list):
+        raise ValueError('Jobs must have different work directories, use {aoi}, {start} and {end} in work_dir')
+    return job_list
+
+
+def run_job(job):
+    '''
+    Run the stages of one job, called in a child process
+    :param job: dictionary, settings of the job, see expand_jobs()
+    :return: dictionary, wall time, task counts and bytes written by the job
+    '''
+
+    from Utilities import Utilities
+
+    init_keys = set(inspect.signature(Utilities.__init__).parameters.keys()) - {'self'}
+    unknown = set(job.keys()) - init_keys - set(JOB_KEYS) - {'result_path'}
+    if unknown:
+        raise ValueError('Unknown settings of job {}: {}'.format(job['name'], ', '.join(sorted(unknown))))
+
+    start = time.perf_counter()
+    ut = Utilities(**{key: value for key, value in job.items() if key in init_keys})
+    ut.setup_dirs()
+    run_log_list = [ut.run_log_path]
+    error = None
+    try:
+        if 'aoi_work_dirs' in job:
+            ut_dict = ut.run_multi_aoi(job['aoi_work_dirs'], job['stages'],
+                                       with_dependencies=job.get('with_dependencies', False),
+                                       stage_kwargs=job.get('stage_kwargs'), validate=job.get('validate', False))
+            run_log_list.extend([ut_aoi.run_log_path for ut_aoi in ut_dict.values()])
+        else:
+            ut.run_pipeline(job['stages'], with_dependencies=job.get('with_dependencies', False),
+                            stage_kwargs=job.get('stage_kwargs'), validate=job.get('validate', False))
+    except Exception as e:
+        error = repr(e)
+    ut.manifest.save()
+
+    # task counts and bytes written from the performance records of this run
+    result = {'name': job['name'], 'work_dir': job['work_dir'], 'wall_s': time.perf_counter() - start,
+              'tasks_run': 0, 'tasks_total': 0, 'tasks_failed': 0, 'write_gb': 0., 'error': error}
+    record_list = []
+    for run_log_path in run_log_list:
+        if os.path.exists(run_log_path):
+            with open(run_log_path, 'r') as f:
+                record_list.extend([json.loads(line) for line in f if line.strip()])
+    if record_list:
+        for record in record_list:
+            if record['run_id'] != ut.run_id:
+                continue
+            for key in ['tasks_run', 'tasks_total', 'tasks_failed']:
+                result[key] += record.get(key, 0)
+            if record['parent'] is None:
+                result['write_gb'] += sum([record[key] or 0 for key in ['write_bytes', 'write_bytes_children']]
+                                          ) / 1024 ** 3
+    return result
+
+
+def run_batch(job_list, workers, parallel_jobs, log_dir):
+    '''
+    Run jobs in child processes, at most parallel_jobs at the same time, each with workers // parallel_jobs workers
+    :param job_list: list, settings of each job
+    :param workers: int, total worker budget
+    :param parallel_jobs: int, the number of jobs running at the same time
+    :param log_dir: string, folder of the job specs and results
+    :return: list, the result of each job
+    '''
+
+    parallel_jobs = max(1, min(parallel_jobs, len(job_list)))
+    n_workers = max(1, workers // parallel_jobs)
+    print('{} jobs, {} at a time with {} workers each'.format(len(job_list), parallel_jobs, n_workers))
+
+    pending = list(job_list)
+    running = []
+    result_list = []
+    while pending or running:
+        while pending and len(running) < parallel_jobs:
+            job = dict(pending.pop(0), n_workers=n_workers)
+            # the GDAL cache and threads of the machine are divided between the jobs as well
+            job['gdal_config'] = dict({'share': 1. / parallel_jobs}, **job.get('gdal_config', {}))
+            job['result_path'] = os.path.join(log_dir, '{}.result.json'.format(job['name']))
+            spec_path = os.path.join(log_dir, '{}.job.json'.format(job['name']))
+            with open(spec_path, 'w') as f:
+                json.dump(job, f, indent=1)
+            # the console output of parallel jobs goes to [work_dir]/batch_run.log
+            log_file = None
+            if parallel_jobs > 1:
+                os.makedirs(job['work_dir'], exist_ok=True)
+                log_file = open(os.path.join(job['work_dir'], 'batch_run.log'), 'a')
+            command = [sys.executable, os.path.abspath(__file__), '--run-job', spec_path]
+            process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT if log_file else None,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+            running.append((job, process, log_file, time.perf_counter()))
+            print('Started job {} (pid {})'.format(job['name'], process.pid))
+
+        time.sleep(0.5)
+        for item in list(running):
+            job, process, log_file, start = item
+            if process.poll() is None:
+                continue
+            running.remove(item)
+            if log_file is not None:
+                log_file.close()
+            if os.path.exists(job['result_path']):
+                with open(job['result_path'], 'r') as f:
+                    result = json.load(f)
+            else:
+                result = {'name': job['name'], 'work_dir': job['work_dir'], 'wall_s': time.perf_counter() - start,
+                          'tasks_run': 0, 'tasks_total': 0, 'tasks_failed': 0, 'write_gb': 0.,
+                          'error': 'exit code {}'.format(process.returncode)}
+            result_list.append(result)
+            print('Finished job {} in {:.1f} s{}'.format(job['name'], result['wall_s'],
+                                                         '' if result['error'] is None else ': ' + result['error']))
+    return result_list
+
+
+def report(result_list, wall_s):
+    '''
+    Print the throughput of each job and of the whole batch
+    '''
+    row_format = '{:<40} {:>10} {:>13} {:>8} {:>10} {:>10} {:>8}'
+    print(row_format.format('job', 'wall (s)', 'tasks run', 'failed', 'tasks/min', 'write GB', 'MB/s'))
+    for result in result_list + [{'name': 'total', 'wall_s': wall_s,
+                                  'tasks_run': sum([r['tasks_run'] for r in result_list]),
+                                  'tasks_total': sum([r['tasks_total'] for r in result_list]),
+                                  'tasks_failed': sum([r['tasks_failed'] for r in result_list]),
+                                  'write_gb': sum([r['write_gb'] for r in result_list]),
+                                  'error': None}]:
+        wall = max(result['wall_s'], 1e-9)
+        print(row_format.format(result['name'] + ('' if result['error'] is None else ' (FAILED)'),
+                                '{:.1f}'.format(result['wall_s']),
+                                '{}/{}'.format(result['tasks_run'], result['tasks_total']), result['tasks_failed'],
+                                '{:.1f}'.format(result['tasks_run'] / wall * 60), '{:.2f}'.format(result['write_gb']),
+                                '{:.1f}'.format(result['write_gb'] * 1024 / wall)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the processing stages of the jobs in a YAML or TOML file')
+    parser.add_argument('job_file', nargs='?', help='file path of the job file (.yaml, .yml or .toml)')
+    parser.add_argument('--workers', type=int, default=None, help='total worker budget, overrides the job file')
+    parser.add_argument('--parallel-jobs', type=int, default=None,
+                        help='number of jobs running at the same time, overrides the job file')
+    parser.add_argument('--job', nargs='+', default=None, help='only run these jobs')
+    parser.add_argument('--validate', action='store_true', help='check existing outputs and rebuild broken ones')
+    parser.add_argument('--list', action='store_true', help='list the jobs and exit')
+    parser.add_argument('--run-job', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_job is not None:
+        with open(args.run_job, 'r') as f:
+            job = json.load(f)
+        result = run_job(job)
+        with open(job['result_path'], 'w') as f:
+            json.dump(result, f)
+        sys.exit(0 if result['error'] is None else 1)
+
+    if args.job_file is None:
+        parser.error('the job file is required')
+    config = load_job_file(args.job_file)
+    job_list = expand_jobs(config)
+    if args.job:
+        job_list = [job for job in job_list if job['name'] in args.job]
+    if args.validate:
+        job_list = [dict(job, validate=True) for job in job_list]
+    if args.list:
+        for job in job_list:
+            print('{:<40} {} {} - {} {}'.format(job['name'], job['work_dir'], job.get('start_date'),
+                                                job.get('end_date'), job.get('stages')))
+        return
+
+    workers = args.workers or config.get('workers') or os.cpu_count()
+    parallel_jobs = args.parallel_jobs or config.get('parallel_jobs') or 1
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix='batch_run_') as log_dir:
+        if parallel_jobs > 1:
+            print('Console output of each job: [work_dir]/batch_run.log')
+        result_list = run_batch(job_list, workers, parallel_jobs, log_dir)
+        report(result_list, time.perf_counter() - start)
+    sys.exit(0 if all([result['error'] is None for result in result_list]) else 1)
+
+
+if __name__ == '__main__':
+    main()
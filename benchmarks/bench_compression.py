@@ -0,0 +1,99 @@
+'''
+======================================
+Benchmark of the GeoTIFF compression profiles in Utilities.creation_options()
+File size, write and read throughput of each codec on synthetic 4-band UInt16 SR and 8-band Byte udm2 scenes
+Usage: python bench_compression.py [--size 4096] [--repeat 3] [--tmp-dir DIR]
+======================================
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from Utilities import Utilities
+import synthetic_data
+
+gdal.UseExceptions()
+
+# name: compression profile, see Utilities.default_compression_profiles
+PROFILES = [
+    ('NONE', {'codec': 'NONE', 'tiled': False}),
+    ('LZW', {'codec': 'LZW', 'predictor': None, 'tiled': False}),
+    ('LZW pred2 tiled', {'codec': 'LZW', 'predictor': 2, 'tiled': True, 'block_size': 512}),
+    ('DEFLATE6 pred2 tiled', {'codec': 'DEFLATE', 'level': 6, 'predictor': 2, 'tiled': True, 'block_size': 512}),
+    ('ZSTD1 pred2 tiled', {'codec': 'ZSTD', 'level': 1, 'predictor': 2, 'tiled': True, 'block_size': 512}),
+    ('ZSTD9 pred2 tiled', {'codec': 'ZSTD', 'level': 9, 'predictor': 2, 'tiled': True, 'block_size': 512}),
+    ('ZSTD9 pred2 strips', {'codec': 'ZSTD', 'level': 9, 'predictor': 2, 'tiled': False}),
+]
+
+
+def write(path, array, data_type, option_list):
+    raster = gdal.GetDriverByName('GTiff').Create(path, array.shape[2], array.shape[1], array.shape[0], data_type,
+                                                  options=option_list)
+    for band_idx in range(array.shape[0]):
+        raster.GetRasterBand(band_idx + 1).WriteArray(array[band_idx])
+    raster = None
+
+
+def read(path):
+    # no block cache between runs
+    gdal.SetCacheMax(0)
+    return gdal.Open(path).ReadAsArray()
+
+
+def timeit(func, repeat):
+    '''
+    Best wall time of several runs
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(size, repeat, tmp_dir=None):
+    rng = np.random.default_rng(0)
+    land = synthetic_data.smooth_noise(rng, (size, size), max(size // 4, 8))
+    sr, udm2 = synthetic_data.make_scene(rng, land, size, cloud_cover=0.3)
+    cache_max = gdal.GetCacheMax()
+
+    root_dir = tempfile.mkdtemp(prefix='planetscopepy_compression_', dir=tmp_dir)
+    try:
+        print('{:<10} {:<22} {:>9} {:>7} {:>10} {:>10}'.format('asset', 'profile', 'MB', 'ratio', 'write MB/s',
+                                                                 'read MB/s'))
+        for asset_type, array, data_type in [('analytic_sr', sr, gdal.GDT_UInt16), ('udm2', udm2, gdal.GDT_Byte)]:
+            raw_mb = array.nbytes / 1024 ** 2
+            for name, profile in PROFILES:
+                ut = Utilities(work_dir=root_dir, api_key='', compression_profiles={asset_type: profile})
+                option_list = ut.creation_options(profile=asset_type)
+                path = os.path.join(root_dir, '{}_{}.tif'.format(asset_type, name.replace(' ', '_')))
+                write_s = timeit(lambda: write(path, array, data_type, option_list), repeat)
+                read_s = timeit(lambda: read(path), repeat)
+                gdal.SetCacheMax(cache_max)
+                assert np.array_equal(read(path), array)
+                file_mb = os.path.getsize(path) / 1024 ** 2
+                print('{:<10} {:<22} {:>9.1f} {:>7.2f} {:>10.0f} {:>10.0f}'.format(
+                    asset_type, name, file_mb, raw_mb / file_mb, raw_mb / write_s, raw_mb / read_s))
+    finally:
+        gdal.SetCacheMax(cache_max)
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the GeoTIFF compression profiles')
+    parser.add_argument('--size', type=int, default=4096, help='number of rows and columns')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is reported')
+    parser.add_argument('--tmp-dir', default=None, help='folder for the test files')
+    args = parser.parse_args()
+    main(args.size, args.repeat, args.tmp_dir)
@@ -0,0 +1,73 @@
+'''
+======================================
+Benchmark of the percentile stretch in Utilities.normalize()
+Compare the histogram based percentiles with the previous implementation (flatten + np.percentile per band)
+======================================
+'''
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from Utilities import Utilities
+
+
+def normalize_legacy(array, percentile=None):
+    '''
+    Previous implementation of Utilities.normalize(), applied to one band
+    '''
+    array_np = np.array(array)
+    array_flat = np.array(array_np).flatten()
+    if percentile is None:
+        array_min, array_max = array_flat.min(), array_flat.max()
+    else:
+        array_min = np.percentile(array_flat, min(percentile))
+        array_max = np.percentile(array_flat, max(percentile))
+    return (array_np - array_min) / (array_max - array_min)
+
+
+def timeit(func, repeat):
+    '''
+    Best wall time of several runs
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(size, n_band, repeat, percentile=(2, 98)):
+    rng = np.random.default_rng(0)
+    array = rng.gamma(2., 800., (n_band, size, size)).clip(0, 65535).astype(np.uint16)
+
+    legacy = np.stack([normalize_legacy(band, percentile) for band in array])
+    new = Utilities.normalize(array, percentile)
+    max_diff = float(np.abs(legacy - new).max())
+
+    t_legacy = timeit(lambda: [normalize_legacy(band, percentile) for band in array], repeat)
+    t_new = timeit(lambda: Utilities.normalize(array, percentile), repeat)
+    t_stats = timeit(lambda: Utilities.band_percentiles(array, percentile), repeat)
+    stats = Utilities.band_percentiles(array, percentile)
+    t_cached = timeit(lambda: Utilities.normalize(array, stats=stats), repeat)
+
+    print('array: {} bands x {} x {} UInt16'.format(n_band, size, size))
+    print('legacy normalize (flatten + np.percentile): {:.3f} s'.format(t_legacy))
+    print('histogram normalize:                        {:.3f} s ({:.1f}x)'.format(t_new, t_legacy / t_new))
+    print('  of which band_percentiles:                {:.3f} s'.format(t_stats))
+    print('normalize with cached statistics:           {:.3f} s'.format(t_cached))
+    print('max abs difference to legacy:               {:.2e}'.format(max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Utilities.normalize()')
+    parser.add_argument('--size', type=int, default=4096, help='number of rows and columns')
+    parser.add_argument('--bands', type=int, default=3, help='number of bands')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the best one is reported')
+    args = parser.parse_args()
+    main(args.size, args.bands, args.repeat)
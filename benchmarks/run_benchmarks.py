@@ -0,0 +1,239 @@
+'''
+======================================
+Benchmark of the processing stages in Utilities.py on synthetic PlanetScope data
+Each stage is timed on freshly generated data of several sizes, the results are saved in benchmarks/results as
+[date-time]_[commit].json so that they can be compared across commits.
+Usage:
+    python run_benchmarks.py [--sizes 512 1024] [--days 4] [--orbits 2] [--strips 3] [--stages import merge clip ...]
+    python run_benchmarks.py --compare results/OLD.json results/NEW.json
+======================================
+'''
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR.parent))
+sys.path.insert(0, str(BENCHMARK_DIR))
+import synthetic_data
+
+RESULTS_DIR = BENCHMARK_DIR / 'results'
+# Modules that should only be imported by the stages that need them
+HEAVY_MODULES = ['planet', 'geopandas', 'netCDF4', 'requests', 'matplotlib', 'rasterio']
+
+
+def git_commit():
+    '''
+    Current commit of the repository, with a '-dirty' suffix if there are uncommitted changes
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(BENCHMARK_DIR),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        cwd=str(BENCHMARK_DIR), stderr=subprocess.DEVNULL).decode().strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def find_gdal_script(name):
+    '''
+    File path of a GDAL python script, e.g., gdal_calc.py
+    '''
+    path = shutil.which(name)
+    if path is None:
+        try:
+            import osgeo_utils
+            path = str(Path(osgeo_utils.__file__).parent / name)
+        except ImportError:
+            path = name
+    return path
+
+
+def measure_import(n_repeat=5):
+    '''
+    Time of importing Utilities in a fresh interpreter, the fastest of several runs
+    :return: tuple, (seconds, list of heavy modules loaded by the import)
+    '''
+    code = ('import sys, time; start = time.perf_counter(); import Utilities; '
+            'print(time.perf_counter() - start); '
+            'print(",".join([m for m in {} if m in sys.modules]))'.format(HEAVY_MODULES))
+    elapsed_list = []
+    for _ in range(n_repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=str(BENCHMARK_DIR.parent)).decode()
+        elapsed, modules = output.strip().split('\n')[-2:]
+        elapsed_list.append(float(elapsed))
+    return min(elapsed_list), [m for m in modules.split(',') if m]
+
+
+def benchmark_stages(ut, data, work_dir):
+    '''
+    Processing stages in order of execution, each stage uses the outputs of the previous ones
+    :return: list, tuples of (stage name, function)
+    '''
+
+    raw_dir = Path(data['raw_dir'])
+    merge_dir = Path(work_dir) / ut.output_dirs['merge']
+    clip_dir = Path(work_dir) / ut.output_dirs['clip']
+    stack_dir = Path(work_dir) / 'stack'
+
+    def complex_gdal_merge():
+        # two orbits of the first day, stacked as sr + udm2 (12 bands) beforehand
+        date = data['dates'][0]
+        input_list = []
+        for idx, sr_path in enumerate(sorted(glob(str(clip_dir / '{}_*AnalyticMS_SR.tif'.format(date))))[:2]):
+            udm2_path = sr_path.replace('AnalyticMS_SR', 'udm2')
+            input_path = str(Path(work_dir) / 'complex_input{}.tif'.format(idx))
+            ut.gdal_merge(input_path=' '.join([sr_path, udm2_path]), output_path=input_path, data_type='UInt16',
+                          separate=True, compression='LZW')
+            input_list.append(input_path)
+        start = time.perf_counter()
+        ut.complex_gdal_merge(input_list[0], input_list[1], str(Path(work_dir) / 'complex_output.tif'))
+        return time.perf_counter() - start
+
+    def stack_as_nc():
+        stack_dir.mkdir(exist_ok=True)
+        sr_list = sorted(glob(str(clip_dir / '*AnalyticMS_SR.tif')))
+        udm2_list = sorted(glob(str(clip_dir / '*udm2.tif')))
+        base_date = datetime.strptime(data['dates'][0], '%Y%m%d').strftime('%Y-%m-%d')
+        ut.stack_as_nc(str(clip_dir), str(stack_dir), 'stack.nc', sr_list[0], base_date=base_date,
+                       input_suffix='AnalyticMS_SR', udm2=True, udm2_suffix='udm2', ref_udm2=udm2_list[0])
+
+    def normalize():
+        from Utilities import Utilities
+        sr_path = sorted(glob(str(clip_dir / '*AnalyticMS_SR.tif')))[0]
+        from osgeo import gdal
+        array = gdal.Open(sr_path).ReadAsArray()
+        Utilities.normalize(array, [2, 98], nodata=0)
+
+    return [
+        ('udm2_setnull', lambda: ut.udm2_setnull(file_list=sorted(glob(str(raw_dir / '*udm2.tif'))))),
+        ('merge', lambda: ut.merge(file_list=sorted(glob(str(raw_dir / '*.tif'))))),
+        ('clip', lambda: ut.clip(file_list=sorted(glob(str(merge_dir / '*.tif'))), aoi_shp=data['aoi_shp'])),
+        ('band_algebra_ndvi', lambda: ut.band_algebra('NDVI', file_list=sorted(glob(str(clip_dir / '*.tif'))))),
+        ('band_algebra_clear_prob',
+         lambda: ut.band_algebra('clear prob', file_list=sorted(glob(str(clip_dir / '*.tif'))))),
+        ('clip_clear_perc', lambda: ut.clip_clear_perc(data['aoi_shp'], 0.1, save_rgb=True, save_clip=False,
+                                                       file_list=sorted(glob(str(clip_dir / '*udm2.tif'))))),
+        ('normalize', normalize),
+        ('stack_as_nc', stack_as_nc),
+        ('complex_gdal_merge', complex_gdal_merge),
+        ('prep_pipline', lambda: ut.prep_pipline(str(clip_dir), str(Path(work_dir) / 'prep'), data['dates'][0],
+                                                 data['dates'][-1], jp2=False, clean=True, complex_merge=True,
+                                                 temp_dir=str(work_dir))),
+    ]
+
+
+def run_size(size, args):
+    '''
+    Generate data of one size and time every stage
+    :return: list, one result per stage
+    '''
+
+    from Utilities import Utilities
+
+    root_dir = tempfile.mkdtemp(prefix='planetscopepy_bench_', dir=args.tmp_dir)
+    cwd = os.getcwd()
+    result_list = []
+    try:
+        start = time.perf_counter()
+        data = synthetic_data.generate(root_dir, size=size, n_days=args.days, n_orbits=args.orbits,
+                                       n_strips=args.strips)
+        input_mb = sum([os.path.getsize(fp) for fp in glob(os.path.join(data['raw_dir'], '*.tif'))]) / 1024 ** 2
+        print('size {}: {} files, {:.0f} MB generated in {:.1f} s'.format(size, data['n_files'], input_mb,
+                                                                         time.perf_counter() - start))
+        ut = Utilities(work_dir=root_dir, aoi_shp=data['aoi_shp'], all_scenes=data['all_scenes'],
+                       proj_code=synthetic_data.EPSG, api_key='', n_workers=args.workers)
+        ut.gdal_calc_path = find_gdal_script('gdal_calc.py')
+        ut.gdal_merge_path = find_gdal_script('gdal_merge.py')
+        ut.setup_dirs()
+        # complex_gdal_merge() writes temporary files to the current directory
+        os.chdir(root_dir)
+
+        for stage, func in benchmark_stages(ut, data, root_dir):
+            if args.stages and stage not in args.stages:
+                continue
+            start = time.perf_counter()
+            error = None
+            try:
+                elapsed = func()
+            except Exception:
+                elapsed = None
+                error = traceback.format_exc(limit=3)
+            wall_s = elapsed if elapsed is not None else time.perf_counter() - start
+            print('  {:<26} {:>9.2f} s{}'.format(stage, wall_s, '' if error is None else ' FAILED'))
+            result_list.append({'size': size, 'days': args.days, 'orbits': args.orbits, 'strips': args.strips,
+                                'input_mb': input_mb, 'stage': stage, 'wall_s': wall_s, 'error': error})
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(root_dir, ignore_errors=True)
+    return result_list
+
+
+def compare(old_path, new_path):
+    '''
+    Print the wall time of each stage and size of two result files
+    '''
+    old, new = [json.load(open(path, 'r')) for path in [old_path, new_path]]
+    old_dict = dict(((r['stage'], r['size']), r['wall_s']) for r in old['results'] if r['error'] is None)
+    print('{:<26} {:>6} {:>12} {:>12} {:>8}'.format('stage', 'size', old['commit'], new['commit'], 'speedup'))
+    for r in new['results']:
+        key = (r['stage'], r['size'])
+        if r['error'] is not None or key not in old_dict:
+            continue
+        print('{:<26} {:>6} {:>11.2f}s {:>11.2f}s {:>7.2f}x'.format(r['stage'], str(r['size']), old_dict[key],
+                                                                    r['wall_s'], old_dict[key] / max(r['wall_s'], 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the processing stages on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048],
+                        help='rows and columns of each synthetic strip')
+    parser.add_argument('--days', type=int, default=4)
+    parser.add_argument('--orbits', type=int, default=2)
+    parser.add_argument('--strips', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--stages', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--tmp-dir', default=None, help='folder for the synthetic data and outputs')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data and outputs')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result_list = []
+    if not args.stages or 'import' in args.stages:
+        elapsed, modules = measure_import()
+        print('{:<28} {:>9.2f} s{}'.format('import', elapsed, ' loads ' + ', '.join(modules) if modules else ''))
+        result_list.append({'size': None, 'stage': 'import', 'wall_s': elapsed, 'modules': modules, 'error': None})
+    for size in args.sizes:
+        result_list.extend(run_size(size, args))
+
+    commit = git_commit()
+    RESULTS_DIR.mkdir(exist_ok=True)
+    output_path = RESULTS_DIR / '{}_{}.json'.format(datetime.now().strftime('%Y%m%d-%H%M%S'), commit)
+    with open(str(output_path), 'w') as f:
+        json.dump({'commit': commit, 'time': datetime.now().isoformat(), 'host': socket.gethostname(),
+                   'cpu_count': os.cpu_count(), 'python': sys.version.split()[0], 'numpy': np.__version__,
+                   'results': result_list}, f, indent=1)
+    print('Results saved in {}'.format(output_path))
+
+
+if __name__ == '__main__':
+    main()
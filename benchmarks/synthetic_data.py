@@ -0,0 +1,203 @@
+'''
+======================================
+Synthetic PlanetScope data for benchmarks
+- 4-band UInt16 analytic_sr and 8-band Byte udm2 strips, named like downloaded assets
+- several orbits (satellite ids) per day, each with overlapping strips and a no data background
+- clouds, haze and cloud shadows from smooth random fields, consistent between sr and udm2
+- an AOI shapefile and a GeoPackage of scene footprints (all_scenes)
+Usage: python synthetic_data.py OUTPUT_DIR [--size 1024] [--days 4] [--orbits 2] [--strips 3]
+======================================
+'''
+
+import argparse
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+gdal.UseExceptions()
+
+EPSG = 32737
+PIXEL_RES = 3
+ORIGIN_X, ORIGIN_Y = 500000., 9800000.
+PROCESS_LEVEL = '3B'
+
+
+def smooth_noise(rng, shape, scale):
+    '''
+    Smooth random field in the range 0 - 1, a coarse random grid interpolated to the full size
+    :param rng: numpy random generator
+    :param shape: tuple, (rows, columns)
+    :param scale: int, the size of the features in pixels
+    :return: numpy array, float32
+    '''
+    ny, nx = shape
+    coarse = rng.random((ny // scale + 2, nx // scale + 2)).astype(np.float32)
+    x_coarse, y_coarse = np.arange(coarse.shape[1]) * scale, np.arange(coarse.shape[0]) * scale
+    rows = np.stack([np.interp(np.arange(nx), x_coarse, row) for row in coarse])
+    field = np.stack([np.interp(np.arange(ny), y_coarse, col) for col in rows.T], axis=1)
+    field -= field.min()
+    return (field / max(field.max(), 1e-6)).astype(np.float32)
+
+
+def write_tif(path, array, x0, y0, data_type, nodata=None):
+    '''
+    Write a (band, row, column) array as an LZW compressed GeoTIFF, like delivered assets
+    '''
+    n_band, ny, nx = array.shape
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    raster = gdal.GetDriverByName('GTiff').Create(str(path), nx, ny, n_band, data_type, options=['COMPRESS=LZW'])
+    raster.SetGeoTransform((x0, PIXEL_RES, 0, y0, 0, -PIXEL_RES))
+    raster.SetProjection(srs.ExportToWkt())
+    for band_idx in range(n_band):
+        band = raster.GetRasterBand(band_idx + 1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(array[band_idx])
+    raster = None
+
+
+def make_scene(rng, land, size, cloud_cover):
+    '''
+    Surface reflectance and udm2 of one strip
+    :param rng: numpy random generator
+    :param land: numpy array, land cover field of the strip (0 - 1)
+    :param size: int, the number of rows and columns
+    :param cloud_cover: float, approximate fraction of cloudy pixels
+    :return: tuple, (sr (4, size, size) UInt16, udm2 (8, size, size) Byte)
+    '''
+    cloud_field = smooth_noise(rng, (size, size), max(size // 6, 8))
+    cloud_threshold = np.quantile(cloud_field, 1 - cloud_cover) if cloud_cover > 0 else 2.
+    cloud = cloud_field >= cloud_threshold
+    haze_light = (cloud_field >= cloud_threshold - 0.08) & ~cloud
+    haze_heavy = (cloud_field >= cloud_threshold - 0.03) & ~cloud
+    haze_light &= ~haze_heavy
+    shift = max(size // 40, 1)
+    shadow = np.zeros_like(cloud)
+    shadow[shift:, shift:] = cloud[:-shift, :-shift]
+    shadow &= ~cloud
+    snow = np.zeros_like(cloud)
+    clear = ~(cloud | shadow | haze_light | haze_heavy | snow)
+
+    # Surface reflectance: blue, green, red, nir
+    base = np.array([400, 700, 600, 2500], dtype=np.float32)[:, None, None]
+    amplitude = np.array([300, 400, 700, 2000], dtype=np.float32)[:, None, None]
+    sr = base + amplitude * np.stack([land, land, 1 - land, land])
+    sr += rng.normal(0, 40, sr.shape).astype(np.float32)
+    sr[:, haze_light] = sr[:, haze_light] * 0.8 + 1500
+    sr[:, haze_heavy] = sr[:, haze_heavy] * 0.5 + 3500
+    sr[:, cloud] = 6000 + rng.normal(0, 300, (4, int(cloud.sum())))
+    sr[:, shadow] *= 0.45
+    sr = sr.clip(1, 10000).astype(np.uint16)
+
+    udm2 = np.zeros((8, size, size), dtype=np.uint8)
+    for band_idx, mask in enumerate([clear, snow, shadow, haze_light, haze_heavy, cloud]):
+        udm2[band_idx] = mask
+    udm2[6] = (50 + 50 * smooth_noise(rng, (size, size), max(size // 8, 8))).astype(np.uint8)  # confidence
+    udm2[7] = cloud * 2 + shadow * 4  # unusable pixels bitmask
+
+    # No data background of the rotated scene footprint
+    rows, cols = np.mgrid[0:size, 0:size]
+    background = (cols + rows * 0.15 < size * 0.1) | (cols + rows * 0.15 > size * 1.05)
+    sr[:, background] = 0
+    udm2[:, background] = 0
+    return sr, udm2
+
+
+def generate(output_dir, size=1024, n_days=4, n_orbits=2, n_strips=3, start_date='20190101', seed=0):
+    '''
+    Generate synthetic raw assets, an AOI shapefile and a GeoPackage of scene footprints
+    :param output_dir: string, [output_dir]/raw, [output_dir]/aoi.shp and [output_dir]/all_scenes.gpkg are created
+    :param size: int, the number of rows and columns of each strip
+    :param n_days: int, the number of acquisition days
+    :param n_orbits: int, the number of orbits (satellite ids) per day
+    :param n_strips: int, the number of overlapping strips per orbit
+    :param start_date: string, 'YYYYMMDD'
+    :param seed: int, random seed
+    :return: dictionary, file paths and extent of the generated data
+    '''
+
+    rng = np.random.default_rng(seed)
+    raw_dir = Path(output_dir) / 'raw'
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    step_y = int(size * 0.8)
+    step_x = size // 2
+    extent_x = size + step_x * (n_orbits - 1)
+    extent_y = size + step_y * (n_strips - 1)
+    land = smooth_noise(rng, (extent_y, extent_x), max(size // 4, 8))
+
+    footprint_list = []
+    date0 = datetime.strptime(start_date, '%Y%m%d')
+    for day in range(n_days):
+        date = (date0 + timedelta(days=day)).strftime('%Y%m%d')
+        for orbit in range(n_orbits):
+            satellite_id = '0f{:02x}'.format(orbit + 16)
+            for strip in range(n_strips):
+                item_id = '{}_{:02d}{:02d}{:02d}_{}'.format(date, 17 + orbit, 30 + strip, 10 * strip, satellite_id)
+                col0, row0 = step_x * orbit, step_y * strip
+                sr, udm2 = make_scene(rng, land[row0:row0 + size, col0:col0 + size], size,
+                                      cloud_cover=rng.uniform(0, 0.5))
+                x0, y0 = ORIGIN_X + col0 * PIXEL_RES, ORIGIN_Y - row0 * PIXEL_RES
+                write_tif(raw_dir / '{}_{}_AnalyticMS_SR.tif'.format(item_id, PROCESS_LEVEL), sr, x0, y0,
+                          gdal.GDT_UInt16, nodata=0)
+                write_tif(raw_dir / '{}_{}_udm2.tif'.format(item_id, PROCESS_LEVEL), udm2, x0, y0, gdal.GDT_Byte)
+                footprint_list.append((item_id, x0, y0, x0 + size * PIXEL_RES, y0 - size * PIXEL_RES))
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    # AOI in the middle of the covered area
+    aoi_path = str(Path(output_dir) / 'aoi.shp')
+    min_x = ORIGIN_X + extent_x * PIXEL_RES * 0.2
+    max_x = ORIGIN_X + extent_x * PIXEL_RES * 0.8
+    max_y = ORIGIN_Y - extent_y * PIXEL_RES * 0.2
+    min_y = ORIGIN_Y - extent_y * PIXEL_RES * 0.8
+    write_polygons(aoi_path, 'ESRI Shapefile', srs, [('aoi', min_x, max_y, max_x, min_y)])
+
+    # Footprints of all scenes
+    all_scenes_path = str(Path(output_dir) / 'all_scenes.gpkg')
+    write_polygons(all_scenes_path, 'GPKG', srs, footprint_list)
+
+    return {'raw_dir': str(raw_dir), 'aoi_shp': aoi_path, 'all_scenes': all_scenes_path,
+            'dates': sorted(set([footprint[0].split('_')[0] for footprint in footprint_list])),
+            'n_files': 2 * len(footprint_list)}
+
+
+def write_polygons(path, driver_name, srs, box_list):
+    '''
+    Write rectangles with an 'id' attribute
+    :param box_list: list, tuples of (id, min x, max y, max x, min y)
+    '''
+    driver = ogr.GetDriverByName(driver_name)
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    dataset = driver.CreateDataSource(path)
+    layer = dataset.CreateLayer(Path(path).stem, srs=srs, geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('id', ogr.OFTString))
+    for box_id, x0, y0, x1, y1 in box_list:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]:
+            ring.AddPoint_2D(x, y)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('id', box_id)
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+    dataset = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic PlanetScope data')
+    parser.add_argument('output_dir')
+    parser.add_argument('--size', type=int, default=1024, help='rows and columns of each strip')
+    parser.add_argument('--days', type=int, default=4, help='number of acquisition days')
+    parser.add_argument('--orbits', type=int, default=2, help='number of orbits per day')
+    parser.add_argument('--strips', type=int, default=3, help='number of strips per orbit')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    info = generate(args.output_dir, args.size, args.days, args.orbits, args.strips, seed=args.seed)
+    print('{} files written to {}'.format(info['n_files'], info['raw_dir']))
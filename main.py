@@ -14,6 +14,7 @@ from pathlib import Path
 
 
 # ===================================          Settings        ======================================#
+# To process many AOIs or date ranges, list them in a job file and run: python batch_run.py jobs_example.yaml
 # You can also change the variables namely default_XXXXXX in the Utilities.py file
 # In this case, you do not need to set these variables when you call functions in Utilities.py
 ut = utils.Utilities(
@@ -34,8 +35,9 @@ ut = utils.Utilities(
     aoi_shp='/mnt/raid5/California_timeseries/aois/sn_aoi1.shp',
     rgb_composition={'red': 4, 'green': 3, 'blue': 2},  # Settings for raster visualization
     percentile=[2, 98],
-    remove_latest=True,  # Set as True only when you killed the previous run and want to rerun it.
-    # In this case, the lasted file will be removed in case it is not a complete file...
+    remove_latest=True,  # Outputs not recorded in the manifest (e.g., created before it) are accepted if newer than
+    # their inputs. True means they are checked with validate_output() first, so that the file being written when the
+    # previous run was killed is rebuilt; False accepts them unchecked. rebuild_unrecorded=True rebuilds them all...
 )
 
 
@@ -55,6 +57,9 @@ ut = utils.Utilities(
 # ut.clip_clear_perc(shapefile_path=r'C:\Users\ChengY\PycharmProjects\PyPlanetScope_WD\shp\bomas\layers\POLYGON.shp', clear_perc_min=0.1,
 #                    save_rgb=True, save_clip=False) # Bomas...
 #
+# # Or run the stages incrementally, only outputs whose inputs or settings changed are rebuilt
+# ut.run_pipeline(stages=['clear prob', 'NDVI'], with_dependencies=True)
+#
 #
 # # ===================================         Download       ======================================#
 # # In case you have downloaded some images before using this script and want to save new images in the same folder,
@@ -47,8 +47,9 @@ ut = utils.Utilities(
     aoi_shp='/mnt/raid5/California_timeseries/aois/sn_aoi1.shp',
     rgb_composition={'red': 4, 'green': 3, 'blue': 2},  # Settings for raster visualization
     percentile=[2, 98],
-    remove_latest=True,  # Set as True only when you killed the previous run and want to rerun it.
-    # In this case, the lasted file will be removed in case it is not a complete file...
+    remove_latest=True,  # Outputs not recorded in the manifest (e.g., created before it) are accepted if newer than
+    # their inputs. True means they are checked with validate_output() first, so that the file being written when the
+    # previous run was killed is rebuilt; False accepts them unchecked. rebuild_unrecorded=True rebuilds them all...
 )
 
 
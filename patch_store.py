@@ -0,0 +1,164 @@
+'''
+======================================
+Memory-mapped patch store of the image stacks of Utilities.prep_pipline() for training deep learning models
+- one uncompressed .npy array per asset of shape (patch row, patch column, time, band, patch size, patch size), so
+  that any patch and time window is a contiguous, zero-copy slice of a memory map
+- index.json, dates, grid and the patches with their pixel offsets, bounds and fraction of valid pixels
+- clear_fraction.npy, fraction of clear pixels (udm2 band 1) of each patch and date, NaN without valid pixels
+Written by Utilities.export_patch_store(), read with PatchStore, which only needs numpy.
+======================================
+'''
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class PatchStore:
+    '''
+    Read-only access to a patch store
+    :param store_dir: string, folder of the store
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        with open(str(self.store_dir / 'index.json'), 'r') as f:
+            self.index = json.load(f)
+        self.dates = self.index['dates']
+        self.patch_size = self.index['patch_size']
+        self.assets = dict([(asset, np.load(str(self.store_dir / attrs['file']), mmap_mode='r'))
+                            for asset, attrs in self.index['assets'].items()])
+        self.clear_fraction = np.load(str(self.store_dir / 'clear_fraction.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index['patches'])
+
+    def patch(self, iy, ix, asset='sr', start=None, end=None):
+        '''
+        Array of one patch, a view of the memory map, the data is read when it is accessed
+        :param iy: int, patch row
+        :param ix: int, patch column
+        :param asset: string, e.g., 'sr' or 'udm2'
+        :param start: int or string, first time index or date 'YYYYMMDD' (inclusive)
+        :param end: int or string, last time index or date 'YYYYMMDD' (exclusive)
+        :return: numpy array, (time, band, patch size, patch size)
+        '''
+        return self.assets[asset][iy, ix, self.time_slice(start, end)]
+
+    def time_slice(self, start=None, end=None):
+        '''
+        Slice of the time axis, dates are converted to indices
+        '''
+        if isinstance(start, str):
+            start = int(np.searchsorted(self.dates, start, side='left'))
+        if isinstance(end, str):
+            end = int(np.searchsorted(self.dates, end, side='left'))
+        return slice(start, end)
+
+    def query(self, min_clear=0., min_valid=0., start=None, end=None):
+        '''
+        Patches and dates with enough clear pixels, e.g., for sampling training data
+        :param min_clear: float, minimum fraction of clear pixels of a patch on a date
+        :param min_valid: float, minimum fraction of valid (not no data) pixels of a patch
+        :param start: int or string, first time index or date 'YYYYMMDD' (inclusive)
+        :param end: int or string, last time index or date 'YYYYMMDD' (exclusive)
+        :return: list, tuples of (patch row, patch column, time index)
+        '''
+        time_slice = self.time_slice(start, end)
+        offset = time_slice.indices(len(self.dates))[0]
+        valid = np.zeros(self.clear_fraction.shape[:2], dtype=bool)
+        for patch in self.index['patches']:
+            valid[patch['iy'], patch['ix']] = patch['valid_fraction'] >= min_valid
+        clear = np.nan_to_num(self.clear_fraction[:, :, time_slice], nan=-1.) >= min_clear
+        return [(int(iy), int(ix), int(t) + offset) for iy, ix, t in np.argwhere(clear & valid[:, :, None])]
+
+
+def write_patch_store(store_dir, asset_paths, dates, patch_size=256, clear_asset='udm2', valid_asset='sr',
+                      desc='Writing patch store'):
+    '''
+    Write band-sequential image stacks (the bands of each date in sequence) as a patch store
+    :param store_dir: string, folder of the store, created if it does not exist
+    :param asset_paths: dictionary, {asset name: file path of the stack}, e.g., {'sr': 'PS_AnalyticMS_SR_stack.tif'}
+    :param dates: list, dates of the stacks 'YYYYMMDD'
+    :param patch_size: int, rows and columns of a patch, the last row/column of patches is padded with 0
+    :param clear_asset: string, asset whose first band of each date is the clear mask (udm2)
+    :param valid_asset: string, asset whose first band of each date is 0 where there is no data
+    :param desc: string, description of the progress bar
+    :return: dictionary, the index
+    '''
+
+    from osgeo import gdal
+    from tqdm import tqdm
+
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    n_date = len(dates)
+    raster_dict = dict([(asset, gdal.Open(str(path), gdal.GA_ReadOnly)) for asset, path in asset_paths.items()])
+    ref_raster = raster_dict[valid_asset]
+    x_size, y_size = ref_raster.RasterXSize, ref_raster.RasterYSize
+    n_py, n_px = -(-y_size // patch_size), -(-x_size // patch_size)
+
+    asset_index = {}
+    array_dict = {}
+    for asset, raster in raster_dict.items():
+        if raster.RasterCount % n_date != 0:
+            raise ValueError('{} bands of {} cannot be split into {} dates'.format(raster.RasterCount, asset, n_date))
+        n_band = raster.RasterCount // n_date
+        dtype = gdal.GetDataTypeName(raster.GetRasterBand(1).DataType)
+        dtype = {'Byte': 'uint8'}.get(dtype, dtype.lower())
+        asset_index[asset] = {'file': '{}.npy'.format(asset), 'dtype': dtype, 'bands': n_band,
+                              'source': str(asset_paths[asset])}
+        array_dict[asset] = np.lib.format.open_memmap(str(store_dir / asset_index[asset]['file']), mode='w+',
+                                                      dtype=dtype,
+                                                      shape=(n_py, n_px, n_date, n_band, patch_size, patch_size))
+    clear_fraction = np.lib.format.open_memmap(str(store_dir / 'clear_fraction.npy'), mode='w+', dtype='float32',
+                                               shape=(n_py, n_px, n_date))
+    valid_count = np.zeros((n_py, n_px), dtype=np.int64)
+
+    for iy in tqdm(range(n_py), total=n_py, unit="row", desc=desc):
+        y0 = iy * patch_size
+        height = min(patch_size, y_size - y0)
+        for t in range(n_date):
+            valid = None
+            for asset, raster in raster_dict.items():
+                n_band = asset_index[asset]['bands']
+                for k in range(n_band):
+                    strip = np.zeros((patch_size, n_px * patch_size), dtype=array_dict[asset].dtype)
+                    strip[:height, :x_size] = raster.GetRasterBand(t * n_band + k + 1).ReadAsArray(
+                        0, y0, x_size, height)
+                    patches = strip.reshape(patch_size, n_px, patch_size).transpose(1, 0, 2)
+                    array_dict[asset][iy, :, t, k] = patches
+                    if asset == valid_asset and k == 0:
+                        valid = patches > 0
+            clear = array_dict[clear_asset][iy, :, t, 0] > 0
+            n_valid = valid.sum(axis=(1, 2))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                clear_fraction[iy, :, t] = np.where(n_valid > 0, (clear & valid).sum(axis=(1, 2)) / n_valid, np.nan)
+            valid_count[iy] = np.maximum(valid_count[iy], n_valid)
+
+    geo_transform = ref_raster.GetGeoTransform()
+    patch_list = []
+    for iy in range(n_py):
+        for ix in range(n_px):
+            row, col = iy * patch_size, ix * patch_size
+            height, width = min(patch_size, y_size - row), min(patch_size, x_size - col)
+            min_x = geo_transform[0] + col * geo_transform[1]
+            max_y = geo_transform[3] + row * geo_transform[5]
+            patch_list.append({'id': '{}_{}'.format(iy, ix), 'iy': iy, 'ix': ix, 'row': row, 'col': col,
+                               'height': height, 'width': width,
+                               'bounds': [min_x, max_y + height * geo_transform[5], min_x + width * geo_transform[1],
+                                          max_y],
+                               'valid_fraction': float(valid_count[iy, ix]) / (height * width)})
+    index = {'dates': list(dates), 'patch_size': patch_size, 'x_size': x_size, 'y_size': y_size,
+             'geo_transform': list(geo_transform), 'projection': ref_raster.GetProjection(), 'assets': asset_index,
+             'patches': patch_list}
+    for array in list(array_dict.values()) + [clear_fraction]:
+        array.flush()
+    raster_dict = None
+    temp_path = store_dir / '.index.json.{}'.format(os.getpid())
+    with open(str(temp_path), 'w') as f:
+        json.dump(index, f)
+    os.replace(str(temp_path), str(store_dir / 'index.json'))
+    return index
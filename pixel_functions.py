@@ -0,0 +1,26 @@
+'''
+======================================
+Python pixel functions of the virtual intermediates of Utilities.py (VRTDerivedRasterBand), evaluated by GDAL when a
+VRT is read, so that the intermediate images are never written to disk
+- udm2_setnull(), background pixels of udm2 set to no data, same as Utilities.gdal_udm2_setnull()
+GDAL runs them when GDAL_VRT_ENABLE_PYTHON=TRUSTED_MODULES and this module is listed in
+GDAL_VRT_PYTHON_TRUSTED_MODULES, which Utilities.gdal_settings() sets with virtual_intermediates, see
+Utilities.vrt_python_settings().
+======================================
+'''
+
+import numpy as np
+
+
+def udm2_setnull(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    '''
+    One udm2 band with background pixels set to 255 (no data), i.e., where the sum of bands 1 - 7 is 0 as a Byte,
+    like the expressions 'A+B+C+D+E+F+G' and 'A*(B>0)' of gdal_calc.py
+    :param in_ar: list, arrays of udm2 bands 1 - 7 and of the output band (Byte)
+    :param out_ar: numpy array, the output block
+    '''
+    total = in_ar[0].astype(np.uint8)
+    for array in in_ar[1:7]:
+        # wraps around like the Byte sum of gdal_calc.py
+        total += array.astype(np.uint8)
+    out_ar[:] = np.where(total == 0, 255, in_ar[7] * (total > 0))
@@ -0,0 +1,59 @@
+'''
+======================================
+Summary of the run log written by the processing stages in Utilities.py
+Usage: python run_log_summary.py [WORK_DIR/run_log.jsonl] [--run RUN_ID] [--runs] [--gdal]
+======================================
+'''
+
+import argparse
+import json
+from Utilities import Utilities
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show where time goes across runs of the processing stages')
+    parser.add_argument('run_log', help='file path of the run log, e.g., [work_dir]/run_log.jsonl')
+    parser.add_argument('--run', default=None, help='only summarize this run id')
+    parser.add_argument('--runs', action='store_true', help='list the runs in the log')
+    parser.add_argument('--gdal', action='store_true', help='show the GDAL settings of each stage')
+    args = parser.parse_args()
+
+    if args.gdal:
+        with open(args.run_log, 'r') as f:
+            record_list = [json.loads(line) for line in f if line.strip()]
+        settings_dict = {}
+        for record in record_list:
+            if (args.run is None or record['run_id'] == args.run) and record.get('gdal_settings') is not None:
+                settings_dict[record['stage']] = record['gdal_settings']
+        for stage, settings in settings_dict.items():
+            print('{:<18} {}'.format(stage, ' '.join(['{}={}'.format(key, value) for key, value in settings.items()])))
+        return
+
+    if args.runs:
+        with open(args.run_log, 'r') as f:
+            record_list = [json.loads(line) for line in f if line.strip()]
+        run_dict = {}
+        for record in record_list:
+            run = run_dict.setdefault(record['run_id'], {'start': record['start'], 'wall_s': 0., 'stages': 0})
+            if record['parent'] is None:
+                run['wall_s'] += record['wall_s']
+                run['stages'] += 1
+        print('{:<40} {:<28} {:>8} {:>12}'.format('run id', 'start', 'stages', 'wall (s)'))
+        for run_id, run in run_dict.items():
+            print('{:<40} {:<28} {:>8} {:>12.1f}'.format(run_id, run['start'], run['stages'], run['wall_s']))
+        return
+
+    row_list = Utilities.summarize_run_log(args.run_log, run_id=args.run)
+    header = '{:<18} {:>6} {:>7} {:>11} {:>7} {:>10} {:>12} {:>9} {:>9} {:>13} {:>10}'
+    print(header.format('stage', 'calls', 'errors', 'wall (s)', 'share', 'cpu (s)', 'cpu sub (s)', 'read GB',
+                        'write GB', 'tasks run', 'peak MB'))
+    row_format = '{:<18} {:>6} {:>7} {:>11.1f} {:>7} {:>10.1f} {:>12.1f} {:>9.2f} {:>9.2f} {:>13} {:>10.0f}'
+    for row in row_list:
+        share = '-' if row['share'] is None else '{:.0%}'.format(row['share'])
+        print(row_format.format(row['stage'], row['calls'], row['errors'], row['wall_s'], share, row['cpu_s'],
+                                row['cpu_children_s'], row['read_gb'], row['write_gb'],
+                                '{:.0f}/{:.0f}'.format(row['tasks_run'], row['tasks_total']), row['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    main()
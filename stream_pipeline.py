@@ -0,0 +1,234 @@
+'''
+======================================
+Streaming mode of the processing stages of Utilities.py: download -> setnull -> merge -> clip -> band algebra run as
+producers and consumers instead of one stage after the other
+- the search results are grouped by day and satellite id (the images merged together) and downloaded by a pool of
+  threads, fed through a bounded queue, the earliest groups first
+- as soon as every asset of a group is downloaded, its setnull, merge, clip and band algebra tasks are run one step
+  after the other in a process pool, while the downloads of the next groups go on
+- at most max_groups groups are downloaded but not processed yet, so that downloads do not run ahead of the disk
+- only the coordinator (the main thread) records the outputs in the manifest, up-to-date outputs are skipped as in
+  Utilities.run_tasks()
+Started by Utilities.run_streaming().
+======================================
+'''
+
+import os
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+# Utilities instance of a worker process, see init_worker()
+_worker_ut = None
+
+
+def init_worker(ut, settings):
+    '''
+    Initializer of the worker processes
+    :param ut: Utilities, settings of the coordinator
+    :param settings: dictionary, GDAL settings of a worker, see Utilities.gdal_settings()
+    '''
+    global _worker_ut
+    from Utilities import apply_gdal_config
+    apply_gdal_config(settings)
+    _worker_ut = ut
+
+
+def run_task(task):
+    '''
+    Build the output of a task in a worker process, the coordinator records it in the manifest
+    :param task: list, fields of Utilities.Task
+    :return: tuple, (task, True if the output was built, error message or None)
+    '''
+    from Utilities import Task
+
+    task = Task(*task)
+    # the outdated output is replaced by atomic_output() once the new one is complete
+    signature = _worker_ut.output_signature(task.output_path)
+    try:
+        getattr(_worker_ut, task.func)(**task.kwargs)
+    except Exception:
+        return list(task), False, traceback.format_exc(limit=3)
+    return list(task), _worker_ut.output_signature(task.output_path) not in [None, signature], None
+
+
+class StreamPipeline:
+    '''
+    Stream the search results of a Utilities instance through the processing stages
+    :param ut: Utilities
+    :param stages: list, stages run on each group after the download, in order: 'setnull', 'merge', 'clip', 'NDVI',
+                   'clear prob'
+    :param download_workers: int, the number of concurrent downloads
+    :param max_groups: int, the maximum number of groups downloaded but not processed yet, 2 x n_workers if None
+    '''
+
+    steps = [['setnull'], ['merge'], ['clip'], ['NDVI', 'clear prob']]
+
+    def __init__(self, ut, stages=None, download_workers=4, max_groups=None):
+        self.ut = ut
+        stages = ['setnull', 'merge', 'clip', 'NDVI', 'clear prob'] if stages is None else list(stages)
+        self.step_list = [[stage for stage in step if stage in stages] for step in self.steps]
+        self.step_list = [step for step in self.step_list if step]
+        self.download_workers = max(1, download_workers)
+        self.max_groups = max(1, max_groups or 2 * ut.n_workers)
+        self.adopt_settings = ut.adopt_settings()
+        self.events = queue.Queue()
+        self.download_queue = queue.Queue(maxsize=2 * self.download_workers)
+        self.group_slots = threading.Semaphore(self.max_groups)
+        self.stop = threading.Event()
+        self.counts = {'tasks_total': 0, 'tasks_run': 0, 'tasks_failed': 0}
+
+    @staticmethod
+    def group_key(item_id):
+        '''
+        Day and satellite id of an item, e.g., '20190509_172738_0f46' -> ('20190509', '0f46')
+        '''
+        return item_id.split('_')[0], item_id.split('_')[-1]
+
+    def feed(self, group_dict):
+        '''
+        Producer: queue the downloads of each group once a group slot is free, the earliest groups first
+        '''
+        for key in sorted(group_dict.keys()):
+            self.group_slots.acquire()
+            if self.stop.is_set():
+                return
+            pending = group_dict[key]['pending']
+            if not pending:
+                self.events.put(('downloaded', key, None, None, True))
+            for item_id, asset_type in sorted(pending):
+                self.download_queue.put((key, item_id, asset_type))
+        for _ in range(self.download_workers):
+            self.download_queue.put(None)
+
+    def download(self):
+        '''
+        Consumer of the download queue, one thread per concurrent download
+        '''
+        while not self.stop.is_set():
+            job = self.download_queue.get()
+            if job is None:
+                return
+            key, item_id, asset_type = job
+            asset_exist = False
+            try:
+                for item_type in self.ut.item_types:
+                    asset_exist = self.ut.download_one(item_id, asset_type, item_type) or asset_exist
+            except Exception as e:
+                print('Failed to download {} {}: {}'.format(item_id, asset_type, e))
+            self.events.put(('downloaded', key, item_id, asset_type, asset_exist))
+
+    def step_tasks(self, group, stage):
+        '''
+        Tasks of a stage for a group, built from the outputs of the previous steps
+        '''
+        ut = self.ut
+        raw_list = [ut.raw_path(item_id, asset_type) for item_id in sorted(group['items'])
+                    for asset_type in ut.asset_types]
+        raw_list = [fp for fp in raw_list if os.path.exists(fp)]
+        if stage == 'setnull':
+            return ut.setnull_tasks([fp for fp in raw_list if ut.asset_attrs('udm2')['suffix'] in fp])
+        if stage == 'merge':
+            return ut.merge_tasks(raw_list, ut.asset_types)
+        if stage == 'clip':
+            return ut.clip_tasks([fp for fp in group['outputs'].get('merge', []) if os.path.exists(fp)])
+        return ut.band_algebra_tasks(stage, [fp for fp in group['outputs'].get('clip', []) if os.path.exists(fp)])
+
+    def advance(self, key, group, pool):
+        '''
+        Submit the tasks of the next step of a group that has outdated outputs
+        :return: boolean, True if the group is finished
+        '''
+        while group['step'] < len(self.step_list):
+            task_list = []
+            for stage in self.step_list[group['step']]:
+                stage_tasks = self.step_tasks(group, stage)
+                group['outputs'][stage] = [task.output_path for task in stage_tasks]
+                task_list.extend(stage_tasks)
+            group['step'] += 1
+            self.counts['tasks_total'] += len(task_list)
+            task_list = [task for task in task_list if not self.ut.manifest.is_up_to_date(
+                task.output_path, task.input_paths, task.params, **self.adopt_settings)]
+            if task_list:
+                group['running'] = len(task_list)
+                self.counts['tasks_run'] += len(task_list)
+                for task in task_list:
+                    pool.apply_async(run_task, (list(task),),
+                                     callback=lambda result, key=key: self.events.put(('built', key) + tuple(result)),
+                                     error_callback=lambda e, key=key, task=task: self.events.put(
+                                         ('built', key, list(task), False, repr(e))))
+                return False
+        return True
+
+    def run(self, item_list):
+        '''
+        Coordinator: download and process the items of a search
+        :param item_list: list, items (GeoJSON features), see Utilities.search_items()
+        :return: dictionary, task counts
+        '''
+        ut = self.ut
+        group_dict = {}
+        for item in item_list:
+            group = group_dict.setdefault(self.group_key(item['id']), {'items': set(), 'pending': set(), 'step': 0,
+                                                                      'outputs': {}, 'running': 0})
+            group['items'].add(item['id'])
+            for asset_type in ut.asset_types:
+                if not ut.manifest.is_up_to_date(ut.raw_path(item['id'], asset_type), [], {'asset_type': asset_type},
+                                                 **self.adopt_settings):
+                    group['pending'].add((item['id'], asset_type))
+        n_download = sum([len(group['pending']) for group in group_dict.values()])
+        print('{} items in {} groups, {} assets to download'.format(len(item_list), len(group_dict), n_download))
+
+        settings = ut.gdal_settings(ut._stage_stack[-1] if ut._stage_stack else None, ut.n_workers)
+        # the workers do not touch the manifest or the Planet client
+        worker_ut = ut.worker_copy()
+        thread_list = [threading.Thread(target=self.feed, args=(group_dict,), daemon=True)] + \
+                      [threading.Thread(target=self.download, daemon=True) for _ in range(self.download_workers)]
+        for thread in thread_list:
+            thread.start()
+
+        n_done = 0
+        start = time.perf_counter()
+        progress = tqdm(total=len(group_dict), unit="group", desc='Streaming')
+        try:
+            with Pool(ut.n_workers, initializer=init_worker, initargs=(worker_ut, settings)) as pool:
+                while n_done < len(group_dict):
+                    event = self.events.get()
+                    key, group = event[1], group_dict[event[1]]
+                    if event[0] == 'downloaded':
+                        _, _, item_id, asset_type, asset_exist = event
+                        if item_id is not None:
+                            group['pending'].discard((item_id, asset_type))
+                            if asset_exist is True:
+                                ut.manifest.record(ut.raw_path(item_id, asset_type), [], {'asset_type': asset_type},
+                                                   'download')
+                        if group['pending']:
+                            continue
+                    else:
+                        _, _, task, built, error = event
+                        task = task if isinstance(task, tuple) else tuple(task)
+                        if built is True:
+                            ut.manifest.record(task[1], task[2], task[3], task[0])
+                        else:
+                            self.counts['tasks_failed'] += 1
+                            print('Failed to build {}: {}'.format(task[1], (error or 'no output').strip()
+                                                                  .splitlines()[-1]))
+                        group['running'] -= 1
+                        if group['running'] > 0:
+                            continue
+                    if self.advance(key, group, pool):
+                        n_done += 1
+                        progress.update(1)
+                        self.group_slots.release()
+                        if n_done == 1:
+                            tqdm.write('First group {} done after {:.0f} s'.format('_'.join(key),
+                                                                                  time.perf_counter() - start))
+        finally:
+            self.stop.set()
+            progress.close()
+            ut.manifest.save()
+        return self.counts
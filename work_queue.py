@@ -0,0 +1,357 @@
+'''
+======================================
+File based work queue for running the tasks of the per-scene/per-date stages of Utilities.py (setnull, merge, clip,
+band algebra, ...) on several hosts sharing a filesystem, without any external service
+- a task is a json file moved between the folders pending/, leased/, done/ and failed/ of the queue by atomic renames
+- a worker leases a task by renaming it from pending/ to leased/ and keeps the lease alive by touching the file
+- leases not renewed for lease_s seconds (e.g., the worker host died) are returned to pending/ by whoever notices,
+the age of a lease is measured by the clock of the filesystem, not of the host, see filesystem_time()
+- failed tasks are retried up to max_attempts times, then moved to failed/ with the error
+- workers never write the manifest, the coordinator records the outputs of done tasks in it
+The coordinator is Utilities.run_tasks() when Utilities(queue_dir=...) is set, it starts queue_workers local workers.
+Workers on other hosts: python work_queue.py worker QUEUE_DIR [--host-workers 8]
+Stop them with: python work_queue.py stop QUEUE_DIR
+======================================
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import socket
+import threading
+import time
+import traceback
+from multiprocessing import Process
+from pathlib import Path
+
+from tqdm import tqdm
+
+
+class WorkQueue:
+    '''
+    Work queue in a folder on a shared filesystem
+    :param queue_dir: string, folder of the queue
+    :param lease_s: float, seconds after which a lease that was not renewed expires
+    :param max_attempts: int, the number of times a task is tried before it is moved to failed/
+    '''
+
+    folders = ['pending', 'leased', 'done', 'failed']
+
+    def __init__(self, queue_dir, lease_s=300, max_attempts=3):
+        self.queue_dir = Path(queue_dir)
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        for folder in self.folders:
+            (self.queue_dir / folder).mkdir(parents=True, exist_ok=True)
+        self.utilities_path = self.queue_dir / 'utilities.pkl'
+        self.stop_path = self.queue_dir / 'STOP'
+
+    @staticmethod
+    def task_id(seq, output_path, func, kwargs):
+        '''
+        File name of a task, tasks are leased in order of seq
+        '''
+        key = json.dumps([output_path, func, kwargs], sort_keys=True, default=str)
+        return '{:08d}_{}.json'.format(seq, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def write(self, folder, name, item):
+        '''
+        Write a task file under a temporary name and rename it, so that readers never see a partial file
+        '''
+        temp_path = self.queue_dir / folder / '.{}.{}-{}'.format(name, socket.gethostname(), os.getpid())
+        with open(str(temp_path), 'w') as f:
+            json.dump(item, f, default=str)
+        os.replace(str(temp_path), str(self.queue_dir / folder / name))
+
+    def read(self, path):
+        with open(str(path), 'r') as f:
+            return json.load(f)
+
+    def list(self, folder):
+        return sorted([name for name in os.listdir(str(self.queue_dir / folder)) if not name.startswith('.')])
+
+    def publish(self, ut):
+        '''
+        Share the settings of the coordinator (a Utilities instance) with the workers
+        :param ut: Utilities
+        '''
+        state = ut.__dict__.copy()
+        state.update({'_client': None, '_manifest': None, '_stage_stack': [], '_stage_tasks': {}})
+        worker_ut = ut.__class__.__new__(ut.__class__)
+        worker_ut.__dict__.update(state)
+        temp_path = str(self.utilities_path) + '.{}-{}'.format(socket.gethostname(), os.getpid())
+        with open(temp_path, 'wb') as f:
+            pickle.dump(worker_ut, f)
+        os.replace(temp_path, str(self.utilities_path))
+
+    def enqueue(self, task_list):
+        '''
+        Add tasks (Utilities.Task) to pending/
+        :param task_list: list, Task
+        :return: list, task file names
+        '''
+        # results of earlier runs of the same outputs are dropped, their file names have another sequence number
+        output_set = set([str(task.output_path) for task in task_list if task.output_path is not None])
+        for folder in ['done', 'failed']:
+            for name in self.list(folder):
+                try:
+                    if str(self.read(self.queue_dir / folder / name)['task'][1]) in output_set:
+                        os.remove(str(self.queue_dir / folder / name))
+                except (FileNotFoundError, ValueError):
+                    continue  # removed meanwhile
+        seq0 = len(self.list('pending')) + len(self.list('leased')) + len(self.list('done'))
+        name_list = []
+        for idx, task in enumerate(task_list):
+            name = self.task_id(seq0 + idx, task.output_path, task.func, task.kwargs)
+            self.write('pending', name, {'task': list(task), 'attempts': 0, 'errors': []})
+            name_list.append(name)
+        return name_list
+
+    def lease(self, worker_id):
+        '''
+        Lease the first pending task
+        :param worker_id: string
+        :return: tuple, (task file name, task item) or (None, None) if there is no pending task
+        '''
+        for name in self.list('pending'):
+            try:
+                # the lease starts before the task appears in leased/, otherwise a task that waited in pending/ for
+                # longer than lease_s could be taken as expired and requeued right after the rename
+                os.utime(str(self.queue_dir / 'pending' / name))
+                os.rename(str(self.queue_dir / 'pending' / name), str(self.queue_dir / 'leased' / name))
+            except FileNotFoundError:
+                continue  # leased by another worker
+            item = self.read(self.queue_dir / 'leased' / name)
+            item['worker'] = worker_id
+            return name, item
+        return None, None
+
+    def renew(self, name):
+        '''
+        Keep a lease alive
+        :return: boolean, False if the lease was lost
+        '''
+        try:
+            os.utime(str(self.queue_dir / 'leased' / name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release(self, name, item, error=None):
+        '''
+        Move a leased task to done/, or back to pending/ (failed/ after max_attempts) if it failed
+        :return: boolean, False if the lease was lost, e.g., expired and leased by another worker
+        '''
+        leased_path = self.queue_dir / 'leased' / name
+        claimed_path = self.queue_dir / 'leased' / '.{}.{}-{}'.format(name, socket.gethostname(), os.getpid())
+        try:
+            os.rename(str(leased_path), str(claimed_path))
+        except FileNotFoundError:
+            return False
+        if error is None:
+            self.write('done', name, item)
+        else:
+            item['attempts'] += 1
+            item['errors'].append(error)
+            self.write('pending' if item['attempts'] < self.max_attempts else 'failed', name, item)
+        os.remove(str(claimed_path))
+        return True
+
+    def filesystem_time(self):
+        '''
+        Current time of the shared filesystem, which stamps the modification times of the leases. The clocks of the
+        hosts may differ from it and from each other, so a probe file is touched in the queue and its mtime is read.
+        :return: float, seconds since the epoch
+        '''
+        probe_path = str(self.queue_dir / '.clock.{}-{}'.format(socket.gethostname(), os.getpid()))
+        with open(probe_path, 'a'):
+            pass
+        os.utime(probe_path)
+        now = os.path.getmtime(probe_path)
+        os.remove(probe_path)
+        return now
+
+    def requeue_expired(self):
+        '''
+        Return the tasks whose lease expired to pending/, counting the attempt
+        :return: int, the number of requeued tasks
+        '''
+        n_requeued = 0
+        name_list = self.list('leased')
+        now = self.filesystem_time() if name_list else None
+        for name in name_list:
+            try:
+                expired = now - os.path.getmtime(str(self.queue_dir / 'leased' / name)) > self.lease_s
+            except FileNotFoundError:
+                continue
+            if not expired:
+                continue
+            try:
+                item = self.read(self.queue_dir / 'leased' / name)
+            except (FileNotFoundError, ValueError):
+                continue  # released meanwhile
+            if self.release(name, item, error='lease expired'):
+                n_requeued += 1
+        return n_requeued
+
+    def status(self):
+        return dict([(folder, len(self.list(folder))) for folder in self.folders])
+
+    def wait(self, name_list, desc, poll_s=1.):
+        '''
+        Wait until the tasks are done or failed, requeuing expired leases
+        :param name_list: list, task file names
+        :param desc: string, description of the progress bar
+        :param poll_s: float, seconds between checks of the queue
+        :return: tuple, (done items, failed items)
+        '''
+        remaining = set(name_list)
+        done_list, failed_list = [], []
+        with tqdm(total=len(name_list), unit="item", desc=desc) as progress:
+            while remaining:
+                self.requeue_expired()
+                for folder, item_list in [('done', done_list), ('failed', failed_list)]:
+                    for name in set(self.list(folder)) & remaining:
+                        item_list.append(self.read(self.queue_dir / folder / name))
+                        remaining.discard(name)
+                        progress.update(1)
+                if remaining:
+                    time.sleep(poll_s)
+        return done_list, failed_list
+
+    def run(self, ut, task_list, desc, n_local_workers=0, host_workers=None):
+        '''
+        Coordinator: publish the settings, enqueue the tasks, start local workers and wait for the results
+        :param ut: Utilities
+        :param task_list: list, Task
+        :param desc: string, description of the progress bar
+        :param n_local_workers: int, the number of worker processes started on this host
+        :param host_workers: int, the number of workers sharing this host's GDAL settings, n_local_workers if None
+        :return: tuple, (done Task list, failed Task list)
+        '''
+        if os.path.exists(str(self.stop_path)):
+            os.remove(str(self.stop_path))
+        self.publish(ut)
+        name_list = self.enqueue(task_list)
+        process_list = [Process(target=run_worker,
+                                args=(str(self.queue_dir), '{}-local{}'.format(socket.gethostname(), idx)),
+                                kwargs={'lease_s': self.lease_s, 'max_attempts': self.max_attempts,
+                                        'host_workers': host_workers or n_local_workers, 'idle_s': 5})
+                        for idx in range(n_local_workers)]
+        for process in process_list:
+            process.start()
+        try:
+            done_list, failed_list = self.wait(name_list, desc)
+        finally:
+            for process in process_list:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+        for item in failed_list:
+            print('Failed task {}: {}'.format(item['task'][1], item['errors'][-1].strip().splitlines()[-1]))
+        # done tasks of this batch are consumed, failed ones are kept for inspection
+        for name in name_list:
+            if (self.queue_dir / 'done' / name).exists():
+                os.remove(str(self.queue_dir / 'done' / name))
+        return [item['task'] for item in done_list], [item['task'] for item in failed_list]
+
+
+def run_worker(queue_dir, worker_id=None, lease_s=300, max_attempts=3, host_workers=1, idle_s=None, poll_s=1.):
+    '''
+    Worker: lease tasks and build their outputs with the settings published by the coordinator, until STOP exists in
+    the queue folder or no task was found for idle_s seconds
+    :param queue_dir: string, folder of the queue
+    :param worker_id: string, [host]-[pid] if None
+    :param lease_s: float, seconds after which a lease that was not renewed expires
+    :param max_attempts: int, the number of times a task is tried
+    :param host_workers: int, the number of workers on this host, the GDAL cache and threads are divided between them
+    :param idle_s: float, seconds without tasks before the worker exits, never if None
+    :param poll_s: float, seconds between checks of the queue
+    :return: int, the number of tasks run
+    '''
+
+    from Utilities import apply_gdal_config
+
+    queue = WorkQueue(queue_dir, lease_s=lease_s, max_attempts=max_attempts)
+    worker_id = '{}-{}'.format(socket.gethostname(), os.getpid()) if worker_id is None else worker_id
+    ut, ut_mtime = None, None
+    n_run = 0
+    idle_start = time.time()
+    while not queue.stop_path.exists():
+        queue.requeue_expired()
+        name, item = queue.lease(worker_id)
+        if name is None:
+            if idle_s is not None and time.time() - idle_start > idle_s:
+                break
+            time.sleep(poll_s)
+            continue
+
+        # settings of the coordinator, reloaded when they change
+        if ut is None or os.path.getmtime(str(queue.utilities_path)) != ut_mtime:
+            ut_mtime = os.path.getmtime(str(queue.utilities_path))
+            with open(str(queue.utilities_path), 'rb') as f:
+                ut = pickle.load(f)
+            ut.queue_dir = None
+            apply_gdal_config(ut.gdal_settings(None, host_workers))
+
+        # keep the lease alive while the task runs
+        stop_renew = threading.Event()
+
+        def renew():
+            while not stop_renew.wait(lease_s / 3.):
+                if not queue.renew(name):
+                    break
+
+        renew_thread = threading.Thread(target=renew, daemon=True)
+        renew_thread.start()
+        stage, output_path, input_paths, params, func, kwargs = item['task']
+        error = None
+        try:
+            # the outdated output is replaced by atomic_output() once the new one is complete, a failed rebuild
+            # leaves it unchanged
+            signature = ut.output_signature(output_path)
+            getattr(ut, func)(**kwargs)
+            if output_path is not None and ut.output_signature(output_path) in [None, signature]:
+                raise RuntimeError('Output not created: {}'.format(output_path))
+        except Exception:
+            error = '{}: {}'.format(worker_id, traceback.format_exc())
+        stop_renew.set()
+        renew_thread.join()
+        queue.release(name, item, error)
+        n_run += 1
+        idle_start = time.time()
+    return n_run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker of the file based work queue of Utilities.py')
+    parser.add_argument('command', choices=['worker', 'stop', 'status'])
+    parser.add_argument('queue_dir', help='folder of the queue on the shared filesystem')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes to start on this host')
+    parser.add_argument('--host-workers', type=int, default=None,
+                        help='number of workers on this host sharing the GDAL cache and threads, --workers if None')
+    parser.add_argument('--lease', type=float, default=300, help='seconds after which an unrenewed lease expires')
+    parser.add_argument('--attempts', type=int, default=3, help='number of times a task is tried')
+    parser.add_argument('--idle', type=float, default=None, help='exit after this many seconds without tasks')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue_dir, lease_s=args.lease, max_attempts=args.attempts)
+    if args.command == 'stop':
+        queue.stop_path.touch()
+    elif args.command == 'status':
+        print(queue.status())
+    else:
+        kwargs = {'lease_s': args.lease, 'max_attempts': args.attempts, 'idle_s': args.idle,
+                  'host_workers': args.host_workers or args.workers}
+        process_list = [Process(target=run_worker, args=(args.queue_dir,), kwargs=kwargs)
+                        for _ in range(args.workers)]
+        for process in process_list:
+            process.start()
+        for process in process_list:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()